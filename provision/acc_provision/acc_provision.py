@@ -4,35 +4,42 @@ from __future__ import print_function, unicode_literals
 
 import argparse
 import base64
+import bisect
+import collections
+import contextlib
 import copy
-import functools
+import hashlib
+import heapq
+import io
 import ipaddress
-import requests
 import json
 import os
 import os.path
+import pickle
 import random
 import re
+import shutil
 import string
 import sys
+import tempfile
+import threading
+import time
 import uuid
 
-import pkg_resources
 import pkgutil
 import tarfile
 import yaml
 from yaml import SafeLoader
 
-from itertools import combinations
-from OpenSSL import crypto
-from jinja2 import Environment, PackageLoader
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
 from os.path import exists
 if __package__ is None or __package__ == '':
-    from apic_provision import Apic, ApicKubeConfig
-    from cloud_provision import CloudProvision
+    from apic_provision import Apic, ApicKubeConfig, RegenState, TrackedConfig
 else:
-    from .apic_provision import Apic, ApicKubeConfig
-    from .cloud_provision import CloudProvision
+    from .apic_provision import Apic, ApicKubeConfig, RegenState, TrackedConfig
 
 
 # This black magic forces pyyaml to load YAML strings as unicode rather
@@ -45,6 +52,17 @@ def construct_yaml_str(self, node):
 
 SafeLoader.add_constructor(u'tag:yaml.org,2002:str', construct_yaml_str)
 
+# Use libyaml when pyyaml was built with it
+YamlLoader = getattr(yaml, "CSafeLoader", SafeLoader)
+if YamlLoader is not SafeLoader:
+    YamlLoader.add_constructor(u'tag:yaml.org,2002:str', construct_yaml_str)
+YamlDumper = getattr(yaml, "CDumper", yaml.Dumper)
+YamlSafeDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+# Templates may dump config subtrees that are being tracked
+for dumper in set([yaml.Dumper, yaml.SafeDumper, YamlDumper, YamlSafeDumper]):
+    yaml.add_representer(TrackedConfig, yaml.representer.SafeRepresenter.represent_dict, Dumper=dumper)
+
 VERSION_FIELDS = [
     "cnideploy_version",
     "aci_containers_host_version",
@@ -57,23 +75,156 @@ VERSION_FIELDS = [
 
 FLAVORS_PATH = os.path.dirname(os.path.realpath(__file__)) + "/flavors.yaml"
 VERSIONS_PATH = os.path.dirname(os.path.realpath(__file__)) + "/versions.yaml"
+TEMPLATES_PATH = os.path.dirname(os.path.realpath(__file__)) + "/templates"
+COMPILED_TEMPLATES_PATH = os.path.dirname(os.path.realpath(__file__)) + "/compiled_templates"
+TEMPLATE_EXTENSIONS = ("yaml", "json")
+COMPILED_TEMPLATES_MANIFEST = "manifest.json"
+RENDER_WORKERS = 4
+
+
+def load_yaml_file(path):
+    with open(path, 'r') as stream:
+        try:
+            return yaml.load(stream, Loader=YamlLoader)
+        except yaml.YAMLError as exc:
+            print(exc)
+
 
+def get_cache_dir():
+    # ACC_PROVISION_CACHE_DIR="" disables the cache
+    cache_dir = os.environ.get("ACC_PROVISION_CACHE_DIR")
+    if cache_dir is None:
+        cache_dir = os.path.join(
+            os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+            "acc-provision")
+    return cache_dir or None
+
+
+def catalog_cache_path():
+    cache_dir = get_cache_dir()
+    if not cache_dir:
+        return None
+    key = hashlib.sha1(os.path.dirname(FLAVORS_PATH).encode("utf-8")).hexdigest()[:12]
+    return os.path.join(cache_dir, "catalog-py%d%d-%s.pickle" % (sys.version_info[0], sys.version_info[1], key))
+
+
+def catalog_sources():
+    ret = {}
+    for path in (FLAVORS_PATH, VERSIONS_PATH):
+        st = os.stat(path)
+        ret[path] = [st.st_mtime, st.st_size, None]
+    return ret
 
-with open(VERSIONS_PATH, 'r') as stream:
+
+def catalog_source_hash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def cache_path_private(path):
+    """Whether path is owned by this user and not writable by others
+
+    Cached pickles and template bytecode are only loaded from such paths,
+    loading them would run code planted by another user.
+    """
+    if not hasattr(os, "getuid"):
+        return True
     try:
-        doc = yaml.safe_load(stream)
-    except yaml.YAMLError as exc:
-        print(exc)
-    VERSIONS = doc['versions']
+        st = os.stat(path)
+    except OSError:
+        return False
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
 
-with open(FLAVORS_PATH, 'r') as stream:
+
+def save_cache_file(cache_path, data):
     try:
-        doc = yaml.safe_load(stream)
-    except yaml.YAMLError as exc:
-        print(exc)
-    DEFAULT_FLAVOR_OPTIONS = doc['kubeFlavorOptions']
-    CfFlavorOptions = doc['cfFlavorOptions']
-    FLAVORS = doc['flavors']
+        cache_dir = os.path.dirname(cache_path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError):
+        # The cache is only an optimization
+        pass
+
+
+def pickle_catalog(cached):
+    # Pickled as loaded: the module later sets functions in the catalog
+    # (e.g. CfFlavorOptions), which can't be unpickled before they exist
+    return pickle.dumps(cached, pickle.HIGHEST_PROTOCOL)
+
+
+def flush_catalog_cache():
+    """Write the catalog cache entry deferred by load_catalog(save=False)"""
+    global catalog_pending
+    cache_path = catalog_cache_path()
+    if catalog_pending is not None and cache_path:
+        save_cache_file(cache_path, catalog_pending)
+    catalog_pending = None
+
+
+def load_catalog(save=True):
+    """Return the parsed flavors and versions catalog
+
+    The parsed files are pickled in the user cache directory. The cache is
+    used while the source mtimes and sizes match; otherwise it is still
+    used if the source contents hash the same. With save=False an updated
+    cache entry is only written by flush_catalog_cache().
+    """
+    global catalog_pending
+    sources = catalog_sources()
+    cache_path = catalog_cache_path()
+    cached = None
+    if (cache_path and os.path.exists(cache_path) and
+            cache_path_private(os.path.dirname(cache_path)) and cache_path_private(cache_path)):
+        try:
+            with open(cache_path, 'rb') as f:
+                cached = pickle.load(f)
+        except Exception:
+            cached = None
+    if cached is not None and sorted(cached["sources"]) == sorted(sources):
+        if all(cached["sources"][p][:2] == sources[p][:2] for p in sources):
+            return cached["catalog"]
+        for path in sources:
+            sources[path][2] = catalog_source_hash(path)
+        if all(cached["sources"][p][2] == sources[p][2] for p in sources):
+            cached["sources"] = sources
+            catalog_pending = pickle_catalog(cached)
+            if save:
+                flush_catalog_cache()
+            return cached["catalog"]
+
+    catalog = {
+        "flavors": load_yaml_file(FLAVORS_PATH),
+        "versions": load_yaml_file(VERSIONS_PATH),
+    }
+    if cache_path:
+        for path in sources:
+            if sources[path][2] is None:
+                sources[path][2] = catalog_source_hash(path)
+        catalog_pending = pickle_catalog({"sources": sources, "catalog": catalog})
+        if save:
+            flush_catalog_cache()
+    return catalog
+
+
+# Importing the module does not write to the cache, main() does
+catalog_pending = None
+CATALOG = load_catalog(save=False)
+VERSIONS = CATALOG["versions"]['versions']
+DEFAULT_FLAVOR_OPTIONS = CATALOG["flavors"]['kubeFlavorOptions']
+CfFlavorOptions = CATALOG["flavors"]['cfFlavorOptions']
+FLAVORS = CATALOG["flavors"]['flavors']
+
+# Fetched versions catalogs (versions_url) are reused for this many
+# seconds before they are revalidated
+VERSIONS_CACHE_TTL = 3600
+VERSIONS_TIMEOUT = (5, 30)
+
+# Outputs of the previous run, set with --state-file
+regen_state = None
 
 
 def info(msg):
@@ -96,8 +247,39 @@ def yaml_quote(s):
     return "'%s'" % str(s).replace("'", "''")
 
 
+# Strings the emitters write double quoted
+QUOTED_SCALAR = re.compile(r"[^\x20-\x7e]")
+
+
+def libyaml_same(data):
+    # libyaml folds double quoted scalars differently from the Python
+    # emitter. Where a fold happens depends on indentation, the key and
+    # the escapes, not only on the scalar's length, so any scalar that
+    # needs double quotes goes to the Python emitter.
+    stack = [data]
+    while stack:
+        d = stack.pop()
+        if isinstance(d, dict):
+            stack.extend(d.keys())
+            stack.extend(d.values())
+        elif isinstance(d, list):
+            stack.extend(d)
+        elif isinstance(d, (str, type(u""))) and QUOTED_SCALAR.search(d):
+            return False
+    return True
+
+
+def yaml_dump(data, stream=None, safe=True, **kwargs):
+    """yaml.dump with the libyaml emitter, unless its output would differ"""
+    if libyaml_same(data):
+        dumper = YamlSafeDumper if safe else YamlDumper
+    else:
+        dumper = yaml.SafeDumper if safe else yaml.Dumper
+    return yaml.dump(data, stream, Dumper=dumper, **kwargs)
+
+
 def yaml_indent(s, **kwargs):
-    return yaml.dump(s, **kwargs)
+    return yaml_dump(s, safe=False, **kwargs)
 
 
 def yaml_list_dict(l):
@@ -131,6 +313,93 @@ def deep_merge(user, default):
     return copy.deepcopy(user)
 
 
+class LayeredConfig(MutableMapping):
+    '''Read-through view over config layers, highest precedence first
+
+    Lookups follow deep_merge semantics without copying the layers: the
+    first layer holding a key wins, and dict values are merged with the
+    dict values below them. Writes go to a private overrides layer so
+    shared sources such as FLAVORS and VERSIONS are never modified.
+    '''
+    def __init__(self, layers=None, parent=None, key=None):
+        self._layers = layers if layers is not None else []
+        self._overrides = {}
+        self._parent = parent
+        self._key = key
+
+    def push(self, layer, top=False):
+        if top:
+            self._layers.insert(0, layer)
+        else:
+            self._layers.append(layer)
+
+    def _path(self):
+        path, view = [], self
+        while view._parent is not None:
+            path.insert(0, view._key)
+            view = view._parent
+        return view, path
+
+    def _sources(self):
+        root, path = self._path()
+        sources = [s for s in [root._overrides] + root._layers
+                   if isinstance(s, Mapping)]
+        for k in path:
+            sources = [s[k] for s in sources
+                       if isinstance(s, Mapping) and k in s]
+            sources = [s for s in sources if isinstance(s, Mapping)]
+        return sources
+
+    def __getitem__(self, key):
+        for source in self._sources():
+            if key in source:
+                value = source[key]
+                if isinstance(value, Mapping):
+                    return LayeredConfig(parent=self, key=key)
+                return value
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        root, path = self._path()
+        target = root._overrides
+        for k in path:
+            if not isinstance(target.get(k), dict):
+                target[k] = {}
+            target = target[k]
+        target[key] = value
+
+    def __delitem__(self, key):
+        raise TypeError("config layers are read-only")
+
+    def __iter__(self):
+        sources = self._sources()
+        seen = set()
+        for source in sources[1:] + sources[:1]:
+            for k in source:
+                if k not in seen:
+                    seen.add(k)
+                    yield k
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(self.materialize())
+
+    def materialize(self):
+        # Build the merged plain dict once; values are copied so the
+        # result can be modified freely
+        ret = {}
+        for k in self:
+            v = self[k]
+            if isinstance(v, LayeredConfig):
+                v = v.materialize()
+            else:
+                v = copy.deepcopy(v)
+            ret[k] = v
+        return ret
+
+
 def config_default():
     # Default values for configuration
     default_config = {
@@ -244,26 +513,58 @@ def config_default():
         },
         "multus": {
             "disable": True,
-        }
+        },
+        "allocator": {
+            "vlan_pool": {
+                "start": 2,
+                "end": 4094,
+            },
+            "vlan_range_size": 100,
+            "subnet_pool": None,
+            "subnet_prefix": 24,
+        },
     }
     return default_config
 
 
-def config_user(config_file):
+def split_documents(data):
+    # Text of each document of a YAML stream
+    starts = [m.start() for m in re.finditer(r"^---(?=\s|$)", data, re.M) if m.start() > 0]
+    bounds = [0] + starts + [len(data)]
+    return [data[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+def read_config_input(config_file):
+    """Read the input file, or STDIN for "-", once
+
+    Returns a (text, config) pair for each YAML document in it.
+    """
+    if config_file == "-":
+        data = sys.stdin.read()
+    else:
+        with open(config_file, 'r') as file:
+            data = file.read()
+    documents = []
+    for text in split_documents(data):
+        config = yaml.load(text, Loader=YamlLoader)
+        if config is not None:
+            documents.append((text, config))
+    return documents or [(data, None)]
+
+
+def config_user(config_file, document=None):
     config = {}
     if config_file:
         if config_file == "-":
             info("Loading configuration from \"STDIN\"")
-            data = sys.stdin.read()
-            config = yaml.safe_load(data)
         else:
             info("Loading configuration from \"%s\"" % config_file)
-            with open(config_file, 'r') as file:
-                config = yaml.safe_load(file)
-            with open(config_file, 'r') as file:
-                data = file.read()
-        user_input = re.sub('password:.*', '', data)
-        config["user_input"] = user_input
+        if document is None:
+            document = read_config_input(config_file)[0]
+        data, config = document
+        if isinstance(config, dict):
+            user_input = re.sub('password:.*', '', data)
+            config["user_input"] = user_input
     if config is None:
         config = {}
     return config
@@ -692,6 +993,35 @@ def is_valid_contract_scope(xval):
     raise(Exception("Must be one of the contract scopes in this List: ", validVersions))
 
 
+def is_valid_vlan(xval):
+    if xval is None:
+        return True
+    try:
+        if not isinstance(xval, bool) and 1 <= int(xval) <= 4094:
+            return True
+    except (TypeError, ValueError):
+        pass
+    raise(Exception("Must be a VLAN id between 1 and 4094"))
+
+
+def is_valid_cidr(xval):
+    if xval is None:
+        return True
+    try:
+        xval = "%s" % (xval,)
+        if "/" in xval and ipaddress.ip_network(xval, strict=False):
+            return True
+    except ValueError:
+        pass
+    raise(Exception("Invalid subnet: %s; Expected address/prefix" % (xval,)))
+
+
+def is_valid_list(xval):
+    if xval is None or isinstance(xval, list):
+        return True
+    raise(Exception("Must be a list"))
+
+
 def isOverlay(flavor):
     flav = SafeDict(FLAVORS[flavor])
     ovl = flav["overlay"]
@@ -701,156 +1031,316 @@ def isOverlay(flavor):
     return False
 
 
-def config_validate(flavor_opts, config):
-    def Raise(exception):
-        raise exception
-
-    required = lambda x: True if x else Raise(Exception("Missing option"))
-    lower_in = lambda y: (
-        lambda x: (
-            (True if str(x).lower() in y
-             else Raise(Exception("Invalid value: %s; "
-                                  "Expected one of: {%s}" %
-                                  (x, ','.join(y)))))))
-    isname = lambda x, l: (1 < len(x) < l) and \
-        x[0].isalpha() and x.replace('_', '').isalnum() \
-        if x else Raise(Exception("Invalid name"))
-    get = lambda t: functools.reduce(lambda x, y: x and x.get(y), t, config)
-
-    checks = {
-        # ACI config
-        "aci_config/system_id": (get(("aci_config", "system_id")),
-                                 lambda x: required(x) and isname(x, 32)),
-        "aci_config/apic_refreshtime": (get(("aci_config", "apic_refreshtime")),
-                                        is_valid_refreshtime),
-        "aci_config/apic_host": (get(("aci_config", "apic_hosts")), required),
-        "aci_config/vrf/name": (get(("aci_config", "vrf", "name")), required),
-        "aci_config/vrf/tenant": (get(("aci_config", "vrf", "tenant")),
-                                  required),
-        # Istio config
-        "istio_config/install_profile": (get(("istio_config", "install_profile")),
-                                         is_valid_istio_install_profile),
-        "kube_config/image_pull_policy": (get(("kube_config", "image_pull_policy")),
-                                          is_valid_image_pull_policy),
-        # Network Config
-        "net_config/pod_subnet": (get(("net_config", "pod_subnet")),
-                                  required),
-        "net_config/node_subnet": (get(("net_config", "node_subnet")),
-                                   required),
-    }
+def _raise(exception):
+    raise exception
 
-    if isOverlay(config["flavor"]):
-        extra_checks = {
-            "aci_config/vrf/region": (get(("aci_config", "vrf", "region")), required),
-        }
-    else:
-        extra_checks = {
-            "aci_config/aep": (get(("aci_config", "aep")), required),
-            "aci_config/l3out/name": (get(("aci_config", "l3out", "name")),
-                                      required),
-            "aci_config/l3out/external-networks":
-            (get(("aci_config", "l3out", "external_networks")), required),
-
-            # Kubernetes config
-            "kube_config/max_nodes_svc_graph": (get(("kube_config", "max_nodes_svc_graph")),
-                                                is_valid_max_nodes_svc_graph),
-
-            "kube_config/snat_operator/contract_scope": (get(("kube_config", "snat_operator", "contract_scope")),
-                                                         is_valid_contract_scope),
-
-            # Network Config
-            "net_config/infra_vlan": (get(("net_config", "infra_vlan")),
-                                      required),
-            "net_config/service_vlan": (get(("net_config", "service_vlan")),
-                                        required),
-            "net_config/extern_dynamic": (get(("net_config", "extern_dynamic")),
-                                          required),
-            "net_config/extern_static": (get(("net_config", "extern_static")),
-                                         required),
-            "net_config/node_svc_subnet": (get(("net_config", "node_svc_subnet")),
-                                           required),
-            "net_config/interface_mtu": (get(("net_config", "interface_mtu")),
-                                         is_valid_mtu),
-            "net_config/service_monitor_interval": (get(("net_config", "service_monitor_interval")),
-                                                    is_valid_ipsla_interval)
-        }
 
-        if (config["aci_config"]["vmm_domain"]["type"] == "OpenShift"):
-            del extra_checks["net_config/extern_static"]
-
-        if flavor_opts.get("apic", {}).get("use_kubeapi_vlan", True):
-            checks["net_config/kubeapi_vlan"] = (
-                get(("net_config", "kubeapi_vlan")), required)
-
-    # Allow deletion of resources without isname check
-    if get(("provision", "prov_apic")) is False:
-        checks["aci_config/system_id"] = \
-            (get(("aci_config", "system_id")), required)
-
-    # Versions
-    for field in flavor_opts.get('version_fields', VERSION_FIELDS):
-        checks[field] = (get(("registry", field)), required)
-
-    if flavor_opts.get("apic", {}).get("associate_aep_to_nested_inside_domain",
-                                       False):
-        checks["aci_config/vmm_domain/nested_inside/type"] = (
-            get(("aci_config", "vmm_domain", "nested_inside", "type")),
-            required)
-
-    if get(("aci_config", "vmm_domain", "encap_type")) == "vlan":
-        checks["aci_config/vmm_domain/vlan_range/start"] = \
-            (get(("aci_config", "vmm_domain", "vlan_range", "start")),
-             required)
-        checks["aci_config/vmm_domain/vlan_range/end"] = \
-            (get(("aci_config", "vmm_domain", "vlan_range", "end")),
-             required)
-
-    if get(("aci_config", "vmm_domain", "nested_inside", "type")):
-        checks["aci_config/vmm_domain/nested_inside/type"] = \
-            (get(("aci_config", "vmm_domain", "nested_inside", "type")),
-             lower_in({"vmware"}))
-        checks["aci_config/vmm_domain/nested_inside/name"] = \
-            (get(("aci_config", "vmm_domain", "nested_inside", "name")),
-             required)
-
-    if get(("aci_config", "vmm_domain", "nested_inside", "duplicate_file_router_default_svc")):
-        checks["aci_config/vmm_domain/nested_inside/installer_provisioned_lb_ip"] = \
-            (get(("aci_config", "vmm_domain", "nested_inside", "installer_provisioned_lb_ip")),
-             required)
-
-    if get(("provision", "prov_apic")) is not None:
-        checks.update({
-            # auth for API access
-            "aci_config/apic_login/username":
-            (get(("aci_config", "apic_login", "username")), required),
-            "aci_config/apic_login/password":
-            (get(("aci_config", "apic_login", "password")), required),
-        })
+def is_required(xval):
+    return True if xval else _raise(Exception("Missing option"))
 
-    if flavor_opts.get('vip_pool_required', False):
-        checks["net_config/vip_subnet"] = (
-            get(("net_config", "vip_subnet")), required)
-
-    iso_seg_check = (
-        lambda x: True
-        if all(('name' in iso and 'subnet' in iso) for iso in x)
-        else Raise(
-            Exception("'name' and 'subnet' required for "
-                      "each isolation segment")))
-    iso_seg = get(("aci_config", "isolation_segments"))
-    if iso_seg:
-        checks["aci_config/isolation_segments"] = (iso_seg, iso_seg_check)
-
-    checks = deep_merge(checks, extra_checks)
-    ret = True
-    for k in sorted(checks.keys()):
-        value, validator = checks[k]
+
+def is_valid_system_id(xval):
+    if not is_required(xval):
+        return False
+    if 1 < len(xval) < 32 and xval[0].isalpha() and xval.replace('_', '').isalnum():
+        return True
+    raise(Exception("Invalid name"))
+
+
+def is_valid_nested_inside_type(xval):
+    if str(xval).lower() in {"vmware"}:
+        return True
+    raise(Exception("Invalid value: %s; Expected one of: {vmware}" % (xval,)))
+
+
+def is_valid_isolation_segments(xval):
+    if all(('name' in iso and 'subnet' in iso) for iso in xval):
+        return True
+    raise(Exception("'name' and 'subnet' required for each isolation segment"))
+
+
+def is_bool(xval):
+    if xval is None or isinstance(xval, bool):
+        return True
+    raise(Exception("Must be true or false"))
+
+
+def is_string(xval):
+    if xval is None or isinstance(xval, str):
+        return True
+    raise(Exception("Must be a string"))
+
+
+def is_valid_ip(xval):
+    if xval is None:
+        return True
+    try:
+        if ipaddress.ip_address("%s" % (xval,)):
+            return True
+    except ValueError:
+        pass
+    raise(Exception("Must be an IP address"))
+
+
+def is_int_between(xmin, xmax):
+    def check(xval):
+        if xval is None:
+            return True
         try:
-            if not validator(value):
-                raise Exception(k)
-        except Exception as e:
-            err("Invalid configuration for %s: %s" % (k, e))
-            ret = False
+            if not isinstance(xval, bool) and xmin <= int(xval) <= xmax:
+                return True
+        except (TypeError, ValueError):
+            pass
+        raise(Exception("Must be an integer between %s and %s" % (xmin, xmax)))
+    return check
+
+
+def is_one_of(*values):
+    def check(xval):
+        if xval is None or xval in values:
+            return True
+        raise(Exception("Invalid value: %s; Expected one of: {%s}" % (xval, ", ".join(values))))
+    return check
+
+
+def all_of(*validators):
+    return lambda x: all(validator(x) for validator in validators)
+
+
+config_getters = {}
+
+
+def config_getter(path):
+    if path in config_getters:
+        return config_getters[path]
+    keys = tuple(path.split("/"))
+
+    def get(config):
+        for k in keys:
+            if not isinstance(config, Mapping):
+                return None
+            config = config.get(k)
+        return config
+    config_getters[path] = get
+    return get
+
+
+def condition_holds(condition, flavor_opts, get):
+    """Evaluate a schema condition
+
+    A condition is a list of conditions that must all hold, or a dict:
+    {"overlay": bool} tests the flavor, {"flavor_option": "a/b",
+    "default": value} tests a flavor option, and {"path": "a/b"} tests a
+    config value, for "is", "is_not" or "equals" a given value if one of
+    those keys is present, else for being set.
+    """
+    if condition is None:
+        return True
+    if isinstance(condition, list):
+        return all(condition_holds(c, flavor_opts, get) for c in condition)
+    if "overlay" in condition:
+        return isOverlay(get("flavor")) == condition["overlay"]
+    if "flavor_option" in condition:
+        value = flavor_opts
+        keys = condition["flavor_option"].split("/")
+        for k in keys[:-1]:
+            value = value.get(k) or {}
+        return bool(value.get(keys[-1], condition.get("default")))
+    value = get(condition["path"])
+    if "is" in condition:
+        return value is condition["is"]
+    if "is_not" in condition:
+        return value is not condition["is_not"]
+    if "equals" in condition:
+        return value == condition["equals"]
+    return bool(value)
+
+
+OVERLAY = {"overlay": True}
+UNDERLAY = {"overlay": False}
+VLAN_ENCAP = {"path": "aci_config/vmm_domain/encap_type", "equals": "vlan"}
+PROV_APIC = {"path": "provision/prov_apic", "is_not": None}
+NESTED_INSIDE = {"path": "aci_config/vmm_domain/nested_inside/type"}
+
+# Validation schema: (key, path, validator, condition), conditions are
+# data, see condition_holds. Rules are compiled once; for each key the
+# first rule whose condition holds is applied. Options without a rule
+# are not checked, including unknown keys: the accepted keys vary with
+# the flavor and the templates.
+CONFIG_SCHEMA = [
+    # ACI config
+    ("aci_config/system_id", "aci_config/system_id", is_required, {"path": "provision/prov_apic", "is": False}),
+    ("aci_config/system_id", "aci_config/system_id", is_valid_system_id, None),
+    ("aci_config/apic_refreshtime", "aci_config/apic_refreshtime", is_valid_refreshtime, None),
+    ("aci_config/apic_host", "aci_config/apic_hosts", all_of(is_required, is_valid_list), None),
+    ("aci_config/vrf/name", "aci_config/vrf/name", is_required, None),
+    ("aci_config/vrf/tenant", "aci_config/vrf/tenant", is_required, None),
+    ("aci_config/vrf/region", "aci_config/vrf/region", is_required, OVERLAY),
+    ("aci_config/aep", "aci_config/aep", is_required, UNDERLAY),
+    ("aci_config/l3out/name", "aci_config/l3out/name", is_required, UNDERLAY),
+    ("aci_config/l3out/external-networks", "aci_config/l3out/external_networks",
+     all_of(is_required, is_valid_list), UNDERLAY),
+    ("aci_config/apic_login/username", "aci_config/apic_login/username", is_required, PROV_APIC),
+    ("aci_config/apic_login/password", "aci_config/apic_login/password", is_required, PROV_APIC),
+    ("aci_config/vmm_domain/encap_type", "aci_config/vmm_domain/encap_type", is_one_of("vlan", "vxlan"), None),
+    ("aci_config/vmm_domain/type", "aci_config/vmm_domain/type", is_string, None),
+    ("aci_config/vmm_domain/mcast_fabric", "aci_config/vmm_domain/mcast_fabric", is_valid_ip, None),
+    ("aci_config/vmm_domain/mcast_range/start", "aci_config/vmm_domain/mcast_range/start", is_valid_ip, None),
+    ("aci_config/vmm_domain/mcast_range/end", "aci_config/vmm_domain/mcast_range/end", is_valid_ip, None),
+    ("aci_config/vmm_domain/vlan_range/start", "aci_config/vmm_domain/vlan_range/start",
+     all_of(is_required, is_valid_vlan), VLAN_ENCAP),
+    ("aci_config/vmm_domain/vlan_range/end", "aci_config/vmm_domain/vlan_range/end",
+     all_of(is_required, is_valid_vlan), VLAN_ENCAP),
+    ("aci_config/vmm_domain/nested_inside/type", "aci_config/vmm_domain/nested_inside/type",
+     is_valid_nested_inside_type, NESTED_INSIDE),
+    ("aci_config/vmm_domain/nested_inside/type", "aci_config/vmm_domain/nested_inside/type",
+     is_required, {"flavor_option": "apic/associate_aep_to_nested_inside_domain", "default": False}),
+    ("aci_config/vmm_domain/nested_inside/name", "aci_config/vmm_domain/nested_inside/name", is_required,
+     NESTED_INSIDE),
+    ("aci_config/vmm_domain/nested_inside/installer_provisioned_lb_ip",
+     "aci_config/vmm_domain/nested_inside/installer_provisioned_lb_ip", is_required,
+     {"path": "aci_config/vmm_domain/nested_inside/duplicate_file_router_default_svc"}),
+    ("aci_config/vmm_domain/nested_inside/duplicate_file_router_default_svc",
+     "aci_config/vmm_domain/nested_inside/duplicate_file_router_default_svc", is_bool, None),
+    ("aci_config/isolation_segments", "aci_config/isolation_segments",
+     all_of(is_valid_list, is_valid_isolation_segments), {"path": "aci_config/isolation_segments"}),
+    ("aci_config/use_pre_existing_tenant", "aci_config/use_pre_existing_tenant", is_bool, None),
+    ("aci_config/use_legacy_kube_naming_convention", "aci_config/use_legacy_kube_naming_convention",
+     is_bool, None),
+    ("aci_config/client_cert", "aci_config/client_cert", is_bool, None),
+    ("aci_config/client_ssl", "aci_config/client_ssl", is_bool, None),
+    ("aci_config/kube_default_provide_kube_api", "aci_config/kube_default_provide_kube_api", is_bool, None),
+    ("aci_config/disable_node_subnet_creation", "aci_config/disable_node_subnet_creation", is_bool, None),
+    # Istio config
+    ("istio_config/install_profile", "istio_config/install_profile", is_valid_istio_install_profile, None),
+    # Kubernetes config
+    ("kube_config/image_pull_policy", "kube_config/image_pull_policy", is_valid_image_pull_policy, None),
+    ("kube_config/max_nodes_svc_graph", "kube_config/max_nodes_svc_graph", is_valid_max_nodes_svc_graph, UNDERLAY),
+    ("kube_config/snat_operator/contract_scope", "kube_config/snat_operator/contract_scope",
+     is_valid_contract_scope, UNDERLAY),
+    ("kube_config/snat_operator/port_range/start", "kube_config/snat_operator/port_range/start",
+     is_int_between(1, 65535), None),
+    ("kube_config/snat_operator/port_range/end", "kube_config/snat_operator/port_range/end",
+     is_int_between(1, 65535), None),
+    ("kube_config/snat_operator/port_range/ports_per_node", "kube_config/snat_operator/port_range/ports_per_node",
+     is_int_between(1, 65535), None),
+    ("kube_config/kubectl", "kube_config/kubectl", is_string, None),
+    ("kube_config/system_namespace", "kube_config/system_namespace", is_string, None),
+    ("kube_config/controller", "kube_config/controller", is_valid_ip, None),
+    ("kube_config/host_agent_openshift_resource", "kube_config/host_agent_openshift_resource", is_bool, None),
+    ("kube_config/use_netpol_annotation", "kube_config/use_netpol_annotation", is_bool, None),
+    ("kube_config/use_cluster_role", "kube_config/use_cluster_role", is_bool, None),
+    ("kube_config/generate_installer_files", "kube_config/generate_installer_files", is_bool, None),
+    ("kube_config/generate_cnet_file", "kube_config/generate_cnet_file", is_bool, None),
+    ("kube_config/generate_apic_file", "kube_config/generate_apic_file", is_bool, None),
+    ("kube_config/use_host_netns_volume", "kube_config/use_host_netns_volume", is_bool, None),
+    ("kube_config/enable_endpointslice", "kube_config/enable_endpointslice", is_bool, None),
+    # Network Config
+    ("net_config/pod_subnet", "net_config/pod_subnet", all_of(is_required, is_valid_cidr), None),
+    ("net_config/node_subnet", "net_config/node_subnet", all_of(is_required, is_valid_cidr), None),
+    ("net_config/infra_vlan", "net_config/infra_vlan", all_of(is_required, is_valid_vlan), UNDERLAY),
+    ("net_config/service_vlan", "net_config/service_vlan", all_of(is_required, is_valid_vlan), UNDERLAY),
+    ("net_config/kubeapi_vlan", "net_config/kubeapi_vlan", all_of(is_required, is_valid_vlan),
+     [UNDERLAY, {"flavor_option": "apic/use_kubeapi_vlan", "default": True}]),
+    ("net_config/extern_dynamic", "net_config/extern_dynamic", all_of(is_required, is_valid_cidr), UNDERLAY),
+    # OpenShift flavors don't need extern_static
+    ("net_config/extern_static", "net_config/extern_static", is_valid_cidr,
+     {"path": "aci_config/vmm_domain/type", "equals": "OpenShift"}),
+    ("net_config/extern_static", "net_config/extern_static", all_of(is_required, is_valid_cidr), UNDERLAY),
+    ("net_config/node_svc_subnet", "net_config/node_svc_subnet", all_of(is_required, is_valid_cidr), UNDERLAY),
+    ("net_config/interface_mtu", "net_config/interface_mtu", is_valid_mtu, UNDERLAY),
+    ("net_config/service_monitor_interval", "net_config/service_monitor_interval",
+     is_valid_ipsla_interval, UNDERLAY),
+    ("net_config/pod_subnet_chunk_size", "net_config/pod_subnet_chunk_size", is_int_between(1, 65536), None),
+    ("net_config/pbr_tracking_non_snat", "net_config/pbr_tracking_non_snat", is_bool, None),
+    ("net_config/second_kubeapi_portgroup", "net_config/second_kubeapi_portgroup", is_bool, None),
+    ("net_config/vip_subnet", "net_config/vip_subnet", all_of(is_required, is_valid_cidr),
+     {"flavor_option": "vip_pool_required", "default": False}),
+    ("net_config/vip_subnet", "net_config/vip_subnet", is_valid_cidr, None),
+]
+
+
+def compile_schema(schema):
+    rules = collections.OrderedDict()
+    for key, path, validator, condition in schema:
+        rules.setdefault(key, []).append((config_getter(path), validator, condition))
+    return sorted(rules.items())
+
+
+COMPILED_SCHEMA = compile_schema(CONFIG_SCHEMA)
+version_schemas = {}
+
+
+def config_errors(flavor_opts, config):
+    fields = tuple(flavor_opts.get('version_fields', VERSION_FIELDS))
+    if fields not in version_schemas:
+        version_schemas[fields] = sorted(
+            COMPILED_SCHEMA + compile_schema(
+                [(field, "registry/" + field, is_required, None)
+                 for field in fields]), key=lambda rule: rule[0])
+
+    get = lambda path: config_getter(path)(config)
+    errors = []
+    for key, rules in version_schemas[fields]:
+        for getter, validator, condition in rules:
+            if not condition_holds(condition, flavor_opts, get):
+                continue
+            try:
+                if not validator(getter(config)):
+                    raise Exception(key)
+            except Exception as e:
+                errors.append((key, e))
+            break
+    return errors
+
+
+def config_validate(flavor_opts, config):
+    errors = config_errors(flavor_opts, config)
+    for key, e in errors:
+        err("Invalid configuration for %s: %s" % (key, e))
+    return not errors
+
+
+def apic_preflight(config, apic):
+    """Return warnings for the APIC resources config refers to but are missing"""
+    ret = []
+    aep_name = config["aci_config"]["aep"]
+    aep = apic.get_aep(aep_name)
+    if aep is None:
+        ret.append("AEP not defined in the APIC: %s" % aep_name)
+
+    vrf_tenant = config["aci_config"]["vrf"]["tenant"]
+    vrf_name = config["aci_config"]["vrf"]["name"]
+    vrf_dn = config["aci_config"]["vrf"]["dn"]
+    l3out_name = config["aci_config"]["l3out"]["name"]
+    vrf = apic.get_vrf(vrf_dn)
+    if vrf is None:
+        ret.append("VRF not defined in the APIC: %s/%s" %
+                   (vrf_tenant, vrf_name))
+    l3out = apic.get_l3out(vrf_tenant, l3out_name)
+    if l3out is None:
+        ret.append("L3out not defined in the APIC: %s/%s" %
+                   (vrf_tenant, l3out_name))
+    else:
+        # get l3out context and check if it's the same as vrf in
+        # input config
+        result = apic.check_l3out_vrf(vrf_tenant, l3out_name, vrf_name, vrf_dn)
+        if not result:
+            info("L3out and Kubernetes EPGs are configured in different VRFs")
+
+    # Following code is to detect a legacy cluster
+    # kube_ap = apic.get_ap(config["aci_config"]["system_id"])
+    # if an app profile with the name "kubernetes" exists under system
+    # tenant, this means the cluster was provisioned with older
+    # naming convention. This is a fallback in case the user
+    # forgets to add the field to indicate an existing legacy
+    # cluster.
+    # if kube_ap:
+    #     config["aci_config"]["use_legacy_kube_naming_convention"] = True
+    #     if config["aci_config"]["vmm_domain"]["type"] == "OpenShift":
+    #         config["kube_config"]["system_namespace"] = "aci-containers-system"
+    #     else:
+    #         config["kube_config"]["system_namespace"] = "kube-system"
     return ret
 
 
@@ -863,44 +1353,8 @@ def config_validate_preexisting(config, prov_apic):
             apic = get_apic(config)
             if apic is None:
                 return False
-
-            aep_name = config["aci_config"]["aep"]
-            aep = apic.get_aep(aep_name)
-            if aep is None:
-                warn("AEP not defined in the APIC: %s" % aep_name)
-
-            vrf_tenant = config["aci_config"]["vrf"]["tenant"]
-            vrf_name = config["aci_config"]["vrf"]["name"]
-            vrf_dn = config["aci_config"]["vrf"]["dn"]
-            l3out_name = config["aci_config"]["l3out"]["name"]
-            vrf = apic.get_vrf(vrf_dn)
-            if vrf is None:
-                warn("VRF not defined in the APIC: %s/%s" %
-                     (vrf_tenant, vrf_name))
-            l3out = apic.get_l3out(vrf_tenant, l3out_name)
-            if l3out is None:
-                warn("L3out not defined in the APIC: %s/%s" %
-                     (vrf_tenant, l3out_name))
-            else:
-                # get l3out context and check if it's the same as vrf in
-                # input config
-                result = apic.check_l3out_vrf(vrf_tenant, l3out_name, vrf_name, vrf_dn)
-                if not result:
-                    info("L3out and Kubernetes EPGs are configured in different VRFs")
-
-            # Following code is to detect a legacy cluster
-            # kube_ap = apic.get_ap(config["aci_config"]["system_id"])
-            # if an app profile with the name "kubernetes" exists under system
-            # tenant, this means the cluster was provisioned with older
-            # naming convention. This is a fallback in case the user
-            # forgets to add the field to indicate an existing legacy
-            # cluster.
-            # if kube_ap:
-            #     config["aci_config"]["use_legacy_kube_naming_convention"] = True
-            #     if config["aci_config"]["vmm_domain"]["type"] == "OpenShift":
-            #         config["kube_config"]["system_namespace"] = "aci-containers-system"
-            #     else:
-            #         config["kube_config"]["system_namespace"] = "kube-system"
+            for msg in apic_preflight(config, apic):
+                warn(msg)
 
     except Exception as e:
         warn("Unable to validate resources on APIC: {}".format(e))
@@ -932,6 +1386,7 @@ def generate_password(no_random):
 
 
 def generate_cert(username, cert_file, key_file):
+    from OpenSSL import crypto
     reused = False
     if not exists(cert_file) or not exists(key_file):
         info("Generating certs for kubernetes controller")
@@ -982,43 +1437,140 @@ def generate_cert(username, cert_file, key_file):
     return key_data, cert_data, reused
 
 
-def get_jinja_template(file):
+def make_jinja_env(loader, bytecode_cache=None):
+    from jinja2 import Environment
     env = Environment(
-        loader=PackageLoader('acc_provision', 'templates'),
+        loader=loader,
+        bytecode_cache=bytecode_cache,
         trim_blocks=True,
         lstrip_blocks=True,
         keep_trailing_newline=True
     )
     env.filters['base64enc'] = lambda s: base64.b64encode(s).decode("ascii")
-    env.filters['cf_secret'] = lambda s: yaml.safe_dump(s.decode("ascii"), default_style='|')
+    env.filters['cf_secret'] = lambda s: yaml_dump(s.decode("ascii"), default_style='|')
     env.filters['json'] = json_indent
     env.filters['yaml'] = yaml_indent
     env.filters['yaml_quote'] = yaml_quote
     env.filters['yaml_list_dict'] = yaml_list_dict
     env.filters['list_unicode_strings'] = list_unicode_strings
-    template = env.get_template(file)
-    return template
+    return env
 
 
-def generate_operator_tar(tar_path, cont_docs, config):
+def templates_manifest():
+    """Jinja version and template hashes the compiled templates are valid for"""
+    import jinja2
+    templates = {}
+    for f in sorted(os.listdir(TEMPLATES_PATH)):
+        if f.endswith(TEMPLATE_EXTENSIONS):
+            with open(os.path.join(TEMPLATES_PATH, f), 'rb') as fh:
+                templates[f] = hashlib.sha256(fh.read()).hexdigest()
+    return {"jinja2": jinja2.__version__, "templates": templates}
+
+
+def compiled_templates_fresh(path=None):
+    # The modules use Jinja internals, they are only used with the Jinja
+    # version that built them and if no template changed since
+    try:
+        with open(os.path.join(path or COMPILED_TEMPLATES_PATH, COMPILED_TEMPLATES_MANIFEST), 'r') as f:
+            return json.load(f) == templates_manifest()
+    except (IOError, OSError, ValueError):
+        return False
+
+
+def compile_templates(target=None):
+    """Precompile the templates into Python modules, run at package build time"""
+    from jinja2 import FileSystemLoader
+    target = target or COMPILED_TEMPLATES_PATH
+    manifest_path = os.path.join(target, COMPILED_TEMPLATES_MANIFEST)
+    if os.path.exists(manifest_path):
+        os.unlink(manifest_path)
+    env = make_jinja_env(FileSystemLoader(TEMPLATES_PATH))
+    env.compile_templates(target, extensions=TEMPLATE_EXTENSIONS, zip=None, ignore_errors=False)
+    # Written last, an interrupted build leaves the modules unused
+    with open(manifest_path, 'w') as f:
+        json.dump(templates_manifest(), f, indent=4, sort_keys=True)
+
+
+jinja_env = None
+
+
+def get_jinja_env():
+    """Return the Jinja environment shared by all the templates
+
+    Templates come from the modules precompiled by compile_templates when
+    they are up to date, otherwise they are compiled through a bytecode
+    cache in the cache directory.
+    """
+    global jinja_env
+    if jinja_env is None:
+        from jinja2 import ChoiceLoader, FileSystemBytecodeCache, FileSystemLoader, ModuleLoader
+        loader = FileSystemLoader(TEMPLATES_PATH)
+        if compiled_templates_fresh():
+            loader = ChoiceLoader([ModuleLoader(COMPILED_TEMPLATES_PATH), loader])
+        bytecode_cache = None
+        cache_dir = get_cache_dir()
+        if cache_dir:
+            cache_dir = os.path.join(cache_dir, "jinja-py%d%d" % sys.version_info[:2])
+            try:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir, 0o700)
+                if cache_path_private(cache_dir):
+                    bytecode_cache = FileSystemBytecodeCache(cache_dir)
+                else:
+                    warn("Not caching templates in %s: writable by other users" % cache_dir)
+            except OSError as e:
+                warn("Not caching templates in %s: %s" % (cache_dir, e))
+        jinja_env = make_jinja_env(loader, bytecode_cache)
+    return jinja_env
+
+
+def get_jinja_template(file):
+    return get_jinja_env().get_template(file)
+
+
+def render_template(file, config):
+    if regen_state is None:
+        return get_jinja_template(file).render(config=config)
+    return regen_state.cached(json.dumps(["kube", file]), config,
+                              lambda tracked: get_jinja_template(file).render(config=tracked))
+
+
+KubeDocument = collections.namedtuple("KubeDocument", ["kind", "name", "text", "data"])
+
+
+def kube_documents(text):
+    """Parse rendered manifests once into a KubeDocument per YAML document
+
+    Joining the documents' text with "---" gives back text.
+    """
+    docs = []
+    for part in re.split(r"(?m)^---(?=\s|$)", text):
+        data = yaml.load(part, Loader=YamlLoader)
+        kind, name = None, None
+        if isinstance(data, dict):
+            kind = data.get("kind")
+            name = (data.get("metadata") or {}).get("name")
+        docs.append(KubeDocument(kind, name, part, data))
+    return docs
 
-    # YAML file numbers generated start from 4 as first three are
-    # reserved for OpenShift specific files
-    file_start = 4
-    filenames = []
 
-    # Function to construct filenames for each yaml
-    def gen_file_list(docs, counter, filenames):
-        for doc in docs:
-            filename = "cluster-network-" + str(counter).zfill(2) + "-" + doc['kind'] + "-" + doc['metadata']['name'] + ".yaml"
-            filenames.append(os.path.basename(filename))
-            with open(filename, 'w') as outfile:
-                yaml.safe_dump(doc, outfile, default_flow_style=False, encoding="utf-8")
-            counter += 1
-        return counter
+def tar_mtime():
+    # Fixed, so the same input gives the same tar
+    try:
+        return int(os.environ.get("SOURCE_DATE_EPOCH", 0))
+    except ValueError:
+        return 0
+
 
-    gen_file_list(cont_docs, file_start, filenames)
+def write_documents(path, documents):
+    with open(path, "w") as fh:
+        for i, doc in enumerate(documents):
+            if i:
+                fh.write("---")
+            fh.write(doc.text)
 
+
+def operator_tar_extra_files(config):
     # Create three extra files needed for Openshift 4.3 installer
     extra_files = []
     gen_inst_files = config["kube_config"]["generate_installer_files"]
@@ -1037,18 +1589,51 @@ def generate_operator_tar(tar_path, cont_docs, config):
     if gen_apic_file:
         apic_name = 'apic.json'
         extra_files.append(apic_name)
+    return extra_files
 
-    for x_file in extra_files:
-        x_template = get_jinja_template(x_file)
-        x_template.stream(config=config).dump(x_file)
-        filenames.append(x_file)
 
-    # Create tar for the parsed files and delete the files too
-    tar = tarfile.open(tar_path, "w:gz", encoding="utf-8")
-    for name in filenames:
-        tar.add(name)
-        os.remove(name)
-    tar.close()
+def generate_operator_tar(tar_path, cont_docs, config, extra_files=None):
+    """Write the operator tar of cont_docs to tar_path
+
+    extra_files are the (name, text) of the OpenShift installer files,
+    rendered here if not given. The tar is streamed straight to tar_path,
+    nothing is written to the current directory.
+    """
+    import gzip
+
+    # YAML file numbers generated start from 4 as first three are
+    # reserved for OpenShift specific files
+    file_start = 4
+
+    if extra_files is None:
+        extra_files = [(x_file, get_jinja_template(x_file).render(config=config))
+                       for x_file in operator_tar_extra_files(config)]
+
+    mtime = tar_mtime()
+    compresslevel = config["provision"].get("tar_compression_level", 9)
+    with open(tar_path, "wb") as fileobj:
+        with gzip.GzipFile(filename="", mode="wb", fileobj=fileobj, compresslevel=compresslevel, mtime=mtime) as gz:
+            tar = tarfile.open(fileobj=gz, mode="w", encoding="utf-8")
+
+            def add_file(name, data):
+                tarinfo = tarfile.TarInfo(name)
+                tarinfo.size = len(data)
+                tarinfo.mtime = mtime
+                tarinfo.mode = 0o644
+                tar.addfile(tarinfo, io.BytesIO(data))
+
+            # A file for each yaml
+            counter = file_start
+            for doc in cont_docs:
+                if doc.data is None:
+                    continue
+                filename = "cluster-network-" + str(counter).zfill(2) + "-" + doc.kind + "-" + doc.name + ".yaml"
+                add_file(filename, yaml_dump(doc.data, default_flow_style=False, encoding="utf-8"))
+                counter += 1
+
+            for x_file, text in extra_files:
+                add_file(x_file, text.encode("utf-8"))
+            tar.close()
 
 
 def generate_rancher_yaml(config, operator_output, operator_tar, operator_cr_output):
@@ -1086,7 +1671,6 @@ def generate_kube_yaml(config, operator_output, operator_tar, operator_cr_output
         kube_objects.extend(["clusterrolebinding", "clusterrole"])
 
     if operator_output and operator_output != "/dev/null":
-        template = get_jinja_template('aci-containers.yaml')
         outname = operator_output
         applyname = operator_output
         tar_path = operator_tar
@@ -1102,56 +1686,66 @@ def generate_kube_yaml(config, operator_output, operator_tar, operator_cr_output
             if not tar_path or tar_path == "-":
                 tar_path = operator_output + ".tar.gz"
 
-        temp = ''.join(template.stream(config=config))
-        parsed_temp = temp.split("---")
+        # Every document is parsed once, the list feeds both the
+        # infrastructure YAML and the tar
+        temp = render_template('aci-containers.yaml', config)
+        documents = kube_documents(temp)
 
         # Find the place where to put the acioperators configmap
-        for cmap_idx in range(len(parsed_temp)):
-            current_yaml = yaml.safe_load(parsed_temp[cmap_idx])
-            if current_yaml['kind'] == 'ConfigMap':
-                break
+        cmap_idx = next((i for i, doc in enumerate(documents) if doc.kind == 'ConfigMap'), len(documents) - 1)
 
         # Generate and convert containers deployment to base64 and add
         # as configMap entry to the operator deployment.
         config["kube_config"]["deployment_base64"] = base64.b64encode(temp.encode('ascii')).decode('ascii')
-        oper_cmap_template = get_jinja_template('aci-operators-configmap.yaml')
-        cmap_temp = ''.join(oper_cmap_template.stream(config=config))
-
-        op_template = get_jinja_template('aci-operators.yaml')
-        output_from_parsed_template = op_template.render(config=config)
-
-        # Generate acioperator CRD from template and add it to top
-        op_crd_template = get_jinja_template('aci-operators-crd.yaml')
-        op_crd_output = op_crd_template.render(config=config)
-
-        new_parsed_yaml = [op_crd_output] + parsed_temp[:cmap_idx] + [cmap_temp] + parsed_temp[cmap_idx:] + [output_from_parsed_template]
-        new_deployment_file = '---'.join(new_parsed_yaml)
-
-        if operator_output != sys.stdout:
-            with open(operator_output, "w") as fh:
-                fh.write(new_deployment_file)
-        else:
-            op_template.stream(config=config).dump(operator_output)
-
-        # The next few files are to generate tar file with each
-        # containers and operator yaml in separate file. This is needed
-        # by OpenShift >= 4.3. If tar_path is provided(-z), we save the tar
-        # with that filename, else we use the provided containers
-        # deployment filepath. If neither is provided, we don't generate
-        # the tar.
-        if tar_path == "-":
-            tar_path = "/dev/null"
-        else:
-            deployment_docs = yaml.load_all(new_deployment_file, Loader=yaml.SafeLoader)
-            generate_operator_tar(tar_path, deployment_docs, config)
-
-        op_cr_template = get_jinja_template('aci-operators-cr.yaml')
-        if operator_cr_output and operator_cr_output != "/dev/null":
-            if operator_cr_output == "-":
-                operator_cr_output = "/dev/null"
+        del temp
+
+        # The rest only reads config, so the other templates are rendered
+        # and the outputs written concurrently. Results are collected in a
+        # fixed order, which keeps the outputs deterministic.
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(RENDER_WORKERS) as executor:
+            render = lambda name: executor.submit(render_template, name, config)
+            cmap_temp = render('aci-operators-configmap.yaml')
+            operators_temp = render('aci-operators.yaml')
+            # Generate acioperator CRD from template and add it to top
+            op_crd_temp = render('aci-operators-crd.yaml')
+            extra_files = [(x_file, executor.submit(get_jinja_template(x_file).render, config=config))
+                           for x_file in (operator_tar_extra_files(config) if tar_path != "-" else [])]
+
+            op_cr_template = get_jinja_template('aci-operators-cr.yaml')
+            if operator_cr_output and operator_cr_output != "/dev/null":
+                if operator_cr_output == "-":
+                    operator_cr_output = "/dev/null"
+                else:
+                    info("Writing kubernetes ACI operator CR to %s" % operator_cr_output)
+            op_cr = executor.submit(op_cr_template.stream(config=config).dump, operator_cr_output)
+
+            output_from_parsed_template = operators_temp.result()
+            documents = kube_documents(op_crd_temp.result()) + documents[:cmap_idx] + \
+                kube_documents(cmap_temp.result()) + documents[cmap_idx:] + \
+                kube_documents(output_from_parsed_template)
+
+            if operator_output != sys.stdout:
+                output = executor.submit(write_documents, operator_output, documents)
+            else:
+                operator_output.write(output_from_parsed_template)
+                output = None
+
+            # The next few files are to generate tar file with each
+            # containers and operator yaml in separate file. This is needed
+            # by OpenShift >= 4.3. If tar_path is provided(-z), we save the tar
+            # with that filename, else we use the provided containers
+            # deployment filepath. If neither is provided, we don't generate
+            # the tar.
+            if tar_path == "-":
+                tar_path = "/dev/null"
             else:
-                info("Writing kubernetes ACI operator CR to %s" % operator_cr_output)
-        op_cr_template.stream(config=config).dump(operator_cr_output)
+                extra_files = [(x_file, x.result()) for x_file, x in extra_files]
+                generate_operator_tar(tar_path, documents, config, extra_files)
+
+            for future in (output, op_cr):
+                if future is not None:
+                    future.result()
 
         info("Writing kubernetes infrastructure YAML to %s" % outname)
         info("Writing ACI CNI operator tar to %s" % tar_path)
@@ -1223,28 +1817,57 @@ networks:
 CfFlavorOptions['template_generator'] = generate_cf_yaml
 
 
-def generate_apic_config(flavor_opts, config, prov_apic, apic_file):
+def apic_plan(flavor_opts, config):
     configurator = ApicKubeConfig(config)
     for k, v in flavor_opts.get("apic", {}).items():
         setattr(configurator, k, v)
-    apic_config = configurator.get_config(config["aci_config"]["apic_version"])
+    configurator.state = regen_state
+    return configurator.get_config(config["aci_config"]["apic_version"])
+
+
+def generate_apic_config(flavor_opts, config, prov_apic, apic_file, apic_config=None):
+    if apic_config is None:
+        apic_config = apic_plan(flavor_opts, config)
+    plan = hashlib.sha256()
+    for path, data in apic_config:
+        plan.update(json.dumps([path, data]).encode("utf-8"))
+    config["provision"]["plan_hash"] = plan.hexdigest()
+    apicfile_format = config["provision"]["apicfile_format"]
+    meta = None
+    if apicfile_format == "ndjson":
+        # Everything --apply-plan needs besides the plan itself
+        meta = collections.OrderedDict([
+            ("apic_hosts", config["aci_config"]["apic_hosts"]),
+            ("system_id", config["aci_config"]["system_id"]),
+            ("tenant", config["aci_config"]["vrf"]["tenant"]),
+            ("vrf_tenant", config["aci_config"]["vrf"]["tenant"]),
+            ("cluster_tenant", config["aci_config"]["cluster_tenant"]),
+            ("old_naming", config["aci_config"]["use_legacy_kube_naming_convention"]),
+            ("sync_login", config["aci_config"]["sync_login"]["username"]),
+        ])
     if apic_file:
         if apic_file == "-":
             info("Writing apic configuration to \"STDOUT\"")
-            ApicKubeConfig.save_config(apic_config, sys.stdout)
+            ApicKubeConfig.save_config(apic_config, sys.stdout, apicfile_format, meta)
         else:
             info("Writing apic configuration to \"%s\"" % apic_file)
             with open(apic_file, 'w') as outfile:
-                ApicKubeConfig.save_config(apic_config, outfile)
+                ApicKubeConfig.save_config(apic_config, outfile, apicfile_format, meta)
 
     ret = True
     sync_login = config["aci_config"]["sync_login"]["username"]
+    skip_unchanged = config["provision"].get("skip_unchanged", False)
     if prov_apic is not None:
         apic = get_apic(config)
         if apic is not None:
             if prov_apic is True:
                 info("Provisioning configuration in APIC")
-                apic.provision(apic_config, sync_login)
+                if regen_state is None:
+                    apic.provision(apic_config, sync_login, skip_unchanged)
+                else:
+                    apic.provision(regen_state.unpushed(apic_config), sync_login, skip_unchanged)
+                    if apic.errors == 0:
+                        regen_state.mark_pushed(apic_config)
             if prov_apic is False:
                 info("Unprovisioning configuration in APIC")
                 system_id = config["aci_config"]["system_id"]
@@ -1253,6 +1876,8 @@ def generate_apic_config(flavor_opts, config, prov_apic, apic_file):
                 cluster_tenant = config["aci_config"]["cluster_tenant"]
                 old_naming = config["aci_config"]["use_legacy_kube_naming_convention"]
                 apic.unprovision(apic_config, system_id, tenant, vrf_tenant, cluster_tenant, old_naming)
+                if regen_state is not None:
+                    regen_state.mark_pushed([])
             ret = False if apic.errors > 0 else True
     return ret
 
@@ -1286,13 +1911,25 @@ class CustomFormatter(argparse.HelpFormatter):
         return ret
 
 
-def parse_args(show_help):
-    version = 'Unknown'
+def package_version():
+    # importlib.metadata is much cheaper to import than pkg_resources
     try:
-        version = pkg_resources.require("acc_provision")[0].version
-    except pkg_resources.DistributionNotFound:
+        from importlib import metadata
+    except ImportError:
+        import pkg_resources
+        try:
+            return pkg_resources.require("acc_provision")[0].version
+        except pkg_resources.DistributionNotFound:
+            return 'Unknown'
+    try:
+        return metadata.version("acc_provision")
+    except metadata.PackageNotFoundError:
         # ignore, expected in case running from source
-        pass
+        return 'Unknown'
+
+
+def parse_args(show_help):
+    version = package_version()
 
     parser = argparse.ArgumentParser(
         description='Provision an ACI/Kubernetes installation',
@@ -1317,9 +1954,21 @@ def parse_args(show_help):
     parser.add_argument(
         '-z', '--output_tar', default="-", metavar='file',
         help='output zipped tar file for your kubernetes deployment')
+    parser.add_argument(
+        '--tar-compression-level', default=9, type=int, metavar='level',
+        help='gzip compression level of the output tar, 0 (none) to 9 (best), default is 9')
     parser.add_argument(
         '-r', '--aci_operator_cr', default="-", metavar='file',
         help='output file for your aci-operator deployment custom resource')
+    parser.add_argument(
+        '--apicfile', default=None, metavar='file',
+        help='output file for the generated APIC configuration')
+    parser.add_argument(
+        '--apicfile-format', default='text', choices=['text', 'ndjson'],
+        help='format of the APIC configuration file: text, or ndjson with one record per line')
+    parser.add_argument(
+        '--apply-plan', default=None, metavar='file',
+        help='provision (or with -d, delete) a saved ndjson APIC configuration without regenerating it')
     parser.add_argument(
         '-a', '--apic', action='store_true', default=False,
         help='create/validate the required APIC resources')
@@ -1359,6 +2008,36 @@ def parse_args(show_help):
     parser.add_argument(
         '--disable-multus', default='true', metavar='disable_multus',
         help='true/false to disable/enable multus in cluster')
+    parser.add_argument(
+        '--state-file', default=None, metavar='file',
+        help='state from the previous run, used to regenerate and push only what changed')
+    parser.add_argument(
+        '--skip-unchanged', action='store_true', default=False,
+        help='with -a, read each subtree from the APIC and post only those that differ')
+    parser.add_argument(
+        '--inventory', default=None, metavar='file',
+        help='SQLite inventory of provisioned clusters, updated after each successful -a or -d run')
+    parser.add_argument(
+        '--query', default=None, metavar='field=value',
+        help='look up clusters in the --inventory by system_id, flavor, tenant, vrf_tenant, vrf, l3out, vlan or subnet, or list the conflicts=system_id')
+    parser.add_argument(
+        '--fleet', default=None, metavar='path',
+        help='input files (file or directory) of the other clusters on the fabric; unset VLANs and subnets are allocated to avoid them')
+    parser.add_argument(
+        '--serve', default=None, metavar='[host:]port',
+        help='run a local HTTP/JSON provisioning service, see serve()')
+    parser.add_argument(
+        '--validate-only', action='store_true', default=False,
+        help='only check the input, print the findings as JSON and exit; with -a, check against the APIC too')
+    parser.add_argument(
+        '--batch', default=None, metavar='path',
+        help='generate outputs for every input file in a directory, or for the clusters listed in a manifest file')
+    parser.add_argument(
+        '--batch-output', default=".", metavar='dir',
+        help='directory for the outputs generated with --batch or for a multi-document input file')
+    parser.add_argument(
+        '--batch-workers', default=None, type=int, metavar='count',
+        help='number of worker processes for --batch, default is the number of cores')
     # If the input has no arguments, show help output and exit
     if show_help:
         parser.print_help(sys.stderr)
@@ -1367,54 +2046,498 @@ def parse_args(show_help):
     return parser.parse_args()
 
 
-def get_versions(versions_url):
-    global VERSIONS
+def versions_cache_path(versions_url):
+    cache_dir = get_cache_dir()
+    if not cache_dir:
+        return None
+    key = hashlib.sha1(versions_url.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(cache_dir, "versions-%s.json" % key)
+
+
+def fetch_versions(versions_url, ttl=VERSIONS_CACHE_TTL):
+    """Return the versions document at versions_url
+
+    Responses are cached on disk and reused for ttl seconds, then
+    revalidated with If-None-Match/If-Modified-Since. The cached copy is
+    also used when the URL cannot be reached. Returns None if there is
+    neither a usable response nor a cached copy.
+    """
+    import requests
+    cache_path = versions_cache_path(versions_url)
+    cached = None
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r') as f:
+                cached = json.load(f)
+        except (IOError, OSError, ValueError):
+            cached = None
+
+    now = time.time()
+    if cached is not None and now - cached["fetched"] < ttl:
+        return yaml.load(cached["body"], Loader=YamlLoader)
+
+    headers = {}
+    if cached is not None:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
     try:
-        # try as a URL
-        res = requests.get(versions_url)
-        versions_yaml = yaml.safe_load(res)
-        info("Loading versions from URL: " + versions_url)
-        VERSIONS = versions_yaml['versions']
-
-    except Exception:
+        res = requests.get(versions_url, headers=headers, timeout=VERSIONS_TIMEOUT)
+        if res.status_code == 304 and cached is not None:
+            cached["fetched"] = now
+        else:
+            res.raise_for_status()
+            doc = yaml.load(res.text, Loader=YamlLoader)
+            if not isinstance(doc, dict) or 'versions' not in doc:
+                raise ValueError("No versions found")
+            cached = {
+                "url": versions_url,
+                "etag": res.headers.get("ETag"),
+                "last_modified": res.headers.get("Last-Modified"),
+                "fetched": now,
+                "body": res.text,
+            }
+        if cache_path:
+            save_cache_file(cache_path, json.dumps(cached).encode("utf-8"))
+    except Exception as e:
+        if cached is None:
+            return None
+        warn("Unable to fetch versions from %s (%s), using cached copy" % (versions_url, e))
+    return yaml.load(cached["body"], Loader=YamlLoader)
+
+
+def get_versions(versions_url, ttl=VERSIONS_CACHE_TTL):
+    """Return the versions at versions_url, or None if they can't be loaded
+
+    The packaged VERSIONS are left alone, so the versions of one run don't
+    leak into the next one in the same process.
+    """
+    if re.match("^https?://", versions_url):
+        versions_yaml = fetch_versions(versions_url, ttl)
+        if versions_yaml is not None:
+            info("Loading versions from URL: " + versions_url)
+            return versions_yaml['versions']
+    else:
         try:
             # try as a local file
             with open(versions_url, 'r') as res:
-                versions_yaml = yaml.safe_load(res)
+                versions_yaml = yaml.load(res, Loader=YamlLoader)
                 info("Loading versions from local file: " + versions_url)
-                VERSIONS = versions_yaml['versions']
+                return versions_yaml['versions']
         except Exception:
-            info("Unable to load versions from path: " + versions_url)
+            pass
+    info("Unable to load versions from path: " + versions_url)
+    return None
+
+
+SUBNET_FIELDS = ["pod_subnet", "node_subnet", "extern_dynamic", "extern_static", "node_svc_subnet"]
+
+
+def subnet_ranges(config, prefix=""):
+    # Labelled subnets of a cluster, extern_static is not set for
+    # OpenShift flavors
+    net_config = config.get("net_config") or {}
+    return [(prefix + field, net_config[field]) for field in SUBNET_FIELDS
+            if net_config.get(field)]
+
+
+class SubnetIndex(object):
+    """Sorted interval index over labelled subnets"""
+    def __init__(self, subnets=None):
+        self.ranges = []
+        for label, cidr in subnets or []:
+            self.add(label, cidr)
+
+    def add(self, label, cidr):
+        n = ipaddress.ip_network("%s" % (cidr,), strict=False)
+        self.ranges.append((n.version, int(n.network_address), int(n.broadcast_address), label, cidr))
+
+    def conflicts(self, labels=None):
+        """Return all overlapping ((label, cidr), (label, cidr)) pairs
+
+        Ranges are swept in start order keeping a heap of the open ones,
+        so this is O(n log n) plus the number of conflicts. If labels is
+        given, only pairs involving one of those labels are returned.
+        """
+        ranges = sorted(self.ranges)
+        ret = []
+        active = []
+        for i, (version, start, end, label, cidr) in enumerate(ranges):
+            if i and ranges[i - 1][0] != version:
+                active = []
+            while active and active[0][0] < start:
+                heapq.heappop(active)
+            for _, j in sorted(active, key=lambda x: x[1]):
+                other = ranges[j]
+                if labels is None or label in labels or other[3] in labels:
+                    ret.append(((other[3], other[4]), (label, cidr)))
+            heapq.heappush(active, (end, i))
+        return ret
 
 
-def check_overlapping_subnets(config):
+def subnet_conflicts(config, fleet=None):
+    """Return the overlapping ((label, subnet), (label, subnet)) pairs of config
+
+    fleet is an optional list of (label, subnet) used by other clusters.
+    """
+    subnets = subnet_ranges(config)
+    index = SubnetIndex(subnets)
+    for label, cidr in fleet or []:
+        index.add(label, cidr)
+    return index.conflicts(set(label for label, _ in subnets))
+
+
+def check_overlapping_subnets(config, fleet=None):
     """check if subnets are overlapping."""
-    subnet_info = {
-        "pod_subnet": config["net_config"]["pod_subnet"],
-        "node_subnet": config["net_config"]["node_subnet"],
-        "extern_dynamic": config["net_config"]["extern_dynamic"],
-        "node_svc_subnet": config["net_config"]["node_svc_subnet"]
-    }
+    conflicts = subnet_conflicts(config, fleet)
+    for (label1, cidr1), (label2, cidr2) in conflicts:
+        err("Subnet %s (%s) overlaps %s (%s)" % (label1, cidr1, label2, cidr2))
+    return not conflicts
+
+
+class FleetAllocator(object):
+    """Conflict-free VLAN and subnet allocation across a fabric
+
+    Used VLANs are kept as an integer bitmap and used subnets as sorted
+    integer ranges per IP version. Allocation is serialized with a lock
+    so one allocator can be shared between threads.
+    """
+    def __init__(self, vlan_start=2, vlan_end=4094):
+        self.lock = threading.Lock()
+        self.vlan_pool = ((1 << (vlan_end + 1)) - 1) ^ ((1 << vlan_start) - 1)
+        self.vlans = 0
+        self.subnets = {4: [], 6: []}
+        self.labels = []
+
+    def reserve_vlans(self, start, end=None):
+        end = start if end is None else end
+        with self.lock:
+            self.vlans |= ((1 << (int(end) + 1)) - 1) ^ ((1 << int(start)) - 1)
+
+    def reserve_subnet(self, cidr, label=None):
+        n = ipaddress.ip_network("%s" % (cidr,), strict=False)
+        with self.lock:
+            bisect.insort(self.subnets[n.version], (int(n.network_address), int(n.broadcast_address)))
+            if label is not None:
+                self.labels.append((label, cidr))
+
+    def add_config(self, config, prefix="", labelled=True):
+        net_config = config.get("net_config") or {}
+        for field in ("kubeapi_vlan", "service_vlan"):
+            if net_config.get(field):
+                self.reserve_vlans(net_config[field])
+        vmm_domain = (config.get("aci_config") or {}).get("vmm_domain") or {}
+        vlan_range = vmm_domain.get("vlan_range") or {}
+        if vlan_range.get("start") and vlan_range.get("end"):
+            self.reserve_vlans(vlan_range["start"], vlan_range["end"])
+        for label, cidr in subnet_ranges(config, prefix):
+            self.reserve_subnet(cidr, label if labelled else None)
+
+    def allocate_vlans(self, count=1):
+        """Return the first VLAN of count free consecutive VLANs"""
+        block = (1 << count) - 1
+        with self.lock:
+            free = self.vlan_pool & ~self.vlans
+            while free:
+                start = (free & -free).bit_length() - 1
+                run = free >> start
+                length = ((run + 1) & ~run).bit_length() - 1
+                if length >= count:
+                    self.vlans |= block << start
+                    return start
+                free &= ~(((1 << length) - 1) << start)
+            return None
+
+    def allocate_subnet(self, pool, prefixlen):
+        """Return the first free prefixlen subnet of pool"""
+        pool = ipaddress.ip_network("%s" % (pool,), strict=False)
+        size = 1 << (pool.max_prefixlen - prefixlen)
+        end = int(pool.broadcast_address)
+        with self.lock:
+            used = self.subnets[pool.version]
+            start = int(pool.network_address)
+            # reach is the largest end of the ranges starting before the
+            # candidate's end, a wide range may start long before it
+            i, reach = 0, -1
+            while start + size - 1 <= end:
+                while i < len(used) and used[i][0] <= start + size - 1:
+                    reach = max(reach, used[i][1])
+                    i += 1
+                if reach < start:
+                    bisect.insort(used, (start, start + size - 1))
+                    net = ipaddress.ip_network((start, prefixlen))
+                    return "%s/%s" % (net.network_address + 1, prefixlen)
+                # move to the first aligned block after the conflict
+                start = (reach // size + 1) * size
+            return None
+
+    def allocate(self, config):
+        """Return a config layer with values for unset VLANs and subnets"""
+        alloc_config = config["allocator"]
+        net_config = config["net_config"]
+        ret = {"net_config": {}}
+        if not isOverlay(config["flavor"]):
+            for field in ("kubeapi_vlan", "service_vlan"):
+                if net_config.get(field) is None:
+                    ret["net_config"][field] = self.allocate_vlans()
+            vmm_domain = config["aci_config"]["vmm_domain"]
+            if vmm_domain.get("encap_type") == "vlan" and not vmm_domain.get("vlan_range"):
+                size = alloc_config["vlan_range_size"]
+                start = self.allocate_vlans(size)
+                if start is not None:
+                    ret["aci_config"] = {"vmm_domain": {"vlan_range": {"start": start, "end": start + size - 1}}}
+        if alloc_config["subnet_pool"]:
+            for field in ("node_svc_subnet", "extern_dynamic", "extern_static"):
+                if net_config.get(field) is None:
+                    ret["net_config"][field] = self.allocate_subnet(
+                        alloc_config["subnet_pool"], alloc_config["subnet_prefix"])
+        return ret
 
-    # Don't have extern_static field set for OpenShift flavors
-    if config["net_config"]["extern_static"]:
-        subnet_info["extern_static"] = config["net_config"]["extern_static"]
 
-    for sub1, sub2 in combinations(subnet_info.values(), r=2):
-        # Checking if sub1 and sub2 are IPv4 or IPv6
-        rtr1, _ = sub1.split("/")
-        ip1 = ipaddress.ip_address(rtr1)
-        if ip1.version == 4:
-            net1, net2 = ipaddress.IPv4Network(sub1, strict=False), ipaddress.IPv4Network(sub2, strict=False)
-        else:
-            net1, net2 = ipaddress.IPv6Network(sub1, strict=False), ipaddress.IPv6Network(sub2, strict=False)
-        out = net1.overlaps(net2)
-        if out:
+def fleet_input_files(path):
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, f) for f in os.listdir(path)
+                      if f.endswith((".yaml", ".yml")))
+    return [path]
+
+
+def fleet_allocator(fleet_path, config, apic=None):
+    """Build an allocator from the input files of the other clusters
+
+    All of their VLANs and subnets are reserved, but only the subnets of
+    the clusters in config's VRF are labelled for the overlap check.
+    Returns the allocator and the system_ids of those clusters.
+    """
+    vrf = config["aci_config"]["vrf"]
+    vrf = (vrf["tenant"], vrf["name"])
+    peers = set()
+    pool = config["allocator"]["vlan_pool"]
+    allocator = FleetAllocator(pool["start"], pool["end"])
+    if config["net_config"].get("infra_vlan"):
+        allocator.reserve_vlans(config["net_config"]["infra_vlan"])
+    system_id = config["aci_config"]["system_id"]
+    for path in fleet_input_files(fleet_path):
+        try:
+            other = load_yaml_file(path) or {}
+        except (IOError, OSError) as e:
+            warn("Ignoring fleet input %s: %s" % (path, e))
+            continue
+        other_id = (other.get("aci_config") or {}).get("system_id")
+        if other_id == system_id:
+            continue
+        other_vrf = (other.get("aci_config") or {}).get("vrf") or {}
+        peer = (other_vrf.get("tenant"), other_vrf.get("name")) == vrf
+        if peer and other_id:
+            peers.add(other_id)
+        allocator.add_config(other, "%s/" % (other_id or path), labelled=peer)
+    if apic is not None:
+        for start, end in apic.get_encap_blocks():
+            allocator.reserve_vlans(start, end)
+    return allocator, peers
+
+
+def fleet_dir(fleet_path):
+    if os.path.isdir(fleet_path):
+        return fleet_path
+    return os.path.dirname(os.path.abspath(fleet_path))
+
+
+@contextlib.contextmanager
+def fleet_lock(fleet_path):
+    """Serialize allocations from concurrent runs against one fleet"""
+    import fcntl
+    with open(os.path.join(fleet_dir(fleet_path), ".acc-provision.lock"), "a") as lockf:
+        fcntl.flock(lockf, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockf, fcntl.LOCK_UN)
+
+
+def unset_fields(layer, config):
+    """The values of layer whose fields are unset in config"""
+    ret = {}
+    for k, v in layer.items():
+        current = config.get(k)
+        if isinstance(v, dict) and isinstance(current, Mapping):
+            v = unset_fields(v, current)
+            if v:
+                ret[k] = v
+        elif current is None:
+            ret[k] = v
+    return ret
+
+
+def fleet_allocations_path(fleet_path):
+    return os.path.join(fleet_dir(fleet_path), ".acc-provision-allocations.json")
+
+
+def load_fleet_allocations(fleet_path):
+    allocations_path = fleet_allocations_path(fleet_path)
+    if not os.path.exists(allocations_path):
+        return {}
+    with open(allocations_path, "r") as f:
+        return json.load(f)
+
+
+def fleet_allocate(fleet_path, config, apic=None):
+    """Fill unset VLANs and subnets of config from the fleet's free space
+
+    Allocations only fill fields that are still unset, values set in the
+    config always win. Returns the (label, subnet) ranges used by the
+    other clusters in config's VRF, and the cluster's allocations to
+    record with fleet_record once the config is validated, or None if
+    they are already recorded. Recorded allocations are kept on reruns.
+    """
+    system_id = config["aci_config"]["system_id"]
+    with fleet_lock(fleet_path):
+        allocations = load_fleet_allocations(fleet_path)
+        allocator, peers = fleet_allocator(fleet_path, config, apic)
+        for other_id, layer in sorted(allocations.items()):
+            if other_id != system_id:
+                allocator.add_config(layer, "%s/" % other_id, labelled=other_id in peers)
+        recorded = unset_fields(allocations.get(system_id, {}), config)
+        config.push(recorded, top=True)
+        # The cluster's own values are not handed out again
+        allocator.add_config(config, labelled=False)
+        layer = allocator.allocate(config)
+        config.push(layer, top=True)
+    for field, value in sorted(layer["net_config"].items()):
+        info("Allocated %s: %s" % (field, value))
+    allocated = deep_merge(copy.deepcopy(layer), recorded)
+    if allocated == allocations.get(system_id, {"net_config": {}}):
+        allocated = None
+    return allocator.labels, allocated
+
+
+def fleet_record(fleet_path, system_id, allocated):
+    """Record the allocations returned by fleet_allocate
+
+    Fails if another run recorded overlapping allocations since they were
+    made.
+    """
+    with fleet_lock(fleet_path):
+        allocations = load_fleet_allocations(fleet_path)
+        mine, others = FleetAllocator(), FleetAllocator()
+        mine.add_config(allocated, labelled=False)
+        for other_id, layer in allocations.items():
+            if other_id != system_id:
+                others.add_config(layer, "%s/" % other_id)
+        if mine.vlans & others.vlans or subnet_conflicts(allocated, others.labels):
+            err("Allocations of another cluster overlap ours since they were made, please retry")
             return False
+        allocations[system_id] = allocated
+        allocations_path = fleet_allocations_path(fleet_path)
+        fd, tmp_path = tempfile.mkstemp(dir=fleet_dir(fleet_path))
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(allocations, f, indent=4, sort_keys=True)
+            os.replace(tmp_path, allocations_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
     return True
 
 
-def provision(args, apic_file, no_random):
+def open_inventory(path):
+    if __package__ is None or __package__ == '':
+        from inventory import Inventory
+    else:
+        from .inventory import Inventory
+    return Inventory(path)
+
+
+def inventory_subnets(path, config):
+    """Return the subnets of the other clusters in config's VRF"""
+    vrf = config["aci_config"]["vrf"]
+    inventory = open_inventory(path)
+    try:
+        return inventory.subnets(config["aci_config"]["system_id"], (vrf["tenant"], vrf["name"]))
+    finally:
+        inventory.close()
+
+
+def query_inventory(args):
+    if not args.inventory:
+        err("--query requires --inventory")
+        return False
+    if "=" not in args.query:
+        err("Invalid query, expected field=value: %s" % args.query)
+        return False
+    field, value = args.query.split("=", 1)
+    inventory = open_inventory(args.inventory)
+    try:
+        if field == "conflicts":
+            ret = [{"field": field, "system_id": other, "other_field": other_field}
+                   for field, other, other_field in inventory.conflicts(value)]
+        else:
+            ret = inventory.find(field, value)
+    except ValueError as e:
+        err("%s" % e)
+        return False
+    finally:
+        inventory.close()
+    print(yaml.safe_dump(ret, default_flow_style=False), end="")
+    return True
+
+
+def get_timeout(args):
+    timeout = None
+    if args.timeout:
+        try:
+            if int(args.timeout) >= 0:
+                timeout = int(args.timeout)
+        except ValueError:
+            # ignore that timeout value
+            warn("Invalid timeout value ignored: '%s'" % timeout)
+    return timeout
+
+
+def apply_plan(args):
+    with open(args.apply_plan, "r") as plan:
+        try:
+            meta = json.loads(plan.readline()).get("meta")
+        except ValueError:
+            meta = None
+        if meta is None:
+            err("No plan metadata in %s, save the plan with --apicfile-format ndjson" % args.apply_plan)
+            return False
+
+        config = {
+            "aci_config": {
+                "apic_hosts": meta["apic_hosts"],
+                "apic_login": {
+                    "username": args.username,
+                    "password": args.password if args.password else os.environ.get('ACC_PROVISION_PASS'),
+                    "timeout": get_timeout(args),
+                },
+                "capic": False,
+                "apic_proxy": args.apic_proxy,
+            },
+            "provision": {
+                "debug_apic": args.debug,
+                "save_to": args.test_data_out,
+            },
+        }
+        apic = get_apic(config)
+        if apic is None:
+            err("Not able to login to the APIC, please check username or password")
+            return False
+
+        apic_config = ApicKubeConfig.load_config(plan)
+        if args.delete:
+            info("Unprovisioning configuration in APIC")
+            apic.unprovision(list(apic_config), meta["system_id"], meta["tenant"], meta["vrf_tenant"],
+                             meta["cluster_tenant"], meta["old_naming"])
+        else:
+            info("Provisioning configuration in APIC")
+            apic.provision(apic_config, meta["sync_login"])
+    return apic.errors == 0
+
+
+def provision(args, apic_file, no_random, document=None):
+    global regen_state
     config_file = args.config
     output_file = args.output
     output_tar = args.output_tar
@@ -1427,14 +2550,7 @@ def provision(args, apic_file, no_random):
     if args.delete:
         prov_apic = False
 
-    timeout = None
-    if args.timeout:
-        try:
-            if int(args.timeout) >= 0:
-                timeout = int(args.timeout)
-        except ValueError:
-            # ignore that timeout value
-            warn("Invalid timeout value ignored: '%s'" % timeout)
+    timeout = get_timeout(args)
 
     generate_cert_data = True
     if args.delete:
@@ -1448,8 +2564,14 @@ def provision(args, apic_file, no_random):
         generate_sample(sys.stdout, args.flavor)
         return True
 
+    # Checked here rather than in main so batch and serve jobs get it too
+    level = args.tar_compression_level
+    if isinstance(level, bool) or not isinstance(level, int) or not 0 <= level <= 9:
+        err("Invalid tar compression level: %s <Valid values: 0-9>" % (level,))
+        return False
+
     # command line config
-    config = {
+    cmdline_config = {
         "aci_config": {
             "apic_login": {
             },
@@ -1461,29 +2583,36 @@ def provision(args, apic_file, no_random):
             "debug_apic": args.debug,
             "save_to": args.test_data_out,
             "skip-kafka-certs": args.skip_kafka_certs,
+            "apicfile_format": args.apicfile_format,
+            "tar_compression_level": args.tar_compression_level,
+            "skip_unchanged": args.skip_unchanged,
         },
     }
 
     if upgrade_cluster:
         output_tar = "/dev/null"
-        config["provision"]["upgrade_cluster"] = True
+        cmdline_config["provision"]["upgrade_cluster"] = True
 
     # infra_vlan is not part of command line input, but we do
     # pass it as a command line arg in unit tests to pass in
     # configuration which would otherwise be discovered from
     # the APIC
-    config["discovered"] = {"infra_vlan": getattr(args, "infra_vlan", None)}
+    cmdline_config["discovered"] = {"infra_vlan": getattr(args, "infra_vlan", None)}
 
     flavor = args.flavor
+    apic_login = cmdline_config["aci_config"]["apic_login"]
     if args.username:
-        config["aci_config"]["apic_login"]["username"] = args.username
+        apic_login["username"] = args.username
 
-    config["aci_config"]["apic_login"]["password"] = \
+    apic_login["password"] = \
         args.password if args.password else os.environ.get('ACC_PROVISION_PASS')
-    config["aci_config"]["apic_login"]["timeout"] = timeout
+    apic_login["timeout"] = timeout
 
     # Create config
-    user_config = config_user(config_file)
+    user_config = config_user(config_file, document)
+    if not isinstance(user_config, dict):
+        err("Invalid configuration input: expected a mapping of options")
+        return False
     if 'aci_config' in user_config and 'use_legacy_kube_naming_convention' in user_config['aci_config'] and 'tenant' in user_config['aci_config']:
         err("Not allowed to set tenant and use_legacy_kube_naming_convention fields at the same time")
         return False
@@ -1492,20 +2621,23 @@ def provision(args, apic_file, no_random):
         err("use_legacy_kube_naming_convention not allowed in cloud flavor")
         return False
 
+    versions = VERSIONS
     if user_config:
         if 'versions_url' in user_config and 'path' in user_config['versions_url']:
             versions_url = user_config['versions_url']['path']
-            get_versions(versions_url)
+            versions = get_versions(versions_url, user_config['versions_url'].get('ttl', VERSIONS_CACHE_TTL)) or VERSIONS
 
-    deep_merge(config, user_config)
+    # Layers are stacked in precedence order and only merged once,
+    # after config_adjust, see LayeredConfig
+    config = LayeredConfig([cmdline_config, user_config])
 
     if flavor in FLAVORS:
         info("Using configuration flavor " + flavor)
-        deep_merge(config, {"flavor": flavor})
+        config.push({"flavor": flavor})
         if "config" in FLAVORS[flavor]:
-            deep_merge(config, FLAVORS[flavor]["config"])
+            config.push(FLAVORS[flavor]["config"])
         if "default_version" in FLAVORS[flavor]:
-            deep_merge(config, {
+            config.push({
                 "registry": {
                     "version": FLAVORS[flavor]["default_version"]
                 }
@@ -1515,20 +2647,24 @@ def provision(args, apic_file, no_random):
         return False
     flavor_opts = FLAVORS[flavor].get("options", DEFAULT_FLAVOR_OPTIONS)
 
-    deep_merge(config, config_default())
+    config.push(config_default())
 
     if (args.disable_multus == 'false'):
         config['multus']['disable'] = False
 
-    if config["registry"]["version"] in VERSIONS:
-        deep_merge(config,
-                   {"registry": VERSIONS[config["registry"]["version"]]})
+    regen_state = RegenState(args.state_file) if args.state_file else None
+
+    if config["registry"]["version"] in versions:
+        config.push({"registry": versions[config["registry"]["version"]]})
 
     # Discoverd state (e.g. infra-vlan) overrides the config file data
     if isOverlay(flavor):
         config["net_config"]["infra_vlan"] = None
     else:
-        config = deep_merge(config_discover(config, prov_apic), config)
+        config.push(config_discover(config, prov_apic), top=True)
+
+    if args.validate_only:
+        return validate_only(args, config, flavor_opts, prov_apic)
 
     # Validate APIC access
     if prov_apic is not None:
@@ -1539,6 +2675,12 @@ def provision(args, apic_file, no_random):
             return False
         config["aci_config"]["apic_version"] = apic_version
 
+    # Allocate unset VLANs and subnets around the rest of the fleet
+    fleet_subnets = None
+    fleet_allocated = None
+    if args.fleet and config["aci_config"]["system_id"]:
+        fleet_subnets, fleet_allocated = fleet_allocate(args.fleet, config, apic if prov_apic is not None else None)
+
     # Validate config
     try:
         if not config_validate(flavor_opts, config):
@@ -1547,14 +2689,28 @@ def provision(args, apic_file, no_random):
     except Exception as ex:
         print("%s") % ex
 
+    if args.inventory:
+        fleet_subnets = (fleet_subnets or []) + inventory_subnets(args.inventory, config)
+
     # Verify if overlapping subnet present in config input file
-    if not check_overlapping_subnets(config):
+    if not check_overlapping_subnets(config, fleet_subnets):
         err("overlapping subnets found in configuration input file")
         return False
 
+    # Only allocations of a valid config are kept for reruns
+    if fleet_allocated is not None:
+        if not fleet_record(args.fleet, config["aci_config"]["system_id"], fleet_allocated):
+            return False
+
     # Adjust config based on convention/apic data
     adj_config = config_adjust(args, config, prov_apic, no_random)
-    deep_merge(config, adj_config)
+    config.push(adj_config)
+    config = config.materialize()
+
+    if regen_state is not None:
+        # Keep generated values stable so unchanged outputs can be reused
+        sync_login = config["aci_config"]["sync_login"]
+        sync_login["password"] = regen_state.sticky("sync_password", sync_login["password"])
 
     # Advisory checks, including apic checks, ignore failures
     if not config_validate_preexisting(config, prov_apic):
@@ -1583,28 +2739,419 @@ def provision(args, apic_file, no_random):
         if apic is None:
             print("APIC login failed")
             return False
+        if __package__ is None or __package__ == '':
+            from cloud_provision import CloudProvision
+        else:
+            from .cloud_provision import CloudProvision
         cloud_prov = CloudProvision(apic, config, args)
         return cloud_prov.Run(flavor_opts, generate_kube_yaml)
 
-    # generate output files; and program apic if needed
-    gen = flavor_opts.get("template_generator", generate_kube_yaml)
-    if not callable(gen):
-        gen = globals()[gen]
-    gen(config, output_file, output_tar, operator_cr_output_file)
-
     if (config['net_config']['second_kubeapi_portgroup'] and prov_apic is not None):
         apic = get_apic(config)
         nested_vswitch_vlanpool = apic.get_vmmdom_vlanpool_tDn(config['aci_config']['vmm_domain']['nested_inside']['name'])
         config['aci_config']['vmm_domain']['nested_inside']['vlan_pool'] = nested_vswitch_vlanpool
-    ret = generate_apic_config(flavor_opts, config, prov_apic, apic_file)
+
+    if regen_state is not None and not args.version_token:
+        stable_configuration_version(config)
+
+    # generate output files; and program apic if needed. The APIC plan
+    # doesn't depend on the outputs, it is built while they are rendered.
+    gen = flavor_opts.get("template_generator", generate_kube_yaml)
+    if not callable(gen):
+        gen = globals()[gen]
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        # gen writes to config (e.g. deployment_base64), the plan gets a
+        # snapshot so it and its state digests don't depend on timing
+        plan = executor.submit(apic_plan, flavor_opts, copy.deepcopy(config))
+        gen(config, output_file, output_tar, operator_cr_output_file)
+        apic_config = plan.result()
+    ret = generate_apic_config(flavor_opts, config, prov_apic, apic_file, apic_config)
+    if regen_state is not None:
+        regen_state.save()
+    # Only runs that changed the APIC change the inventory
+    if args.inventory and ret and prov_apic is not None:
+        inventory = open_inventory(args.inventory)
+        try:
+            if prov_apic is False:
+                inventory.remove(config["aci_config"]["system_id"])
+            else:
+                inventory.record(config, config["provision"]["plan_hash"])
+                for field, other, other_field in inventory.conflicts(config["aci_config"]["system_id"]):
+                    warn("%s is also used by %s as %s" % (field, other, other_field))
+        finally:
+            inventory.close()
     return ret
 
 
+def stable_configuration_version(config):
+    """Keep the previous run's configuration_version if no output changes
+
+    The version labels the generated objects, objects with another version
+    are deleted as stale. A new version is used as soon as any output
+    would differ from the previous run's.
+    """
+    registry = config["registry"]
+    previous = regen_state.values.get("configuration_version")
+    if previous is not None:
+        current, registry["configuration_version"] = registry["configuration_version"], previous
+        check = copy.deepcopy(config)
+        # deployment_base64 is set from aci-containers.yaml while rendering
+        containers = regen_state.output(json.dumps(["kube", "aci-containers.yaml"]))
+        if containers is not None:
+            check["kube_config"]["deployment_base64"] = base64.b64encode(containers.encode('ascii')).decode('ascii')
+        if not regen_state.unchanged("kube", check):
+            registry["configuration_version"] = current
+    regen_state.record("configuration_version", registry["configuration_version"])
+
+
+def validate_only(args, config, flavor_opts, prov_apic):
+    """Run the checks of provision without generating certs or outputs
+
+    The findings are printed to stdout as a JSON record, one line per
+    input. With an APIC, its login and the resources the config refers
+    to are checked too.
+    """
+    findings = []
+    apic = None
+    if prov_apic is not None:
+        apic = get_apic(config)
+        if apic is None:
+            findings.append({"check": "apic", "message": "Not able to login to the APIC"})
+        else:
+            config["aci_config"]["apic_version"] = apic.apic_version
+
+    system_id = config["aci_config"]["system_id"]
+    fleet_subnets = []
+    if args.fleet and system_id:
+        fleet_subnets, _ = fleet_allocate(args.fleet, config, apic)
+    if args.inventory:
+        fleet_subnets += inventory_subnets(args.inventory, config)
+
+    for key, e in config_errors(flavor_opts, config):
+        findings.append({"check": "config", "field": key, "message": "%s" % e})
+    for (label1, cidr1), (label2, cidr2) in subnet_conflicts(config, fleet_subnets):
+        findings.append({"check": "overlap", "field": label1, "subnet": cidr1,
+                         "message": "Subnet %s (%s) overlaps %s (%s)" % (label1, cidr1, label2, cidr2)})
+
+    if apic is not None and not findings and not isOverlay(config["flavor"]):
+        config.push(config_adjust(args, config, prov_apic, True))
+        try:
+            for msg in apic_preflight(config.materialize(), apic):
+                findings.append({"check": "apic", "message": msg})
+        except Exception as e:
+            findings.append({"check": "apic", "message": "Unable to validate resources on APIC: %s" % e})
+
+    print(json.dumps({
+        "config": args.config,
+        "flavor": config["flavor"],
+        "system_id": system_id,
+        "valid": not findings,
+        "findings": findings,
+    }, sort_keys=True))
+    return not findings
+
+
+BATCH_OUTPUTS = ("output", "output_tar", "aci_operator_cr", "apicfile")
+
+
+def batch_jobs(args, documents=None):
+    """Return the per-cluster argument dicts for --batch
+
+    args.batch is a directory of input files or a manifest with a list of
+    clusters, each an input file or a dict of argument overrides such as
+    config, flavor, output, output_tar, aci_operator_cr or apicfile. Each
+    document of a multi-document input file is a cluster of its own;
+    documents is the already read input of a multi-document args.config.
+    """
+    base = args._asdict() if hasattr(args, "_asdict") else dict(vars(args))
+    base.update({"batch": None, "state_file": None})
+    if documents is not None:
+        entries = [{"config": args.config}]
+        root = "."
+    elif os.path.isdir(args.batch):
+        entries = fleet_input_files(args.batch)
+        root = "."
+    else:
+        entries = (load_yaml_file(args.batch) or {}).get("clusters", [])
+        root = os.path.dirname(args.batch)
+
+    jobs = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            entry = {"config": entry}
+        config_file = entry["config"] if entry["config"] == "-" else os.path.join(root, entry["config"])
+        file_documents = documents if documents is not None else read_config_input(config_file)
+        name = "stdin" if config_file == "-" else os.path.splitext(os.path.basename(config_file))[0]
+        for index, document in enumerate(file_documents):
+            job_name = name
+            if len(file_documents) > 1:
+                config = document[1] if isinstance(document[1], dict) else {}
+                system_id = (config.get("aci_config") or {}).get("system_id")
+                job_name = "%s-%s" % (name, system_id or index)
+            out = lambda suffix: os.path.join(args.batch_output, job_name + suffix)
+            job = dict(base)
+            job.update({
+                "config": config_file,
+                "config_document": document,
+                "output": out(".kube.yaml"),
+                "output_tar": out(".tar.gz"),
+                "aci_operator_cr": out(".operator_cr.yaml"),
+                "apicfile": out(".apic." + ("ndjson" if args.apicfile_format == "ndjson" else "txt")) if args.apicfile else None,
+            })
+            for k, v in entry.items():
+                if k != "config" and k in job:
+                    job[k] = os.path.join(root, v) if k in BATCH_OUTPUTS else v
+            jobs.append(job)
+
+    # Clusters must not overwrite each other's outputs, e.g. with the same
+    # system_id in two documents or one manifest output for several
+    written = {}
+    for index, job in enumerate(jobs):
+        for k in BATCH_OUTPUTS:
+            if job[k] in (None, "-"):
+                continue
+            path = os.path.normpath(job[k])
+            if written.setdefault(path, index) != index:
+                raise ValueError("Several clusters write %s" % path)
+    return jobs
+
+
+def batch_provision(job, no_random=False):
+    # Runs in a batch worker; output is captured so the clusters' messages
+    # don't interleave
+    job = dict(job)
+    document = job.pop("config_document", None)
+    args = argparse.Namespace(**job)
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = capture_out, capture = io.StringIO(), io.StringIO()
+    try:
+        ok = provision(args, args.apicfile, no_random, document)
+        error = None if ok else "provisioning failed"
+    except (Exception, SystemExit) as e:
+        ok = False
+        error = "%s: %s" % (e.__class__.__name__, e)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    return args.config, bool(ok), error, capture.getvalue(), capture_out.getvalue()
+
+
+def batch(args, no_random=False, documents=None):
+    try:
+        jobs = batch_jobs(args, documents)
+    except ValueError as e:
+        err("%s" % e)
+        return False
+    if not os.path.isdir(args.batch_output):
+        os.makedirs(args.batch_output)
+    import multiprocessing
+    workers = min(args.batch_workers or multiprocessing.cpu_count(), max(len(jobs), 1))
+    info("Provisioning %d clusters with %d workers" % (len(jobs), workers))
+    if workers == 1:
+        results = [batch_provision(job, no_random) for job in jobs]
+    else:
+        # Workers are forked where possible, so they share the flavors,
+        # versions and catalog loaded here
+        import concurrent.futures
+        try:
+            context = {"mp_context": multiprocessing.get_context("fork")}
+        except (AttributeError, ValueError):
+            context = {}
+        with concurrent.futures.ProcessPoolExecutor(workers, **context) as executor:
+            results = list(executor.map(batch_provision, jobs, [no_random] * len(jobs)))
+
+    failed = []
+    for config, ok, error, output, stdout in results:
+        sys.stderr.write(output)
+        sys.stdout.write(stdout)
+        if not ok:
+            failed.append((config, error))
+    info("Batch done: %d succeeded, %d failed" % (len(results) - len(failed), len(failed)))
+    for config, error in failed:
+        err("%s: %s" % (config, error))
+    return not failed
+
+
+def provision_input(args, apic_file, no_random=False):
+    # The input is read here, once; several documents in it are provisioned
+    # as a batch
+    documents = [None]
+    if args.config and not args.sample:
+        documents = read_config_input(args.config)
+    if len(documents) > 1:
+        # The outputs of each document go to --batch-output
+        if any(getattr(args, k) not in (None, "-") for k in BATCH_OUTPUTS):
+            err("-o, -z, -r and --apicfile can't name files for a multi-document input, "
+                "the outputs are written to --batch-output (--apicfile - includes the APIC configuration)")
+            return False
+        return batch(args, no_random, documents)
+    return provision(args, apic_file, no_random, documents[0])
+
+
+# Config options naming files on the server, serve requests may only give
+# plain file names, which are created in the request's own directory
+SERVE_PATH_OPTIONS = [
+    "aci_config/sync_login/certfile",
+    "aci_config/sync_login/keyfile",
+]
+
+
+def provision_request(args, request, no_random=False):
+    """Provision one cluster for the serve API
+
+    request has the input "config" (a dict or YAML text) and optionally
+    "flavor", "apply", "delete", "username", "password" and
+    "apicfile_format". Each request runs in its own directory so
+    generated certificates are not shared between clusters. Raises
+    ValueError for malformed requests, for a versions_url or a path in a
+    SERVE_PATH_OPTIONS option of the config: clients must not make the
+    server read or write its files or fetch URLs, and for apply or delete
+    without username and password: the server's own credentials are
+    never used for a request.
+    """
+    if not isinstance(request, dict):
+        raise ValueError("request must be an object")
+    config = request.get("config") or {}
+    parsed = config
+    if not isinstance(config, dict):
+        if not isinstance(config, str):
+            raise ValueError("config must be an object or YAML text")
+        try:
+            parsed = yaml.safe_load(config) or {}
+        except yaml.YAMLError as e:
+            raise ValueError("config is not valid YAML: %s" % e)
+        if not isinstance(parsed, dict):
+            raise ValueError("config must be a mapping")
+    if "versions_url" in parsed:
+        raise ValueError("versions_url is not allowed in requests")
+    for option in SERVE_PATH_OPTIONS:
+        section = parsed
+        for key in option.split("/")[:-1]:
+            section = section.get(key) if isinstance(section, dict) else None
+        value = section.get(option.split("/")[-1]) if isinstance(section, dict) else None
+        if value is not None and (not isinstance(value, str) or value in ("", ".", "..") or
+                                  "/" in value or os.sep in value):
+            raise ValueError("%s must be a file name, not a path" % option)
+
+    job = args._asdict() if hasattr(args, "_asdict") else dict(vars(args))
+    job.update({"serve": None, "batch": None, "state_file": None, "sample": False,
+                "username": None, "password": None})
+    for k in ("flavor", "username", "password", "apicfile_format"):
+        if request.get(k) is not None:
+            if not isinstance(request[k], str):
+                raise ValueError("%s must be a string" % k)
+            job[k] = request[k]
+    job["apic"] = bool(request.get("apply"))
+    job["delete"] = bool(request.get("delete"))
+    if (job["apic"] or job["delete"]) and not (job["username"] and job["password"]):
+        raise ValueError("apply and delete need the username and password of the request")
+
+    cwd = os.getcwd()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        os.chdir(tmpdir)
+        with open("input.yaml", "w") as f:
+            f.write(config if not isinstance(config, dict) else yaml.safe_dump(config))
+        job.update({
+            "config": "input.yaml",
+            "output": "kube.yaml",
+            "output_tar": "operator.tar.gz",
+            "aci_operator_cr": "operator_cr.yaml",
+            "apicfile": "apic.txt",
+        })
+        if job["flavor"] not in FLAVORS:
+            return {"ok": False, "messages": "ERR:  Invalid configuration flavor: %s\n" % job["flavor"]}
+        _, ok, error, messages, _ = batch_provision(job, no_random)
+        ret = {"ok": ok, "messages": messages}
+        if error:
+            ret["error"] = error
+        for key, path in (("kube", "kube.yaml"), ("operator_cr", "operator_cr.yaml"), ("apic", "apic.txt")):
+            if os.path.exists(path):
+                with open(path, "r") as f:
+                    ret[key] = f.read()
+        if os.path.exists("operator.tar.gz"):
+            with open("operator.tar.gz", "rb") as f:
+                ret["tar"] = base64.b64encode(f.read()).decode("ascii")
+        return ret
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmpdir)
+
+
+def make_server(args, address, no_random=False):
+    """HTTP/JSON provisioning service
+
+    POST /provision takes a provision_request() body and returns the
+    rendered outputs, GET /flavors lists the flavors. The flavors,
+    versions and APIC login sessions stay loaded between requests.
+    Requests are served one at a time since provisioning uses module
+    state.
+    """
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+    except ImportError:
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def reply(self, code, body):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/flavors":
+                self.reply(200, dict((k, v["desc"]) for k, v in FLAVORS.items() if not v["hidden"]))
+            else:
+                self.reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/provision":
+                self.reply(404, {"error": "not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length).decode("utf-8"))
+            except ValueError as e:
+                self.reply(400, {"error": "invalid request: %s" % e})
+                return
+            try:
+                ret = provision_request(args, request, no_random)
+            except ValueError as e:
+                self.reply(400, {"error": "invalid request: %s" % e})
+                return
+            except Exception as e:
+                self.reply(500, {"error": "%s" % e})
+                return
+            self.reply(200 if ret["ok"] else 422, ret)
+
+        def log_message(self, fmt, *fmt_args):
+            info("%s %s" % (self.address_string(), fmt % fmt_args))
+
+    return HTTPServer(address, Handler)
+
+
+def serve(args, no_random=False):
+    host, _, port = args.serve.rpartition(":")
+    server = make_server(args, (host or "127.0.0.1", int(port)), no_random)
+    info("Serving on http://%s:%d" % server.server_address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return True
+
+
 def main(args=None, apic_file=None, no_random=False):
     # apic_file and no_random are used by the test functions
     # len(sys.argv) == 1 when acc-provision is called w/o arguments
     if args is None:
         args = parse_args(len(sys.argv) == 1)
+    flush_catalog_cache()
 
     if args.release:
         try:
@@ -1625,6 +3172,25 @@ def main(args=None, apic_file=None, no_random=False):
                 info(flavor + ":\t" + desc)
         return
 
+    if args.apply_plan:
+        if not apply_plan(args):
+            sys.exit(1)
+        return
+
+    if args.query:
+        if not query_inventory(args):
+            sys.exit(1)
+        return
+
+    if args.batch:
+        if not batch(args, no_random):
+            sys.exit(1)
+        return
+
+    if args.serve:
+        serve(args, no_random)
+        return
+
     if args.flavor is None:
         err("Flavor not provided. Use -f to pass a flavor name, --list-flavors to see a list of supported flavors")
         sys.exit(1)
@@ -1637,12 +3203,15 @@ def main(args=None, apic_file=None, no_random=False):
         err("Invalid configuration for disable_multus:" + args.disable_multus + " <Valid values: true/false>")
         sys.exit(1)
 
+    if apic_file is None:
+        apic_file = args.apicfile
+
     success = True
     if args.debug:
-        success = provision(args, apic_file, no_random)
+        success = provision_input(args, apic_file, no_random)
     else:
         try:
-            success = provision(args, apic_file, no_random)
+            success = provision_input(args, apic_file, no_random)
         except KeyboardInterrupt:
             pass
         except Exception as e:
@@ -1,37 +1,160 @@
 from __future__ import print_function, unicode_literals
 
 import collections
+import copy
+import hashlib
 import json
+import os
 import sys
 import re
-import requests
-import urllib3
+import tempfile
 import ipaddress
 
+# requests is loaded on first use, see load_requests()
+requests = None
 debug_http = False
-if debug_http:
-    import logging
-    import http.client as http_client
-    http_client.HTTPConnection.debuglevel = 1
-    # You must initialize logging, otherwise you'll not see debug output.
-    logging.basicConfig()
-    logging.getLogger().setLevel(logging.DEBUG)
-    requests_log = logging.getLogger("requests.packages.urllib3")
-    requests_log.setLevel(logging.DEBUG)
-    requests_log.propagate = True
-
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-try:
-    from requests.packages.urllib3.exceptions import InsecureRequestWarning
-    requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
-except Exception:
-    pass
+
+
+def load_requests():
+    global requests
+    if requests is not None:
+        return requests
+    import requests as requests_module
+    import urllib3
+    if debug_http:
+        import logging
+        import http.client as http_client
+        http_client.HTTPConnection.debuglevel = 1
+        # You must initialize logging, otherwise you'll not see debug output.
+        logging.basicConfig()
+        logging.getLogger().setLevel(logging.DEBUG)
+        requests_log = logging.getLogger("requests.packages.urllib3")
+        requests_log.setLevel(logging.DEBUG)
+        requests_log.propagate = True
+
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    try:
+        from requests.packages.urllib3.exceptions import InsecureRequestWarning
+        requests_module.packages.urllib3.disable_warnings(InsecureRequestWarning)
+    except Exception:
+        pass
+    requests = requests_module
+    return requests
+
+
 apic_debug = False
 apic_cookies = {}
 apic_default_timeout = (15, 90)
 aciContainersOwnerAnnotation = "orchestrator:aci-containers-controller"
 aci_prefix = "aci-containers-"
 
+# Config values that only show up as names, subnets or encaps in the
+# tenant tree. Tenant templates are compiled with placeholders in their
+# place and filled in per cluster.
+TENANT_TEMPLATE_SLOTS = [
+    ("aci_config", "system_id"),
+    ("aci_config", "cluster_tenant"),
+    ("aci_config", "app_profile"),
+    ("aci_config", "vrf", "name"),
+    ("aci_config", "l3out", "name"),
+    ("aci_config", "vmm_domain", "domain"),
+    ("aci_config", "physical_domain", "domain"),
+    ("net_config", "kubeapi_vlan"),
+    ("net_config", "node_subnet"),
+    ("net_config", "pod_subnet"),
+]
+# Config values that change the shape of the tenant tree. Together with
+# the flavor these make up the template cache key. Tenant generators
+# only see the slots and these keys when compiling a template.
+TENANT_TEMPLATE_SHAPE = [
+    ("flavor",),
+    ("aci_config", "use_pre_existing_tenant"),
+    ("aci_config", "use_legacy_kube_naming_convention"),
+    ("aci_config", "disable_node_subnet_creation"),
+    ("aci_config", "kube_default_provide_kube_api"),
+    ("aci_config", "dhcp_relay_label"),
+    ("aci_config", "custom_epgs"),
+    ("aci_config", "items"),
+    ("aci_config", "kube_api_entries"),
+    ("aci_config", "dns_entries"),
+    ("aci_config", "isolation_segments"),
+    ("aci_config", "vmm_domain", "type"),
+    ("aci_config", "vmm_domain", "nested_inside"),
+    ("kube_config", "allow_kube_api_default_epg"),
+    ("kube_config", "allow_pods_kube_api_access"),
+    ("kube_config", "allow_pods_external_access"),
+    ("cf_config", "default_endpoint_group"),
+    ("cf_config", "node_epg"),
+    ("rke_config",),
+]
+# Slot values that tenant generators compare against, kept as literals
+TENANT_TEMPLATE_LITERALS = ["common"]
+# Placeholders for subnet slots have to parse as subnets of the right
+# family. Templates are compiled with both sets, see TenantTemplate.
+TENANT_TEMPLATE_SUBNETS = {
+    ("net_config", "node_subnet"): ({4: "192.0.2.1/24", 6: "2001:db8:0:1::1/64"},
+                                    {4: "203.0.113.1/24", 6: "2001:db8:0:3::1/64"}),
+    ("net_config", "pod_subnet"): ({4: "198.51.100.1/24", 6: "2001:db8:0:2::1/64"},
+                                   {4: "198.18.0.1/24", 6: "2001:db8:0:4::1/64"}),
+}
+TENANT_TEMPLATE_TOKENS = ("@@slot-%d@@", "@@alt-%d@@")
+TENANT_TEMPLATES_MAX = 64
+tenant_templates = collections.OrderedDict()
+# Relative names of the classes generated by acc-provision, as defined by
+# the ACI object model. Fields are filled from the MO attributes.
+MO_RN_FORMATS = {
+    "aaaUser": "user-{name}",
+    "aaaUserCert": "usercert-{name}",
+    "aaaUserDomain": "userdomain-{name}",
+    "aaaUserRole": "role-{name}",
+    "dhcpInfraProvP": "infraprovp",
+    "dhcpLbl": "dhcplbl-{name}",
+    "fvAEPg": "epg-{name}",
+    "fvAp": "ap-{name}",
+    "fvBD": "BD-{name}",
+    "fvCtx": "ctx-{name}",
+    "fvRsBDToOut": "rsBDToOut-{tnL3extOutName}",
+    "fvRsBd": "rsbd",
+    "fvRsCons": "rscons-{tnVzBrCPName}",
+    "fvRsCtx": "rsctx",
+    "fvRsDomAtt": "rsdomAtt-[{tDn}]",
+    "fvRsNdPfxPol": "rsNdPfxPol",
+    "fvRsProv": "rsprov-{tnVzBrCPName}",
+    "fvSubnet": "subnet-[{ip}]",
+    "fvTenant": "tn-{name}",
+    "fvnsEncapBlk": "from-[{from}]-to-[{to}]",
+    "fvnsMcastAddrBlk": "fromaddr-[{from}]-toaddr-[{to}]",
+    "fvnsMcastAddrInstP": "maddrns-{name}",
+    "fvnsVlanInstP": "vlanns-[{name}]-{allocMode}",
+    "infraAttEntityP": "attentp-{name}",
+    "infraGeneric": "gen-{name}",
+    "infraProvAcc": "provacc",
+    "infraRsDomP": "rsdomP-[{tDn}]",
+    "infraRsFuncToEpg": "rsfuncToEpg-[{tDn}]",
+    "infraRsVlanNs": "rsvlanNs",
+    "infraSetPol": "settings",
+    "l3extInstP": "instP-{name}",
+    "l3extOut": "out-{name}",
+    "ndPfxPol": "ndpfxpol-{name}",
+    "physDomP": "phys-{name}",
+    "vmmCtrlrP": "ctrlr-{name}",
+    "vmmDomP": "dom-{name}",
+    "vmmRsDomMcastAddrNs": "rsdomMcastAddrNs",
+    "vmmRsUsrAggrLagPolAtt": "rsUsrAggrLagPolAtt",
+    "vmmUsrCustomAggr": "usrcustomaggr-{name}",
+    "vzBrCP": "brc-{name}",
+    "vzEntry": "e-{name}",
+    "vzFilter": "flt-{name}",
+    "vzInTerm": "intmnl",
+    "vzOutTerm": "outtmnl",
+    "vzRsFiltAtt": "rsfiltAtt-{tnVzFilterName}",
+    "vzRsSubjFiltAtt": "rssubjFiltAtt-{tnVzFilterName}",
+    "vzSubj": "subj-{name}",
+}
+
+# Attributes that name or act on a MO rather than configure it
+MO_FINGERPRINT_IGNORE = ["dn", "rn", "status"]
+
 
 def err(msg):
     print("ERR:  " + msg, file=sys.stderr)
@@ -82,11 +205,14 @@ class Apic(object):
     ):
         global apic_debug
         apic_debug = debug
+        load_requests()
         self.addr = addr
         self.ssl = ssl
         self.username = username
         self.password = password
-        self.cookies = apic_cookies.get((addr, username, ssl))
+        # Sessions are only shared by logins with the same credentials
+        session = (addr, username, hashlib.sha256(("%s" % password).encode("utf-8")).hexdigest(), ssl)
+        self.cookies = apic_cookies.get(session)
         self.errors = 0
         self.verify = verify
         self.timeout = timeout if timeout else apic_default_timeout
@@ -100,7 +226,7 @@ class Apic(object):
         if self.cookies is None:
             self.login()
             if self.cookies is not None:
-                apic_cookies[(addr, username, ssl)] = self.cookies
+                apic_cookies[session] = self.cookies
         self.apic_version = self.get_apic_version()
 
     def url(self, path):
@@ -186,6 +312,22 @@ class Apic(object):
             err("Error in getting %s: %s: " % (path, str(e)))
         return ret
 
+    def get_subtree(self, path):
+        path = path.split("?")[0] + "?rsp-subtree=full&rsp-prop-include=config-only"
+        return self.get_path(path)
+
+    def diff(self, path, config):
+        """Return the DNs under path whose APIC state differs from config."""
+        if not isinstance(config, dict):
+            config = json.loads(config, object_pairs_hook=collections.OrderedDict)
+        generated = mo_fingerprint(config)
+        klass, body = next(iter(config.items()))
+        dn = mo_dn(path, klass, body["attributes"]) or path_dn(path)
+        current = self.get_subtree(path)
+        if current is None or klass not in current:
+            return [dn]
+        return mo_diff(generated, mo_fingerprint(current, generated), dn)
+
     def get_infravlan(self):
         infra_vlan = None
         path = (
@@ -198,6 +340,17 @@ class Apic(object):
             infra_vlan = int(encap.split("-")[1])
         return infra_vlan
 
+    def get_encap_blocks(self):
+        """Return the (from, to) VLAN blocks of all fabric encap pools."""
+        blocks = []
+        data = self.get_path("/api/node/class/fvnsEncapBlk.json", multi=True)
+        for mo in data or []:
+            attributes = mo["fvnsEncapBlk"]["attributes"]
+            if attributes["from"].startswith("vlan-"):
+                blocks.append((int(attributes["from"].split("-")[1]),
+                               int(attributes["to"].split("-")[1])))
+        return blocks
+
     def get_aep(self, aep_name):
         path = "/api/mo/uni/infra/attentp-%s.json" % aep_name
         return self.get_path(path)
@@ -235,19 +388,21 @@ class Apic(object):
         path = "/api/mo/uni/tn-%s/ap-kubernetes.json" % tenant
         return self.get_path(path)
 
-    def provision(self, data, sync_login):
+    def provision(self, data, sync_login, skip_unchanged=False):
         ignore_list = []
-        if self.get_user(sync_login):
-            warn("User already exists (%s), recreating user" % sync_login)
-            user_path = "/api/node/mo/uni/userext/user-%s.json" % sync_login
-            resp = self.delete(user_path)
-            dbg("%s: %s" % (user_path, resp.text))
-
+        user_path = "/api/node/mo/uni/userext/user-%s.json" % sync_login
         for path, config in data:
             try:
                 if path in ignore_list:
                     continue
+                if path == user_path and self.get_user(sync_login):
+                    warn("User already exists (%s), recreating user" % sync_login)
+                    resp = self.delete(user_path)
+                    dbg("%s: %s" % (user_path, resp.text))
                 if config is not None:
+                    if skip_unchanged and not self.diff(path, config):
+                        dbg("%s: unchanged" % path)
+                        continue
                     resp = self.post(path, config)
                     self.check_resp(resp)
                     dbg("%s: %s" % (path, resp.text))
@@ -263,31 +418,37 @@ class Apic(object):
         if vrf_tenant not in ["common", system_id]:
             shared_resources.append("/api/mo/uni/tn-%s.json" % vrf_tenant)
 
+        index = MoIndex(data)
+        deleted = set()
         try:
             for path, config in data:
-                if path.split("/")[-1].startswith("instP-"):
-                    continue
-                if path not in shared_resources:
+                teardown = mo_teardown(config)
+                if teardown is not None:
+                    resp = self.post(path, json.dumps(teardown))
+                    self.check_resp(resp)
+                    dbg("%s: %s" % (path, resp.text))
+                elif path not in shared_resources:
                     resp = self.delete(path)
                     self.check_resp(resp)
                     dbg("%s: %s" % (path, resp.text))
                 else:
-                    if path == cluster_tenant_path:
-                        path += "?query-target=children"
-                        resp = self.get(path)
-                        self.check_resp(resp)
-                        respj = json.loads(resp.text)
-                        respj = respj["imdata"]
-                        for resp in respj:
-                            for val in resp.values():
-                                if 'rsTenantMonPol' not in val['attributes']['dn'] and 'svcCont' not in val['attributes']['dn']:
-                                    del_path = "/api/node/mo/" + val['attributes']['dn'] + ".json"
-                                    if 'name' in val['attributes']:
-                                        name = val['attributes']['name']
-                                        if (not old_naming) and (system_id in name):
-                                            resp = self.delete(del_path)
-                                            self.check_resp(resp)
-                                            dbg("%s: %s" % (del_path, resp.text))
+                    if path == cluster_tenant_path and not old_naming:
+                        # The APIC also has the children left by older
+                        # versions or configs; the generated ones, which
+                        # carry their DNs, are only used if it can't be read
+                        try:
+                            children = self.get_tenant_children(cluster_tenant_path)
+                        except Exception as e:
+                            dbg("Unable to read %s: %s" % (cluster_tenant_path, str(e)))
+                            children = [(dn, index.lookup(dn)['attributes'].get('name'))
+                                        for dn in index.children("uni/tn-%s" % cluster_tenant)]
+                        for dn, name in children:
+                            if name is not None and system_id in name and dn not in deleted:
+                                deleted.add(dn)
+                                del_path = "/api/node/mo/" + dn + ".json"
+                                resp = self.delete(del_path)
+                                self.check_resp(resp)
+                                dbg("%s: %s" % (del_path, resp.text))
             if old_naming:
                 for object in self.TENANT_OBJECTS:
                     del_path = "/api/node/mo/uni/tn-%s/%s.json" % (cluster_tenant, object)
@@ -308,6 +469,18 @@ class Apic(object):
         # Finally clean any stray resources in common
         self.clean_tagged_resources(system_id, tenant)
 
+    def get_tenant_children(self, path):
+        """Return (dn, name) of the children of a tenant to unprovision."""
+        resp = self.get(path + "?query-target=children")
+        self.check_resp(resp)
+        ret = []
+        for mo in json.loads(resp.text)["imdata"]:
+            for val in mo.values():
+                dn = val['attributes']['dn']
+                if 'rsTenantMonPol' not in dn and 'svcCont' not in dn:
+                    ret.append((dn, val['attributes'].get('name')))
+        return ret
+
     def get_apic_version(self):
         path = "/api/node/class/firmwareCtrlrRunning.json"
         version = 1.0
@@ -409,6 +582,455 @@ class Apic(object):
             err("Error in deleting tags: %s" % str(e))
 
 
+def config_get(config, path):
+    for key in path:
+        if not isinstance(config, dict) or key not in config:
+            return None
+        config = config[key]
+    return config
+
+
+def config_set(config, path, value):
+    for key in path[:-1]:
+        config = config.setdefault(key, {})
+    config[path[-1]] = copy.deepcopy(value)
+
+
+def template_leaves(a, b, tokens, loc=(), ret=None):
+    """Return (location, tokens) of the leaves where trees a and b differ.
+
+    Raises ValueError if the trees don't have the same shape.
+    """
+    if ret is None:
+        ret = []
+    if isinstance(a, dict):
+        if not isinstance(b, dict) or list(a.keys()) != list(b.keys()):
+            raise ValueError("tenant trees differ in shape at %s" % (loc,))
+        for k in a:
+            template_leaves(a[k], b[k], tokens, loc + (k,), ret)
+    elif isinstance(a, list):
+        if not isinstance(b, list) or len(a) != len(b):
+            raise ValueError("tenant trees differ in shape at %s" % (loc,))
+        for i, (x, y) in enumerate(zip(a, b)):
+            template_leaves(x, y, tokens, loc + (i,), ret)
+    elif a != b:
+        found = [token for token in tokens if isinstance(a, str) and token in a]
+        if not found:
+            raise ValueError("tenant trees differ outside the slots at %s" % (loc,))
+        ret.append((loc, found))
+    return ret
+
+
+class TenantTemplate(object):
+    """Tenant tree of a flavor with placeholders for per-cluster values.
+
+    The tree is compiled with two different sets of placeholders. Only
+    the leaves that differ between the two are filled in, so a literal
+    that happens to equal a placeholder is left alone.
+    """
+
+    def __init__(self, tree, alt_tree, slots):
+        self.text = json.dumps(tree)
+        self.slots = slots
+        self.leaves = template_leaves(
+            json.loads(self.text), json.loads(json.dumps(alt_tree)), [token for token, _ in slots])
+
+    def fill(self, config):
+        values = dict((token, config_get(config, path)) for token, path in self.slots)
+        tree = json.loads(self.text, object_pairs_hook=collections.OrderedDict)
+        for loc, tokens in self.leaves:
+            parent = tree
+            for key in loc[:-1]:
+                parent = parent[key]
+            leaf = parent[loc[-1]]
+            if leaf in values:
+                leaf = copy.deepcopy(values[leaf])
+            else:
+                for token in tokens:
+                    leaf = leaf.replace(token, "%s" % values[token])
+            parent[loc[-1]] = leaf
+        return tuple(tree)
+
+
+def mo_rn(klass, attributes):
+    fmt = MO_RN_FORMATS.get(klass)
+    if fmt is None:
+        return None
+    try:
+        return fmt.format(**attributes)
+    except KeyError:
+        return None
+
+
+def mo_dn(path, klass, attributes):
+    dn = attributes.get("dn")
+    if not dn:
+        rn = mo_rn(klass, attributes)
+        if rn is None or path is None:
+            return None
+        base = path_dn(path)
+        dn = base if base == rn or base.endswith("/" + rn) else "%s/%s" % (base, rn)
+    return dn
+
+
+def path_dn(path):
+    # "/api/node/mo/uni/tn-x.json?query" -> "uni/tn-x"
+    path = path.split("?")[0]
+    for prefix in ["/api/node/mo/", "/api/mo/"]:
+        if path.startswith(prefix):
+            path = path[len(prefix):]
+            break
+    if path.endswith(".json"):
+        path = path[:-len(".json")]
+    return path
+
+
+class MoIndex(object):
+    """DN index over generated MO trees.
+
+    DNs are computed locally from MO_RN_FORMATS, so generated objects can
+    be looked up by DN, or by class and name, without walking the trees
+    or querying the APIC. Objects of classes without a known RN are not
+    indexed, and neither are their children.
+    """
+
+    def __init__(self, data=None):
+        self.mos = collections.OrderedDict()
+        self.names = {}
+        for path, mo in data or []:
+            if mo is not None:
+                self.add(path, mo)
+
+    def add(self, path, data):
+        """Index a MO posted to path; returns its DN."""
+        if not isinstance(data, dict):
+            data = json.loads(data, object_pairs_hook=collections.OrderedDict)
+        klass, body = next(iter(data.items()))
+        dn = mo_dn(path, klass, body["attributes"])
+        if dn is None:
+            return None
+        self.index(dn, klass, body, None)
+        return dn
+
+    def index(self, dn, klass, body, parent):
+        self.mos[dn] = (klass, body, parent)
+        name = body["attributes"].get("name")
+        if name is not None:
+            self.names.setdefault((klass, name), []).append(dn)
+        for child in body.get("children", []):
+            child_klass, child_body = next(iter(child.items()))
+            rn = mo_rn(child_klass, child_body["attributes"])
+            if rn is not None:
+                self.index("%s/%s" % (dn, rn), child_klass, child_body, dn)
+
+    def lookup(self, dn):
+        """Return the body (attributes and children) of the MO at dn."""
+        mo = self.mos.get(dn)
+        return mo[1] if mo else None
+
+    def find(self, klass, name):
+        """Return the DNs of all MOs of a class with the given name."""
+        return self.names.get((klass, name), [])
+
+    def children(self, dn, klass=None):
+        return [k for k, v in self.mos.items()
+                if v[2] == dn and (klass is None or v[0] == klass)]
+
+    def add_child(self, dn, mo):
+        body = self.mos[dn][1]
+        body.setdefault("children", []).append(mo)
+        klass, child_body = next(iter(mo.items()))
+        rn = mo_rn(klass, child_body["attributes"])
+        if rn is not None:
+            self.index("%s/%s" % (dn, rn), klass, child_body, dn)
+
+    def remove(self, dn):
+        klass, body, parent = self.mos[dn]
+        if parent:
+            siblings = self.mos[parent][1]["children"]
+            for idx, child in enumerate(siblings):
+                if child.get(klass) is body:
+                    del siblings[idx]
+                    break
+        for child_dn in [k for k in self.mos if k == dn or k.startswith(dn + "/")]:
+            child_klass, child_body = self.mos.pop(child_dn)[:2]
+            name = child_body["attributes"].get("name")
+            if name is not None:
+                self.names[(child_klass, name)].remove(child_dn)
+
+
+def mo_teardown(mo):
+    """Teardown for a tree of existing MOs that we only add children to.
+
+    Objects posted with status "modified" are not ours, so they are kept;
+    the objects created beneath them are marked deleted. Returns None for
+    trees we own, which are deleted by path.
+    """
+    if mo is None:
+        return None
+    if not isinstance(mo, dict):
+        mo = json.loads(mo, object_pairs_hook=collections.OrderedDict)
+    klass, body = next(iter(mo.items()))
+    if body["attributes"].get("status") != "modified":
+        return None
+    attributes = collections.OrderedDict(body["attributes"])
+    children = []
+    for child in body.get("children", []):
+        teardown = mo_teardown(child)
+        if teardown is None:
+            child_klass, child_body = next(iter(child.items()))
+            child_attributes = collections.OrderedDict(child_body["attributes"])
+            child_attributes["status"] = "deleted"
+            teardown = aci_obj(child_klass, child_attributes.items())
+        children.append(teardown)
+    return aci_obj(klass, list(attributes.items()) + [("_children", children)])
+
+
+def mo_deps(mo):
+    """DNs of the objects that relations in a MO subtree point to."""
+    deps = set()
+    pending = [mo] if mo else []
+    while pending:
+        klass, body = next(iter(pending.pop().items()))
+        tdn = body["attributes"].get("tDn")
+        if tdn:
+            deps.add(tdn)
+        pending.extend(body.get("children", []))
+    return sorted(deps)
+
+
+MoFingerprint = collections.namedtuple("MoFingerprint", ["digest", "klass", "attributes", "children"])
+
+
+def mo_child_key(klass, attrs, keys=None):
+    """Key of a child whose class has no RN format, built from its content."""
+    if keys is None:
+        keys = [k for k in attrs if k not in MO_FINGERPRINT_IGNORE]
+    return "%s%s" % (klass, json.dumps(sorted((k, attrs.get(k)) for k in keys)))
+
+
+def mo_fingerprint(mo, reference=None):
+    """Merkle fingerprint of a MO subtree.
+
+    The digest covers the class, the config attributes and the digests of
+    the children, keyed by RN so that child order does not matter. Given
+    the fingerprint of a generated tree as reference, an APIC response is
+    projected onto the attributes and children present in the reference,
+    so defaults filled in by the APIC are not reported as drift.
+    """
+    if not isinstance(mo, dict):
+        mo = json.loads(mo, object_pairs_hook=collections.OrderedDict)
+    klass, body = next(iter(mo.items()))
+    attrs = body.get("attributes", {})
+    if reference is None:
+        keys = [k for k in attrs if k not in MO_FINGERPRINT_IGNORE]
+    else:
+        keys = [k for k, v in reference.attributes]
+    attributes = tuple(sorted((k, attrs.get(k)) for k in keys))
+
+    children = collections.OrderedDict()
+    for child in body.get("children", []):
+        child_klass, child_body = next(iter(child.items()))
+        child_attrs = child_body.get("attributes", {})
+        rn = mo_rn(child_klass, child_attrs)
+        if rn is None and reference is None:
+            rn = child_attrs.get("rn") or mo_child_key(child_klass, child_attrs)
+        elif rn is None:
+            rn = child_attrs.get("rn")
+            if rn not in reference.children:
+                # match by content against the reference children of the class
+                rn = next((key for key, fp in reference.children.items()
+                           if fp.klass == child_klass and
+                           key == mo_child_key(child_klass, child_attrs, [k for k, v in fp.attributes])), None)
+        if reference is None:
+            children[rn] = mo_fingerprint(child)
+        elif rn in reference.children:
+            children[rn] = mo_fingerprint(child, reference.children[rn])
+
+    content = [klass, attributes, sorted((rn, fp.digest) for rn, fp in children.items())]
+    digest = hashlib.sha256(json.dumps(content).encode("utf-8")).hexdigest()
+    return MoFingerprint(digest, klass, attributes, children)
+
+
+def mo_diff(generated, current, dn):
+    """DNs of the generated MOs that are missing or differ in current.
+
+    Only subtrees whose digests differ are descended into.
+    """
+    if current is None:
+        return [dn]
+    if generated.digest == current.digest:
+        return []
+    if generated.klass != current.klass or generated.attributes != current.attributes:
+        return [dn]
+    ret = []
+    for rn, child in generated.children.items():
+        ret.extend(mo_diff(child, current.children.get(rn), "%s/%s" % (dn, rn)))
+    return ret
+
+
+class TrackedConfig(dict):
+    """Config view that records the paths of the values read through it.
+
+    Reading a scalar or list records its path. Iterating over a dict or
+    copying it records the dict's path, making its whole subtree a
+    dependency. Writes go through to the underlying config.
+    """
+
+    def __init__(self, data, reads, path=()):
+        dict.__init__(self, data)
+        self._data = data
+        self._reads = reads
+        self._path = path
+        self._views = {}
+
+    def _read(self, key):
+        value = dict.__getitem__(self, key)
+        if not isinstance(value, dict):
+            self._reads.add(self._path + (key,))
+            return value
+        view = self._views.get(key)
+        if view is None or view._data is not value:
+            view = TrackedConfig(value, self._reads, self._path + (key,))
+            self._views[key] = view
+        return view
+
+    def __getitem__(self, key):
+        if not dict.__contains__(self, key):
+            self._reads.add(self._path + (key,))
+        return self._read(key)
+
+    def get(self, key, default=None):
+        if not dict.__contains__(self, key):
+            self._reads.add(self._path + (key,))
+            return default
+        return self._read(key)
+
+    def __contains__(self, key):
+        self._reads.add(self._path + (key,))
+        return dict.__contains__(self, key)
+
+    def __iter__(self):
+        self._reads.add(self._path)
+        return dict.__iter__(self)
+
+    def __len__(self):
+        # Also covers truthiness tests such as {% if config.a.b %}
+        self._reads.add(self._path)
+        return dict.__len__(self)
+
+    def keys(self):
+        self._reads.add(self._path)
+        return dict.keys(self)
+
+    def values(self):
+        self._reads.add(self._path)
+        return dict.values(self)
+
+    def items(self):
+        self._reads.add(self._path)
+        return dict.items(self)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self._data[key] = value
+        self._views.pop(key, None)
+
+    def __deepcopy__(self, memo):
+        self._reads.add(self._path)
+        return copy.deepcopy(self._data, memo)
+
+
+def config_digest(config, paths):
+    values = [[list(path), config_get(config, path)] for path in paths]
+    text = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class RegenState(object):
+    """Outputs of previous runs, with the config paths they were built from.
+
+    An output is reused as long as the values at its recorded paths are
+    unchanged. APIC objects are tracked separately by the digest of what
+    was last pushed, so only objects that changed since are posted again.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self.pushed = set()
+        self.values = {}
+        self.used = {}
+        if path and os.path.exists(path):
+            with open(path, "r") as fh:
+                state = json.load(fh, object_pairs_hook=collections.OrderedDict)
+            self.entries = state.get("entries", {})
+            self.pushed = set(state.get("pushed", []))
+            self.values = state.get("values", {})
+
+    def sticky(self, name, value):
+        """Return the value recorded by the previous run, else record value."""
+        return self.values.setdefault(name, value)
+
+    def unchanged(self, kind, config):
+        """Whether the previous run had outputs of kind and all of them are
+        still up to date for config."""
+        entries = [entry for key, entry in self.entries.items() if json.loads(key)[0] == kind]
+        return bool(entries) and all(entry["digest"] == config_digest(config, entry["deps"])
+                                     for entry in entries)
+
+    def output(self, key):
+        entry = self.entries.get(key)
+        return entry["output"] if entry is not None else None
+
+    def record(self, name, value):
+        self.values[name] = value
+        return value
+
+    def cached(self, key, config, produce):
+        entry = self.entries.get(key)
+        if entry is not None and entry["digest"] == config_digest(config, entry["deps"]):
+            self.used[key] = entry
+            return entry["output"]
+        reads = set()
+        output = produce(TrackedConfig(config, reads))
+        deps = sorted(reads)
+        self.used[key] = {
+            "deps": [list(path) for path in deps],
+            "digest": config_digest(config, deps),
+            "output": output,
+        }
+        return output
+
+    @staticmethod
+    def push_digest(path, config):
+        text = json.dumps([path, config])
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def unpushed(self, data):
+        return [(path, config) for path, config in data
+                if self.push_digest(path, config) not in self.pushed]
+
+    def mark_pushed(self, data):
+        self.pushed = set(self.push_digest(path, config) for path, config in data)
+
+    def save(self):
+        state = collections.OrderedDict([
+            ("entries", self.used),
+            ("pushed", sorted(self.pushed)),
+            ("values", self.values),
+        ])
+        # The state holds the sync password, keep it private to the user
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".")
+        try:
+            with os.fdopen(fd, "w") as fh:
+                json.dump(state, fh)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
 class ApicKubeConfig(object):
 
     ACI_PREFIX = aci_prefix
@@ -418,6 +1040,7 @@ class ApicKubeConfig(object):
         self.use_kubeapi_vlan = True
         self.tenant_generator = "kube_tn"
         self.associate_aep_to_nested_inside_domain = False
+        self.state = None
 
     def get_nested_domain_type(self):
         inside = self.config["aci_config"]["vmm_domain"].get("nested_inside")
@@ -429,10 +1052,37 @@ class ApicKubeConfig(object):
         return t
 
     @staticmethod
-    def save_config(config, outfilep):
+    def save_config(config, outfilep, fmt="text", meta=None):
+        if fmt == "ndjson" and meta is not None:
+            print(json.dumps({"meta": meta}, separators=(",", ":")), file=outfilep)
         for path, data in config:
-            print(path, file=outfilep)
-            print(data, file=outfilep)
+            if fmt == "ndjson":
+                payload = None
+                if data is not None:
+                    payload = json.loads(data, object_pairs_hook=collections.OrderedDict)
+                record = collections.OrderedDict([
+                    ("path", path),
+                    ("payload", payload),
+                    ("deps", mo_deps(payload)),
+                ])
+                print(json.dumps(record, separators=(",", ":")), file=outfilep)
+            else:
+                print(path, file=outfilep)
+                print(data, file=outfilep)
+
+    @staticmethod
+    def load_config(infilep):
+        """Stream (path, data) pairs from a plan saved in ndjson format."""
+        for line in infilep:
+            if not line.strip():
+                continue
+            record = json.loads(line, object_pairs_hook=collections.OrderedDict)
+            if "meta" in record:
+                continue
+            data = record["payload"]
+            if data is not None:
+                data = json.dumps(data, indent=4, separators=(",", ": "))
+            yield record["path"], data
 
     def get_config(self, apic_version):
         def assert_attributes_is_first_key(data):
@@ -456,29 +1106,105 @@ class ApicKubeConfig(object):
                     data.append((path, None))
 
         data = []
-        update(data, self.pdom_pool())
-        update(data, self.vdom_pool())
-        update(data, self.mcast_pool())
-        update(data, self.phys_dom())
-        update(data, self.kube_dom(apic_version))
-        update(data, self.nested_dom())
-        update(data, self.associate_aep())
-        update(data, self.opflex_cert())
+        update(data, self.generate("pdom_pool"))
+        update(data, self.generate("vdom_pool"))
+        update(data, self.generate("mcast_pool"))
+        update(data, self.generate("phys_dom"))
+        update(data, self.generate("kube_dom", apic_version))
+        update(data, self.generate("nested_dom"))
+        update(data, self.generate("associate_aep"))
+        update(data, self.generate("opflex_cert"))
         self.apic_version = apic_version
         if apic_version >= 5.0:
-            update(data, self.cluster_info())
+            update(data, self.generate("cluster_info"))
 
-        update(data, self.l3out_tn())
-        update(data, getattr(self, self.tenant_generator)(self.config['flavor']))
-        update(data, self.add_apivlan_for_second_portgroup())
-        update(data, self.nested_dom_second_portgroup())
-        for l3out_instp in self.config["aci_config"]["l3out"]["external_networks"]:
-            update(data, self.l3out_contract(l3out_instp))
+        update(data, self.generate("l3out_tn"))
+        update(data, self.generate("tenant_config", self.config['flavor']))
+        update(data, self.generate("add_apivlan_for_second_portgroup"))
+        update(data, self.generate("nested_dom_second_portgroup"))
+        update(data, self.generate("l3out_contracts"))
 
-        update(data, self.kube_user())
-        update(data, self.kube_cert())
+        update(data, self.generate("kube_user"))
+        update(data, self.generate("kube_cert"))
         return data
 
+    def generate(self, name, *args):
+        """Run a generator, or reuse its previous output if its inputs are unchanged."""
+        generator = getattr(self, name)
+        if self.state is None:
+            return generator(*args)
+        options = dict((k, v) for k, v in vars(self).items() if k not in ["config", "state"])
+        key = json.dumps(["apic", name, args, options], sort_keys=True, default=str)
+
+        def produce(config):
+            saved, self.config = self.config, config
+            try:
+                return generator(*args)
+            finally:
+                self.config = saved
+        return self.state.cached(key, self.config, produce)
+
+    def tenant_template_skeleton(self, alt=0):
+        """Build the reduced config a tenant template is compiled from.
+
+        Returns the cache key and the skeleton config, which has
+        placeholders for the slot values and only the shape keys besides.
+        alt selects the set of placeholders.
+        """
+        skeleton = {}
+        slots = []
+        literals = []
+        for idx, path in enumerate(TENANT_TEMPLATE_SLOTS):
+            value = config_get(self.config, path)
+            if path in TENANT_TEMPLATE_SUBNETS and value is not None:
+                rtr = value.split("/")[0]
+                token = TENANT_TEMPLATE_SUBNETS[path][alt][ipaddress.ip_address(rtr).version]
+            elif isinstance(value, (str, int)) and value not in TENANT_TEMPLATE_LITERALS:
+                token = TENANT_TEMPLATE_TOKENS[alt] % idx
+            else:
+                config_set(skeleton, path, value)
+                literals.append(value)
+                continue
+            config_set(skeleton, path, token)
+            slots.append((token, path))
+        shape = []
+        for path in TENANT_TEMPLATE_SHAPE:
+            value = config_get(self.config, path)
+            if value is not None:
+                config_set(skeleton, path, value)
+            elif len(path) > 1 and isinstance(config_get(self.config, path[:-1]), dict):
+                parent = skeleton
+                for k in path[:-1]:
+                    parent = parent.setdefault(k, {})
+            shape.append(value)
+        options = dict((k, v) for k, v in vars(self).items() if k not in ["config", "state"])
+        key = json.dumps([options, slots, literals, shape], sort_keys=True, default=str)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest(), skeleton, slots
+
+    def tenant_config(self, flavor):
+        """Generate the cluster tenant from the compiled flavor template."""
+        generator = getattr(self, self.tenant_generator)
+        key, skeleton, slots = self.tenant_template_skeleton()
+        template = tenant_templates.get(key)
+        if template is None:
+            _, alt_skeleton, _ = self.tenant_template_skeleton(alt=1)
+            try:
+                trees = []
+                for config in (skeleton, alt_skeleton):
+                    compiler = copy.copy(self)
+                    compiler.config = config
+                    trees.append(getattr(compiler, self.tenant_generator)(flavor))
+                template = TenantTemplate(trees[0], trees[1], slots)
+            except Exception as e:
+                # Generator reads config outside of the template keys, or
+                # uses the slot values beyond naming things
+                dbg("Tenant template not compiled for %s: %s" % (flavor, e))
+                return generator(flavor)
+            while len(tenant_templates) >= TENANT_TEMPLATES_MAX:
+                tenant_templates.popitem(last=False)
+            tenant_templates[key] = template
+        return template.fill(self.config)
+
     def annotateApicObjects(self, data, pre_existing_tenant=False, ann=aciContainersOwnerAnnotation):
         # apic objects are dicts of length 1
         assert(len(data) <= 1)
@@ -2512,14 +3238,37 @@ class ApicKubeConfig(object):
         self.annotateApicObjects(data)
         return path, data, flt, brc
 
-    def l3out_contract(self, l3out_instp):
-        system_id = self.config["aci_config"]["system_id"]
+    def l3out_contracts(self):
+        """Provide the l3out contract on all external networks in one POST.
+
+        The l3out and its external networks are not ours, so they are
+        posted as modified; only the contract relations are created.
+        """
         vrf_tenant = self.config["aci_config"]["vrf"]["tenant"]
         l3out = self.config["aci_config"]["l3out"]["name"]
+        external_networks = self.config["aci_config"]["l3out"]["external_networks"]
+        if not external_networks:
+            return None
+
+        path = "/api/mo/uni/tn-%s/out-%s.json" % (vrf_tenant, l3out)
+        children = []
+        for l3out_instp in external_networks:
+            children.append(aci_obj("l3extInstP", [
+                ("name", l3out_instp),
+                ("status", "modified"),
+                ("_children", [self.l3out_contract(l3out_instp)]),
+            ]))
+        data = aci_obj("l3extOut", [
+            ("name", l3out),
+            ("status", "modified"),
+            ("_children", children),
+        ])
+        return path, data
+
+    def l3out_contract(self, l3out_instp):
+        system_id = self.config["aci_config"]["system_id"]
         l3out_rsprov_name = "%s-l3out-allow-all" % system_id
 
-        pathc = (vrf_tenant, l3out, l3out_instp)
-        path = "/api/mo/uni/tn-%s/out-%s/instP-%s.json" % pathc
         data = collections.OrderedDict(
             [
                 (
@@ -2541,10 +3290,8 @@ class ApicKubeConfig(object):
             ]
         )
 
-        rsprovc = (vrf_tenant, l3out, l3out_instp, l3out_rsprov_name)
-        rsprov = "/api/mo/uni/tn-%s/out-%s/instP-%s/rsprov-%s.json" % rsprovc
         self.annotateApicObjects(data)
-        return path, data, rsprov
+        return data
 
     def kube_user(self):
         name = self.config["aci_config"]["sync_login"]["username"]
@@ -4939,6 +5686,12 @@ class ApicKubeConfig(object):
             ]
         )
 
+        tn_dn = "uni/tn-%s" % tn_name
+        ap_dn = "%s/ap-%s" % (tn_dn, app_profile)
+        node_epg_dn = "%s/epg-%s" % (ap_dn, node_epg_name)
+        node_bd_dn = "%s/BD-%s" % (tn_dn, node_bd_name)
+        index = MoIndex([(path, data)])
+
         # If flavor requires adding kubeapi VLAN, add corresponding
         # fvRsDomAtt object to node-epg
         if self.use_kubeapi_vlan:
@@ -4970,28 +5723,20 @@ class ApicKubeConfig(object):
                     )
                 ]
             )
-            for i, child in enumerate(data["fvTenant"]["children"]):
-                if "fvAp" in child.keys():
-                    for j, ap_child in enumerate(child["fvAp"]["children"]):
-                        if "fvAEPg" in ap_child.keys() and ap_child["fvAEPg"]["attributes"]["name"] == node_epg_name:
-                            epg_object = ap_child["fvAEPg"]["children"]
-                            epg_object.append(kubeapi_dom_obj)
+            index.add_child(node_epg_dn, kubeapi_dom_obj)
 
         # If flavor requires not creating node subnet, remove it from
         # the data object
         if disable_node_subnet_creation:
-            for i, child in enumerate(data["fvTenant"]["children"]):
-                if "fvBD" in child.keys() and child["fvBD"]["attributes"]["name"] == node_bd_name:
-                    bd_object = child["fvBD"]["children"]
-                    for bd_child in bd_object:
-                        if 'fvSubnet' in bd_child.keys():
-                            bd_object.remove(bd_child)
+            for subnet_dn in index.children(node_bd_dn, "fvSubnet"):
+                index.remove(subnet_dn)
 
         if eade is not True:
-            del data["fvTenant"]["children"][2]["fvBD"]["children"][2]
+            index.remove("%s/BD-%spod-bd/rsBDToOut-%s" % (tn_dn, bd_prefix, kube_l3out))
 
         if v6subnet is True:
-            data["fvTenant"]["children"].append(
+            index.add_child(
+                tn_dn,
                 collections.OrderedDict(
                     [
                         (
@@ -5019,7 +5764,6 @@ class ApicKubeConfig(object):
         # If dhcp_relay_label is present, attach the label to the kube-node-bd
         if "dhcp_relay_label" in self.config["aci_config"]:
             dbg("Handle DHCP Relay Label")
-            children = data["fvTenant"]["children"]
             dhcp_relay_label = self.config["aci_config"]["dhcp_relay_label"]
             attr = collections.OrderedDict(
                 [
@@ -5038,15 +5782,11 @@ class ApicKubeConfig(object):
                     )
                 ]
             )
-            # lookup kube-node-bd data
-            for child in children:
-                if "fvBD" in child:
-                    if child["fvBD"]["attributes"]["name"] == "%snode-bd" % bd_prefix:
-                        child["fvBD"]["children"].append(attr)
-                        break
+            index.add_child(node_bd_dn, attr)
 
         for epg in self.config["aci_config"].get("custom_epgs", []):
-            data["fvTenant"]["children"][0]["fvAp"]["children"].append(
+            index.add_child(
+                ap_dn,
                 {
                     "fvAEPg": {
                         "attributes": {
@@ -5068,11 +5808,11 @@ class ApicKubeConfig(object):
                 dns_entries = self.config["aci_config"]["dns_entries"]
             if vmm_type == "OpenShift":
                 openshift_flavor_specific_handling(data, items, system_id, old_naming, self.ACI_PREFIX, default_provide_api,
-                                                   kube_api_entries, api_filter_prefix, dns_entries, filter_prefix)
+                                                   kube_api_entries, api_filter_prefix, dns_entries, filter_prefix, index=index)
             elif flavor == "docker-ucp-3.0":
-                dockerucp_flavor_specific_handling(data, items)
+                dockerucp_flavor_specific_handling(data, items, api_filter_prefix, index=index)
             elif flavor == "RKE-1.2.3":
-                rke_flavor_specific_handling(aci_prefix, data, items, self.config["rke_config"])
+                rke_flavor_specific_handling(aci_prefix, data, items, self.config["rke_config"], api_filter_prefix, index=index)
         self.annotateApicObjects(data, pre_existing_tenant)
         return path, data
 
@@ -5257,16 +5997,26 @@ class ApicKubeConfig(object):
 
 
 def openshift_flavor_specific_handling(data, items, system_id, old_naming, aci_prefix, default_provide_api,
-                                       kube_api_entries, api_filter_prefix, dns_entries, dns_filter_prefix):
+                                       kube_api_entries, api_filter_prefix, dns_entries, dns_filter_prefix, index=None):
     if items is None or len(items) == 0:
         err("Error in getting items for flavor")
 
+    if index is None:
+        index = MoIndex([(None, data)])
+    tn_dn = data['fvTenant']['attributes']['dn']
+
     if old_naming:
         api_contract_name = "kube-api"
         dns_contract_name = "dns"
+        epg_prefix = "kube-"
     else:
         api_contract_name = "%s%s-api" % (aci_prefix, system_id)
         dns_contract_name = '%s%s-dns' % (aci_prefix, system_id)
+        epg_prefix = aci_prefix
+    default_epg, system_epg, nodes_epg = [epg_prefix + name for name in ["default", "system", "nodes"]]
+
+    def add_to_epg(epg, mo):
+        index.add_child(index.find("fvAEPg", epg)[0], mo)
 
     # kube-systems needs to provide kube-api contract
     provide_kube_api_contract_os = collections.OrderedDict(
@@ -5291,10 +6041,10 @@ def openshift_flavor_specific_handling(data, items, system_id, old_naming, aci_p
             )
         ]
     )
-    data['fvTenant']['children'][0]['fvAp']['children'][1]['fvAEPg']['children'].append(provide_kube_api_contract_os)
+    add_to_epg(system_epg, provide_kube_api_contract_os)
 
     if default_provide_api:
-        data['fvTenant']['children'][0]['fvAp']['children'][0]['fvAEPg']['children'].append(provide_kube_api_contract_os)
+        add_to_epg(default_epg, provide_kube_api_contract_os)
 
     # special case for dns contract
     consume_dns_contract_os = collections.OrderedDict(
@@ -5319,7 +6069,7 @@ def openshift_flavor_specific_handling(data, items, system_id, old_naming, aci_p
             )
         ]
     )
-    data['fvTenant']['children'][0]['fvAp']['children'][1]['fvAEPg']['children'].append(consume_dns_contract_os)
+    add_to_epg(system_epg, consume_dns_contract_os)
 
     # add new contract
     for item in items:
@@ -5369,37 +6119,12 @@ def openshift_flavor_specific_handling(data, items, system_id, old_naming, aci_p
             ]
         )
 
-        if old_naming:
-            # 0 = kube-default, 1 = kube-system, 2 = kube-nodes
-            if 'kube-default' in item['consumed']:
-                data['fvTenant']['children'][0]['fvAp']['children'][0]['fvAEPg']['children'].append(consume_os_contract)
-            if 'kube-system' in item['consumed']:
-                data['fvTenant']['children'][0]['fvAp']['children'][1]['fvAEPg']['children'].append(consume_os_contract)
-            if 'kube-nodes' in item['consumed']:
-                data['fvTenant']['children'][0]['fvAp']['children'][2]['fvAEPg']['children'].append(consume_os_contract)
-
-            if 'kube-default' in item['provided']:
-                data['fvTenant']['children'][0]['fvAp']['children'][0]['fvAEPg']['children'].append(provide_os_contract)
-            if 'kube-system' in item['provided']:
-                data['fvTenant']['children'][0]['fvAp']['children'][1]['fvAEPg']['children'].append(provide_os_contract)
-            if 'kube-nodes' in item['provided']:
-                data['fvTenant']['children'][0]['fvAp']['children'][2]['fvAEPg']['children'].append(provide_os_contract)
-
-        else:
-            # 0 = kube-default, 1 = kube-system, 2 = kube-nodes
-            if ('%sdefault' % aci_prefix) in item['consumed']:
-                data['fvTenant']['children'][0]['fvAp']['children'][0]['fvAEPg']['children'].append(consume_os_contract)
-            if ('%ssystem' % aci_prefix) in item['consumed']:
-                data['fvTenant']['children'][0]['fvAp']['children'][1]['fvAEPg']['children'].append(consume_os_contract)
-            if ('%snodes' % aci_prefix) in item['consumed']:
-                data['fvTenant']['children'][0]['fvAp']['children'][2]['fvAEPg']['children'].append(consume_os_contract)
-
-            if ('%sdefault' % aci_prefix) in item['provided']:
-                data['fvTenant']['children'][0]['fvAp']['children'][0]['fvAEPg']['children'].append(provide_os_contract)
-            if ('%ssystem' % aci_prefix) in item['provided']:
-                data['fvTenant']['children'][0]['fvAp']['children'][1]['fvAEPg']['children'].append(provide_os_contract)
-            if ('%snodes' % aci_prefix) in item['provided']:
-                data['fvTenant']['children'][0]['fvAp']['children'][2]['fvAEPg']['children'].append(provide_os_contract)
+        for epg in [default_epg, system_epg, nodes_epg]:
+            if epg in item['consumed']:
+                add_to_epg(epg, consume_os_contract)
+        for epg in [default_epg, system_epg, nodes_epg]:
+            if epg in item['provided']:
+                add_to_epg(epg, provide_os_contract)
 
     # add new contract and subject
     for item in items:
@@ -5482,7 +6207,7 @@ def openshift_flavor_specific_handling(data, items, system_id, old_naming, aci_p
                 )
             ]
         )
-        data['fvTenant']['children'].append(os_contract)
+        index.add_child(tn_dn, os_contract)
 
     # add filter and entries to that subject
     for item in items:
@@ -5562,125 +6287,126 @@ def openshift_flavor_specific_handling(data, items, system_id, old_naming, aci_p
             )
             os_filter['vzFilter']['children'].append(child)
 
-        data['fvTenant']['children'].append(os_filter)
+        index.add_child(tn_dn, os_filter)
 
     # Add http, https, etcd entries to kube-api filter for OpenShift 4.3
     if kube_api_entries:
-        tenant_children = data['fvTenant']['children']
         api_filter_name = "%sapi-filter" % api_filter_prefix
         filter_entries = []
-        for child in tenant_children:
-            if 'vzFilter' in child.keys() and child['vzFilter']['attributes']['name'] == api_filter_name:
-                for entry in kube_api_entries:
-                    apic_entry = collections.OrderedDict(
-                        [
-                            (
-                                "vzEntry",
-                                collections.OrderedDict(
-                                    [
-                                        (
-                                            "attributes",
-                                            collections.OrderedDict(
-                                                [
-                                                    (
-                                                        "name",
-                                                        "openshift-%s" % entry['name'],
-                                                    ),
-                                                    (
-                                                        "etherT",
-                                                        entry["etherT"],
-                                                    ),
-                                                    (
-                                                        "prot",
-                                                        entry["prot"],
-                                                    ),
-                                                    (
-                                                        "dFromPort",
-                                                        str(entry["range"][0]),
-                                                    ),
-                                                    (
-                                                        "dToPort",
-                                                        str(entry["range"][1]),
-                                                    ),
-                                                    (
-                                                        "stateful",
-                                                        entry["stateful"],
-                                                    ),
-                                                    (
-                                                        "tcpRules",
-                                                        "",
-                                                    ),
-                                                ]
-                                            ),
-                                        )
-                                    ]
-                                ),
-                            )
-                        ]
-                    )
-                    filter_entries.append(apic_entry)
-                child['vzFilter']['children'] = child['vzFilter']['children'] + filter_entries
-                break
+        for filter_dn in index.find("vzFilter", api_filter_name):
+            for entry in kube_api_entries:
+                apic_entry = collections.OrderedDict(
+                    [
+                        (
+                            "vzEntry",
+                            collections.OrderedDict(
+                                [
+                                    (
+                                        "attributes",
+                                        collections.OrderedDict(
+                                            [
+                                                (
+                                                    "name",
+                                                    "openshift-%s" % entry['name'],
+                                                ),
+                                                (
+                                                    "etherT",
+                                                    entry["etherT"],
+                                                ),
+                                                (
+                                                    "prot",
+                                                    entry["prot"],
+                                                ),
+                                                (
+                                                    "dFromPort",
+                                                    str(entry["range"][0]),
+                                                ),
+                                                (
+                                                    "dToPort",
+                                                    str(entry["range"][1]),
+                                                ),
+                                                (
+                                                    "stateful",
+                                                    entry["stateful"],
+                                                ),
+                                                (
+                                                    "tcpRules",
+                                                    "",
+                                                ),
+                                            ]
+                                        ),
+                                    )
+                                ]
+                            ),
+                        )
+                    ]
+                )
+                filter_entries.append(apic_entry)
+            for entry in filter_entries:
+                index.add_child(filter_dn, entry)
+            break
 
     if dns_entries:
         dns_filter_name = "%sdns-filter" % dns_filter_prefix
-        tenant_children = data['fvTenant']['children']
         filter_entries = []
-        for child in tenant_children:
-            if 'vzFilter' in child.keys() and child['vzFilter']['attributes']['name'] == dns_filter_name:
-                for entry in dns_entries:
-                    apic_entry = collections.OrderedDict(
-                        [
-                            (
-                                "vzEntry",
-                                collections.OrderedDict(
-                                    [
-                                        (
-                                            "attributes",
-                                            collections.OrderedDict(
-                                                [
-                                                    (
-                                                        "name",
-                                                        entry['name'],
-                                                    ),
-                                                    (
-                                                        "etherT",
-                                                        entry["etherT"],
-                                                    ),
-                                                    (
-                                                        "prot",
-                                                        entry["prot"],
-                                                    ),
-                                                    (
-                                                        "dFromPort",
-                                                        str(entry["range"][0]),
-                                                    ),
-                                                    (
-                                                        "dToPort",
-                                                        str(entry["range"][1]),
-                                                    ),
-                                                    (
-                                                        "stateful",
-                                                        entry["stateful"],
-                                                    ),
-                                                    (
-                                                        "tcpRules",
-                                                        "",
-                                                    ),
-                                                ]
-                                            ),
-                                        )
-                                    ]
-                                ),
-                            )
-                        ]
-                    )
-                    filter_entries.append(apic_entry)
-                child['vzFilter']['children'] = child['vzFilter']['children'] + filter_entries
-                break
+        for filter_dn in index.find("vzFilter", dns_filter_name):
+            for entry in dns_entries:
+                apic_entry = collections.OrderedDict(
+                    [
+                        (
+                            "vzEntry",
+                            collections.OrderedDict(
+                                [
+                                    (
+                                        "attributes",
+                                        collections.OrderedDict(
+                                            [
+                                                (
+                                                    "name",
+                                                    entry['name'],
+                                                ),
+                                                (
+                                                    "etherT",
+                                                    entry["etherT"],
+                                                ),
+                                                (
+                                                    "prot",
+                                                    entry["prot"],
+                                                ),
+                                                (
+                                                    "dFromPort",
+                                                    str(entry["range"][0]),
+                                                ),
+                                                (
+                                                    "dToPort",
+                                                    str(entry["range"][1]),
+                                                ),
+                                                (
+                                                    "stateful",
+                                                    entry["stateful"],
+                                                ),
+                                                (
+                                                    "tcpRules",
+                                                    "",
+                                                ),
+                                            ]
+                                        ),
+                                    )
+                                ]
+                            ),
+                        )
+                    ]
+                )
+                filter_entries.append(apic_entry)
+            for entry in filter_entries:
+                index.add_child(filter_dn, entry)
+            break
 
 
-def dockerucp_flavor_specific_handling(data, ports):
+def dockerucp_flavor_specific_handling(data, ports, api_filter_prefix, index=None):
+    if index is None:
+        index = MoIndex([(None, data)])
+    api_filter_dn = index.find("vzFilter", "%sapi-filter" % api_filter_prefix)[0]
 
     if ports is None or len(ports) == 0:
         err("Error in getting ports for flavor")
@@ -5732,10 +6458,14 @@ def dockerucp_flavor_specific_handling(data, ports):
                     )
                 ]
             )
-            data['fvTenant']['children'][7]['vzFilter']['children'].append(extra_port)
+            index.add_child(api_filter_dn, extra_port)
 
 
-def rke_flavor_specific_handling(aci_prefix, data, ports, rke_config):
+def rke_flavor_specific_handling(aci_prefix, data, ports, rke_config, api_filter_prefix, index=None):
+    if index is None:
+        index = MoIndex([(None, data)])
+    tn_dn = data['fvTenant']['attributes']['dn']
+    api_filter_dn = index.find("vzFilter", "%sapi-filter" % api_filter_prefix)[0]
 
     if ports is None or len(ports) == 0:
         err("Error in getting ports for flavor")
@@ -5787,7 +6517,7 @@ def rke_flavor_specific_handling(aci_prefix, data, ports, rke_config):
                     )
                 ]
             )
-            data['fvTenant']['children'][7]['vzFilter']['children'].append(extra_port)
+            index.add_child(api_filter_dn, extra_port)
 
     if rke_config is not None:
         for ctrct in rke_config["contracts"]:
@@ -5871,7 +6601,7 @@ def rke_flavor_specific_handling(aci_prefix, data, ports, rke_config):
                     )
                 ]
             )
-            data['fvTenant']['children'].append(contract)
+            index.add_child(tn_dn, contract)
             provide_rke_contract = collections.OrderedDict(
                 [
                     (
@@ -5917,15 +6647,11 @@ def rke_flavor_specific_handling(aci_prefix, data, ports, rke_config):
                 ]
             )
             for provider in ctrct['provided']:
-                for i, child in enumerate(data['fvTenant']['children'][0]['fvAp']['children']):
-                    if data['fvTenant']['children'][0]['fvAp']['children'][i]['fvAEPg']['attributes']['name'] == provider:
-                        data['fvTenant']['children'][0]['fvAp']['children'][i]['fvAEPg']['children'].append(provide_rke_contract)
-                        break
+                for epg_dn in index.find("fvAEPg", provider)[:1]:
+                    index.add_child(epg_dn, provide_rke_contract)
             for consumer in ctrct['consumed']:
-                for i, child in enumerate(data['fvTenant']['children'][0]['fvAp']['children']):
-                    if data['fvTenant']['children'][0]['fvAp']['children'][i]['fvAEPg']['attributes']['name'] == consumer:
-                        data['fvTenant']['children'][0]['fvAp']['children'][i]['fvAEPg']['children'].append(consume_rke_contract)
-                        break
+                for epg_dn in index.find("fvAEPg", consumer)[:1]:
+                    index.add_child(epg_dn, consume_rke_contract)
 
         for i, filter in enumerate(rke_config["filters"]):
             filt_entry = collections.OrderedDict(
@@ -6002,7 +6728,7 @@ def rke_flavor_specific_handling(aci_prefix, data, ports, rke_config):
                 ]
             )
             filt_entry['vzFilter']['children'].append(filt_child)
-            data['fvTenant']['children'].append(filt_entry)
+            index.add_child(tn_dn, filt_entry)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,6 @@
 from __future__ import print_function, unicode_literals
 
+import concurrent.futures
 import ipaddress
 import json
 import os
@@ -11,10 +12,15 @@ import time
 import tempfile
 if __package__ is None or __package__ == '':
     import kafka_cert
-    from apic_provision import ApicKubeConfig
+    from apic_provision import ApicKubeConfig, aci_obj
 else:
     from . import kafka_cert
-    from .apic_provision import ApicKubeConfig
+    from .apic_provision import ApicKubeConfig, aci_obj
+
+# User filters and contracts are posted in tenant-level batches of
+# this many objects, concurrently when there is more than one batch.
+CAPIC_CONTRACT_BATCH = 200
+CAPIC_CONTRACT_WORKERS = 4
 
 
 def gwToSubnet(gw):
@@ -379,15 +385,52 @@ class CloudProvision(object):
         return self.configurator.cloudCidr(ccp_name, cidr, [b_subnet, n_subnet, t_subnet], "no")
 
     def setupCapicContractsInline(self):
-        # setup filters
-        for f in self.config["aci_config"]["filters"]:
-            path, data = self.configurator.make_filter(f)
-            self.postIt(path, data)
+        # filters first, so contracts can refer to them
+        filters = [self.configurator.make_filter(f) for f in self.config["aci_config"]["filters"]]
+        contracts = [self.configurator.make_contract(c) for c in self.config["aci_config"]["contracts"]]
+        seen = set()
+        phases = []
+        for mos in (filters, contracts):
+            unique = []
+            for path, data in mos:
+                key = json.dumps([path, data], sort_keys=True)
+                if key not in seen:
+                    seen.add(key)
+                    unique.append((path, data))
+            phases.append(unique)
 
-        # setup contracts
-        for f in self.config["aci_config"]["contracts"]:
-            path, data = self.configurator.make_contract(f)
-            self.postIt(path, data)
+        if self.args.delete:
+            for unique in phases:
+                for path, data in unique:
+                    self.deleter.record(path, data)
+            return "", None
+
+        annStr = self.deleter.getAnnStr()
+        for unique in phases:
+            for path, data in unique:
+                self.configurator.annotateApicObjects(data, ann=annStr)
+
+        # a single post creates the filters and the contracts together
+        if sum(len(unique) for unique in phases) <= CAPIC_CONTRACT_BATCH:
+            phases = [phases[0] + phases[1]]
+
+        # the tenant is only a container here, so it is not annotated
+        tn_name = self.config["aci_config"]["cluster_tenant"]
+        tn_path = "/api/mo/uni/tn-%s.json" % tn_name
+        for unique in phases:
+            posts = []
+            for i in range(0, len(unique), CAPIC_CONTRACT_BATCH):
+                children = [data for path, data in unique[i:i + CAPIC_CONTRACT_BATCH]]
+                posts.append(aci_obj("fvTenant", [('name', tn_name), ('status', "modified"), ('_children', children)]))
+
+            # every filter batch completes before any contract batch is posted
+            if len(posts) == 1:
+                self.postMo(tn_path, posts[0])
+            elif posts:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=CAPIC_CONTRACT_WORKERS) as executor:
+                    futures = [executor.submit(self.postMo, tn_path, data) for data in posts]
+                    for future in futures:
+                        future.result()
 
         return "", None
 
@@ -399,6 +442,9 @@ class CloudProvision(object):
         # annotate before posting
         annStr = self.deleter.getAnnStr()
         self.configurator.annotateApicObjects(data, ann=annStr)
+        self.postMo(path, data)
+
+    def postMo(self, path, data):
         if self.args.debug:
             print("Path: {}".format(path))
             print("data: {}".format(data))
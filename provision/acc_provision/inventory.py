@@ -0,0 +1,163 @@
+from __future__ import print_function, unicode_literals
+
+import hashlib
+import ipaddress
+import sqlite3
+import ssl
+import time
+
+INVENTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS clusters (
+    system_id TEXT PRIMARY KEY,
+    flavor TEXT,
+    tenant TEXT,
+    vrf_tenant TEXT,
+    vrf TEXT,
+    l3out TEXT,
+    cert_fingerprint TEXT,
+    plan_hash TEXT,
+    updated REAL
+);
+CREATE TABLE IF NOT EXISTS vlans (
+    system_id TEXT,
+    field TEXT,
+    first INTEGER,
+    last INTEGER
+);
+CREATE TABLE IF NOT EXISTS subnets (
+    system_id TEXT,
+    field TEXT,
+    subnet TEXT,
+    version INTEGER,
+    first TEXT,
+    last TEXT
+);
+CREATE INDEX IF NOT EXISTS clusters_tenant ON clusters (tenant);
+CREATE INDEX IF NOT EXISTS clusters_vrf ON clusters (vrf);
+CREATE INDEX IF NOT EXISTS clusters_l3out ON clusters (l3out);
+CREATE INDEX IF NOT EXISTS vlans_range ON vlans (first, last);
+CREATE INDEX IF NOT EXISTS vlans_cluster ON vlans (system_id);
+CREATE INDEX IF NOT EXISTS subnets_range ON subnets (version, first, last);
+CREATE INDEX IF NOT EXISTS subnets_cluster ON subnets (system_id);
+"""
+
+INVENTORY_COLUMNS = ["system_id", "flavor", "tenant", "vrf_tenant", "vrf", "l3out",
+                     "cert_fingerprint", "plan_hash", "updated"]
+INVENTORY_VLANS = ["infra_vlan", "kubeapi_vlan", "service_vlan"]
+INVENTORY_SUBNETS = ["pod_subnet", "node_subnet", "extern_dynamic", "extern_static", "node_svc_subnet"]
+
+
+def subnet_bounds(cidr):
+    # Fixed width hex so IPv6 ranges compare correctly as sqlite TEXT
+    n = ipaddress.ip_network("%s" % (cidr,), strict=False)
+    return n.version, "%032x" % int(n.network_address), "%032x" % int(n.broadcast_address)
+
+
+def cert_fingerprint(cert_data):
+    # Hash the DER encoding, as openssl x509 -fingerprint does, so the
+    # PEM line wrapping doesn't matter
+    if not cert_data:
+        return None
+    if isinstance(cert_data, bytes):
+        cert_data = cert_data.decode("utf-8")
+    return hashlib.sha256(ssl.PEM_cert_to_DER_cert(cert_data)).hexdigest()
+
+
+class Inventory(object):
+    """SQLite inventory of the clusters provisioned from this host"""
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.executescript(INVENTORY_SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def record(self, config, plan_hash=None):
+        aci_config = config["aci_config"]
+        net_config = config["net_config"]
+        system_id = aci_config["system_id"]
+        row = [
+            system_id,
+            config["flavor"],
+            aci_config.get("cluster_tenant"),
+            aci_config["vrf"]["tenant"],
+            aci_config["vrf"]["name"],
+            (aci_config.get("l3out") or {}).get("name"),
+            cert_fingerprint(aci_config["sync_login"].get("cert_data")),
+            plan_hash,
+            time.time(),
+        ]
+        vlans = [(f, net_config[f], net_config[f]) for f in INVENTORY_VLANS if net_config.get(f)]
+        vlan_range = aci_config["vmm_domain"].get("vlan_range") or {}
+        if vlan_range.get("start") and vlan_range.get("end"):
+            vlans.append(("vlan_range", vlan_range["start"], vlan_range["end"]))
+        subnets = [(f, net_config[f]) for f in INVENTORY_SUBNETS if net_config.get(f)]
+        with self.db:
+            self.delete(system_id)
+            self.db.execute("INSERT INTO clusters VALUES (%s)" % ", ".join("?" * len(row)), row)
+            self.db.executemany("INSERT INTO vlans VALUES (?, ?, ?, ?)",
+                                [(system_id, f, int(first), int(last)) for f, first, last in vlans])
+            self.db.executemany("INSERT INTO subnets VALUES (?, ?, ?, ?, ?, ?)",
+                                [(system_id, f, cidr) + subnet_bounds(cidr) for f, cidr in subnets])
+
+    def delete(self, system_id):
+        for table in ("clusters", "vlans", "subnets"):
+            self.db.execute("DELETE FROM %s WHERE system_id = ?" % table, (system_id,))
+
+    def remove(self, system_id):
+        with self.db:
+            self.delete(system_id)
+
+    def clusters(self, where="1", params=()):
+        cur = self.db.execute(
+            "SELECT %s FROM clusters WHERE %s ORDER BY system_id" % (", ".join(INVENTORY_COLUMNS), where), params)
+        return [dict(zip(INVENTORY_COLUMNS, row)) for row in cur]
+
+    def find(self, field, value):
+        """Return the clusters using value as field
+
+        field is a clusters column, 'vlan' for clusters using a VLAN, or
+        'subnet' for clusters with a subnet overlapping value.
+        """
+        if field == "vlan":
+            return self.clusters(
+                "system_id IN (SELECT system_id FROM vlans WHERE first <= ? AND last >= ?)",
+                (int(value), int(value)))
+        if field == "subnet":
+            version, first, last = subnet_bounds(value)
+            return self.clusters(
+                "system_id IN (SELECT system_id FROM subnets WHERE version = ? AND first <= ? AND last >= ?)",
+                (version, last, first))
+        if field not in INVENTORY_COLUMNS:
+            raise ValueError("Unknown inventory field: %s" % field)
+        return self.clusters("%s = ?" % field, (value,))
+
+    def subnets(self, exclude=None, vrf=None):
+        """Return (label, subnet) for the subnets of the other clusters
+
+        If vrf is a (tenant, name) pair, only clusters in that VRF are
+        included; subnets of different VRFs may overlap.
+        """
+        where, params = "s.system_id IS NOT ?", [exclude]
+        if vrf is not None:
+            where += " AND c.vrf_tenant = ? AND c.vrf = ?"
+            params += list(vrf)
+        cur = self.db.execute(
+            "SELECT s.system_id, s.field, s.subnet FROM subnets s JOIN clusters c ON c.system_id = s.system_id"
+            " WHERE %s ORDER BY s.system_id, s.field" % where, params)
+        return [("%s/%s" % (system_id, field), subnet) for system_id, field, subnet in cur]
+
+    def conflicts(self, system_id):
+        """Return (field, other system_id, other field) for the VLANs and
+        subnets system_id shares with other clusters"""
+        cur = self.db.execute(
+            "SELECT a.field, b.system_id, b.field FROM vlans a JOIN vlans b"
+            " ON a.first <= b.last AND b.first <= a.last"
+            " WHERE a.system_id = ? AND b.system_id != ?"
+            " AND a.field != 'infra_vlan' AND b.field != 'infra_vlan'"
+            " UNION ALL"
+            " SELECT a.field, b.system_id, b.field FROM subnets a JOIN subnets b"
+            " ON a.version = b.version AND a.first <= b.last AND b.first <= a.last"
+            " WHERE a.system_id = ? AND b.system_id != ?"
+            " ORDER BY 1, 2, 3", (system_id,) * 4)
+        return cur.fetchall()
@@ -1,23 +1,35 @@
 from __future__ import print_function, unicode_literals
 
+import base64
 import collections
+import copy
 import filecmp
 import functools
+import glob
+import io
 import os
 import shutil
 import ssl
+import subprocess
 import sys
 import tempfile
 import tarfile
 import json
+import yaml
 
 
 from . import acc_provision
+from . import apic_provision
+from . import cloud_provision
 from . import fake_apic
+from . import inventory as acc_inventory
 
 
 debug = False
 
+# Keep the tests out of the user cache directory
+os.environ["ACC_PROVISION_CACHE_DIR"] = tempfile.mkdtemp()
+
 
 def in_testdir(f):
     @functools.wraps(f)
@@ -677,6 +689,8 @@ def get_args(**overrides):
         "aci_operator_cr": None,
         "apic_proxy": None,
         "apicfile": None,
+        "apicfile_format": "text",
+        "apply_plan": None,
         "apic": False,
         "delete": False,
         "username": "admin",
@@ -692,6 +706,17 @@ def get_args(**overrides):
         "skip_kafka_certs": True,
         "upgrade": False,
         "disable_multus": 'true',
+        "state_file": None,
+        "skip_unchanged": False,
+        "fleet": None,
+        "inventory": None,
+        "query": None,
+        "serve": None,
+        "batch": None,
+        "batch_output": ".",
+        "batch_workers": None,
+        "validate_only": False,
+        "tar_compression_level": 9,
         # infra_vlan is not part of command line input, but we do
         # pass it as a command line arg in unit tests to pass in
         # configuration which would otherwise be discovered from
@@ -770,6 +795,737 @@ def test_normalize_cidr():
     assert ipv6 == '2001::/16'
 
 
+def test_import_is_lazy():
+    # Heavy dependencies must only be imported on the code paths using them
+    heavy = ["boto3", "OpenSSL", "jinja2", "requests", "pkg_resources"]
+    out = subprocess.check_output(
+        [sys.executable, "-c", "import sys, acc_provision.acc_provision; "
+         "print(' '.join(m for m in %r if m in sys.modules))" % heavy],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert out.split() == []
+
+
+def test_kube_documents():
+    text = "kind: ConfigMap\nmetadata:\n  name: a\n---\nkind: Secret\nmetadata:\n  name: b\n" \
+        "data:\n  cert: |\n    -----BEGIN CERTIFICATE-----\n---\n"
+    docs = acc_provision.kube_documents(text)
+    assert [(d.kind, d.name) for d in docs] == [("ConfigMap", "a"), ("Secret", "b"), (None, None)]
+    assert "---".join(d.text for d in docs) == text
+
+
+@in_testdir
+def test_operator_tar_deterministic():
+    tmpdir = tempfile.mkdtemp()
+    before = sorted(os.listdir("."))
+    try:
+        tars = []
+        for level in (9, 9, 1):
+            tar_path = os.path.join(tmpdir, "operator-%d-%d.tar.gz" % (level, len(tars)))
+            args = get_args(config="base_case.inp.yaml", output=os.path.join(tmpdir, "kube.yaml"),
+                            output_tar=tar_path, aci_operator_cr="/dev/null", tar_compression_level=level)
+            acc_provision.main(args, no_random=True)
+            with open(tar_path, "rb") as f:
+                tars.append(f.read())
+        with tarfile.open(tar_path, "r:gz") as tar:
+            assert all(m.mtime == 0 and m.mode == 0o644 for m in tar.getmembers())
+    finally:
+        shutil.rmtree(tmpdir)
+    assert tars[0] == tars[1] and tars[0] != tars[2]
+    # Out of range levels fail the job, not the tar writer
+    args = get_args(config="base_case.inp.yaml", output="/dev/null", tar_compression_level=10)
+    assert not acc_provision.provision(args, None, True)
+    assert sorted(os.listdir(".")) == before
+
+
+@in_testdir
+def test_yaml_dump_golden():
+    # Every document of the golden tars, dumped again, must come out
+    # byte for byte the same, with libyaml and with the Python emitter
+    libyaml = 0
+    for path in sorted(glob.glob("*_tar/cluster-network-*-*-*.yaml")):
+        with open(path, "rb") as f:
+            golden = f.read()
+        data = yaml.load(golden, Loader=yaml.SafeLoader)
+        assert acc_provision.yaml_dump(data, default_flow_style=False, encoding="utf-8") == golden, path
+        assert yaml.dump(data, Dumper=yaml.SafeDumper, default_flow_style=False, encoding="utf-8") == golden, path
+        libyaml += acc_provision.libyaml_same(data)
+    assert libyaml > 0 or acc_provision.YamlSafeDumper is yaml.SafeDumper
+
+    # Folded under a long key although shorter than the line width
+    data = {"k" * 30: {"inner" * 6: u"a b c d e f g h i j k l m n o p q r s t u v\xe9w x y z 0 1 2 3\t"}}
+    assert acc_provision.yaml_dump(data, default_flow_style=False) == \
+        yaml.dump(data, Dumper=yaml.SafeDumper, default_flow_style=False)
+
+
+@in_testdir
+def test_compiled_templates():
+    from jinja2 import ModuleLoader
+    tmpdir = tempfile.mkdtemp()
+    jinja_env = acc_provision.get_jinja_env()
+    assert acc_provision.get_jinja_env() is jinja_env
+    try:
+        acc_provision.compile_templates(tmpdir)
+        assert acc_provision.compiled_templates_fresh(tmpdir)
+        # Modules built by another Jinja version are not used
+        manifest = os.path.join(tmpdir, acc_provision.COMPILED_TEMPLATES_MANIFEST)
+        with open(manifest, "r") as f:
+            built = json.load(f)
+        with open(manifest, "w") as f:
+            json.dump(dict(built, jinja2="0.0"), f)
+        assert not acc_provision.compiled_templates_fresh(tmpdir)
+        acc_provision.jinja_env = acc_provision.make_jinja_env(ModuleLoader(tmpdir))
+        run_provision(
+            "base_case.inp.yaml",
+            "base_case.kube.yaml",
+            "base_case_tar",
+            "base_case_operator_cr.kube.yaml",
+            "base_case.apic.txt"
+        )
+    finally:
+        acc_provision.jinja_env = jinja_env
+        shutil.rmtree(tmpdir)
+
+
+def test_catalog_cache():
+    tmpdir = tempfile.mkdtemp()
+    orig = (acc_provision.FLAVORS_PATH, acc_provision.VERSIONS_PATH, acc_provision.load_yaml_file)
+    cache_dir = os.environ["ACC_PROVISION_CACHE_DIR"]
+    os.environ["ACC_PROVISION_CACHE_DIR"] = os.path.join(tmpdir, "cache")
+    try:
+        for path in orig[:2]:
+            shutil.copy(path, tmpdir)
+        acc_provision.FLAVORS_PATH = os.path.join(tmpdir, "flavors.yaml")
+        acc_provision.VERSIONS_PATH = os.path.join(tmpdir, "versions.yaml")
+        catalog = acc_provision.load_catalog()
+        assert catalog["flavors"]["flavors"] == acc_provision.FLAVORS
+        assert os.path.exists(acc_provision.catalog_cache_path())
+
+        # Served from the cache, also when only the mtime changes
+        acc_provision.load_yaml_file = None
+        assert acc_provision.load_catalog() == catalog
+        os.utime(acc_provision.VERSIONS_PATH, (0, 0))
+        assert acc_provision.load_catalog() == catalog
+
+        acc_provision.load_yaml_file = orig[2]
+        with open(acc_provision.VERSIONS_PATH, "w") as f:
+            f.write("versions: {}\n")
+        assert acc_provision.load_catalog()["versions"] == {"versions": {}}
+
+        # A fresh process, importing the module, is served from the cache
+        # written after the import
+        code = "import acc_provision.acc_provision as a; a.flush_catalog_cache(); print(a.catalog_pending is None)"
+        env = dict(os.environ, ACC_PROVISION_CACHE_DIR=os.path.join(tmpdir, "import-cache"))
+        cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        subprocess.check_output([sys.executable, "-c", code], cwd=cwd, env=env)
+        code = "import acc_provision.acc_provision as a; print(a.catalog_pending is None)"
+        assert subprocess.check_output([sys.executable, "-c", code], cwd=cwd, env=env).split() == [b"True"]
+
+        # A cache writable by other users is not loaded
+        os.chmod(acc_provision.catalog_cache_path(), 0o666)
+        acc_provision.load_yaml_file = None
+        try:
+            acc_provision.load_catalog()
+            assert False, "loaded an untrusted cache"
+        except TypeError:
+            pass
+    finally:
+        acc_provision.FLAVORS_PATH, acc_provision.VERSIONS_PATH, acc_provision.load_yaml_file = orig
+        os.environ["ACC_PROVISION_CACHE_DIR"] = cache_dir
+        shutil.rmtree(tmpdir)
+
+
+def test_fetch_versions_cache():
+    import threading
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append(self.headers.get("If-None-Match"))
+            if self.headers.get("If-None-Match") == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+                return
+            body = b"versions:\n  '9.9':\n    aci_containers_host_version: 9.9.0\n"
+            self.send_response(200)
+            self.send_header("ETag", '"v1"')
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:%d/versions.yaml" % server.server_address[1]
+    tmpdir = tempfile.mkdtemp()
+    cache_dir = os.environ["ACC_PROVISION_CACHE_DIR"]
+    os.environ["ACC_PROVISION_CACHE_DIR"] = tmpdir
+    try:
+        expected = {"versions": {"9.9": {"aci_containers_host_version": "9.9.0"}}}
+        assert acc_provision.fetch_versions(url) == expected
+        # Fresh cache, no request
+        assert acc_provision.fetch_versions(url) == expected
+        assert requests_seen == [None]
+        # Expired cache is revalidated
+        assert acc_provision.fetch_versions(url, ttl=0) == expected
+        assert requests_seen == [None, '"v1"']
+        # Offline, fall back to the cached copy
+        server.shutdown()
+        server.server_close()
+        assert acc_provision.fetch_versions(url, ttl=0) == expected
+        assert len(requests_seen) == 2
+        # Loaded versions are per run, the packaged ones stay in place
+        versions = acc_provision.VERSIONS
+        assert acc_provision.get_versions(url) == expected["versions"]
+        assert acc_provision.VERSIONS is versions
+    finally:
+        os.environ["ACC_PROVISION_CACHE_DIR"] = cache_dir
+        shutil.rmtree(tmpdir)
+
+
+def test_config_schema_errors():
+    config = {
+        "flavor": "kubernetes-1.15",
+        "aci_config": {"system_id": "kube", "apic_hosts": "10.30.120.100",
+                       "vrf": {"name": "kube", "tenant": "common"}, "aep": "kube-aep",
+                       "l3out": {"name": "l3out", "external_networks": ["default"]},
+                       "vmm_domain": {"encap_type": "vlan", "vlan_range": {"start": 10, "end": 5000}}},
+        "net_config": {"infra_vlan": 4093, "service_vlan": 0, "kubeapi_vlan": 4001,
+                       "pod_subnet": "10.2.0.1/16", "node_subnet": "10.1.0.1", "extern_dynamic": "10.3.0.1/24",
+                       "extern_static": "10.4.0.1/24", "node_svc_subnet": "10.5.0.1/24"},
+        "kube_config": {"use_cluster_role": "yes", "snat_operator": {"port_range": {"start": 70000}}},
+        "registry": dict((field, "1.0") for field in acc_provision.VERSION_FIELDS),
+    }
+    errors = acc_provision.config_errors({}, config)
+    assert [key for key, _ in errors] == [
+        "aci_config/apic_host",
+        "aci_config/vmm_domain/vlan_range/end",
+        "kube_config/snat_operator/port_range/start",
+        "kube_config/use_cluster_role",
+        "net_config/node_subnet",
+        "net_config/service_vlan",
+    ]
+
+
+def test_subnet_index_fleet():
+    config = {"net_config": {"pod_subnet": "10.2.0.1/16", "node_subnet": "10.1.0.1/16",
+                             "extern_dynamic": "10.3.0.1/24", "node_svc_subnet": "10.5.0.1/24"}}
+    fleet = []
+    for i in range(300):
+        fleet.append(("cluster%d/pod_subnet" % i, "172.%d.%d.1/24" % (16 + i // 256, i % 256)))
+    fleet += [("old/pod_subnet", "10.2.128.1/17"), ("old/node_subnet", "10.0.0.1/8"), ("v6/pod_subnet", "::/0")]
+    index = acc_provision.SubnetIndex(acc_provision.subnet_ranges(config) + fleet)
+    conflicts = index.conflicts(set(["pod_subnet", "node_subnet", "extern_dynamic", "node_svc_subnet"]))
+    assert sorted((a[0], b[0]) for a, b in conflicts) == [
+        ("old/node_subnet", "extern_dynamic"),
+        ("old/node_subnet", "node_subnet"),
+        ("old/node_subnet", "node_svc_subnet"),
+        ("old/node_subnet", "pod_subnet"),
+        ("pod_subnet", "old/pod_subnet"),
+    ]
+    assert acc_provision.check_overlapping_subnets(config, fleet[:300])
+
+
+def test_fleet_allocator():
+    allocator = acc_provision.FleetAllocator(2, 4094)
+    allocator.reserve_vlans(2, 10)
+    allocator.reserve_vlans(13)
+    assert allocator.allocate_vlans() == 11
+    assert allocator.allocate_vlans(3) == 14
+    assert allocator.allocate_vlans() == 12
+    allocator.reserve_subnet("10.128.0.1/24")
+    allocator.reserve_subnet("10.128.2.0/23")
+    assert allocator.allocate_subnet("10.128.0.0/16", 24) == "10.128.1.1/24"
+    assert allocator.allocate_subnet("10.128.0.0/16", 24) == "10.128.4.1/24"
+    assert allocator.allocate_subnet("10.128.0.0/23", 24) is None
+    # A wide range hides behind a later, smaller one
+    allocator.reserve_subnet("10.0.0.0/8")
+    allocator.reserve_subnet("10.2.0.0/16")
+    assert allocator.allocate_subnet("10.5.0.0/16", 24) is None
+    assert allocator.allocate_subnet("10.0.0.0/7", 8) == "11.0.0.1/8"
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        shutil.copy("testdata/base_case.inp.yaml", tmpdir)
+        config = acc_provision.LayeredConfig([{
+            "flavor": "kubernetes-1.15",
+            "aci_config": {"system_id": "new", "vrf": {"tenant": "common", "name": "kube"},
+                           "vmm_domain": {"encap_type": "vlan"}},
+            "net_config": {"infra_vlan": 4093, "kubeapi_vlan": None, "service_vlan": None, "node_svc_subnet": None,
+                           "extern_dynamic": None, "extern_static": "10.6.0.1/24"},
+        }, acc_provision.config_default()])
+        config["allocator"]["vlan_pool"]["start"] = 4000
+        config["allocator"]["vlan_range_size"] = 50
+        config["allocator"]["subnet_pool"] = "10.0.0.0/12"
+        fleet, recorded = acc_provision.fleet_allocate(tmpdir, config)
+        assert ("kube/pod_subnet", "10.2.0.1/16") in fleet
+        allocated = config.materialize()
+        assert allocated["net_config"]["kubeapi_vlan"] == 4000
+        assert allocated["net_config"]["service_vlan"] == 4002
+        assert allocated["aci_config"]["vmm_domain"]["vlan_range"] == {"start": 4004, "end": 4053}
+        assert allocated["net_config"]["node_svc_subnet"] == "10.0.0.1/24"
+        assert allocated["net_config"]["extern_dynamic"] == "10.0.1.1/24"
+        assert allocated["net_config"]["extern_static"] == "10.6.0.1/24"
+        # Allocations are only recorded once the config is validated
+        assert not os.path.exists(os.path.join(tmpdir, ".acc-provision-allocations.json"))
+        assert acc_provision.fleet_record(tmpdir, "new", recorded)
+
+        # Clusters in other VRFs are not overlap checked
+        config = acc_provision.LayeredConfig([{
+            "flavor": "kubernetes-1.15",
+            "aci_config": {"system_id": "other", "vrf": {"tenant": "other", "name": "kube"}},
+        }, acc_provision.config_default()])
+        config["allocator"]["subnet_pool"] = "10.0.0.0/12"
+        fleet, _ = acc_provision.fleet_allocate(tmpdir, config)
+        assert fleet == []
+        assert config["net_config"]["node_svc_subnet"] == "10.0.2.1/24"
+
+        # Values set by the user win over recorded allocations
+        config = acc_provision.LayeredConfig([{
+            "flavor": "kubernetes-1.15",
+            "aci_config": {"system_id": "new", "vmm_domain": {"encap_type": "vlan"}},
+            "net_config": {"kubeapi_vlan": 1234},
+        }, acc_provision.config_default()])
+        config["allocator"]["vlan_pool"]["start"] = 4000
+        acc_provision.fleet_allocate(tmpdir, config)
+        assert config["net_config"]["kubeapi_vlan"] == 1234
+        assert config["net_config"]["service_vlan"] == 4002
+
+        # The cluster's own VLANs and subnets are not allocated again
+        config = acc_provision.LayeredConfig([{
+            "flavor": "kubernetes-1.15",
+            "aci_config": {"system_id": "own", "vmm_domain": {"encap_type": "vlan",
+                                                              "vlan_range": {"start": 4000, "end": 4000}}},
+            "net_config": {"node_subnet": "10.0.0.1/16"},
+        }, acc_provision.config_default()])
+        config["allocator"]["vlan_pool"]["start"] = 4000
+        config["allocator"]["subnet_pool"] = "10.0.0.0/12"
+        acc_provision.fleet_allocate(tmpdir, config)
+        assert config["net_config"]["kubeapi_vlan"] not in (4000, 4002, 4004)
+        assert not config["net_config"]["node_svc_subnet"].startswith("10.0.")
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+@in_testdir
+def test_inventory():
+    with tempfile.NamedTemporaryFile(suffix=".db") as db:
+        # Generating without -a doesn't record the cluster
+        run_provision("base_case.inp.yaml", overrides={"inventory": db.name})
+        inventory = acc_provision.open_inventory(db.name)
+        try:
+            assert inventory.clusters() == []
+
+            with open("user.crt") as f:
+                cert_data = f.read()
+            config = {"flavor": "kubernetes-1.15", "net_config": {"pod_subnet": "10.2.0.1/16", "kubeapi_vlan": 4001},
+                      "aci_config": {"system_id": "kube", "cluster_tenant": "kube",
+                                     "vrf": {"tenant": "common", "name": "kube"}, "l3out": {"name": "l3out"},
+                                     "sync_login": {"cert_data": cert_data}, "vmm_domain": {}}}
+            inventory.record(config, "0" * 64)
+            cluster, = inventory.find("tenant", "kube")
+            assert cluster["system_id"] == "kube"
+            assert cluster["l3out"] == "l3out"
+            # The DER fingerprint doesn't depend on the PEM line wrapping
+            assert cluster["cert_fingerprint"] == acc_inventory.cert_fingerprint(cert_data.replace("\n", "\r\n"))
+            assert inventory.find("vlan", 4001) == [cluster]
+            assert inventory.find("subnet", "10.2.128.0/17") == [cluster]
+            assert inventory.find("subnet", "10.6.0.0/16") == []
+
+            # Same subnets under another system_id conflict with it
+            config = {"flavor": "kubernetes-1.15", "net_config": {"pod_subnet": "10.2.0.1/24", "kubeapi_vlan": 4001},
+                      "aci_config": {"system_id": "other", "vrf": {"tenant": "common", "name": "kube"},
+                                     "sync_login": {}, "vmm_domain": {}}}
+            inventory.record(config)
+            assert inventory.conflicts("other") == [("kubeapi_vlan", "kube", "kubeapi_vlan"),
+                                                    ("pod_subnet", "kube", "pod_subnet")]
+            assert ("kube/pod_subnet", "10.2.0.1/16") in inventory.subnets("other")
+            # Only clusters of the same VRF take part in the overlap check
+            assert ("kube/pod_subnet", "10.2.0.1/16") in inventory.subnets("other", ("common", "kube"))
+            assert inventory.subnets("other", ("common", "other")) == []
+        finally:
+            inventory.close()
+
+
+@in_testdir
+def test_batch():
+    tmpdir = tempfile.mkdtemp()
+    with tempfile.NamedTemporaryFile("w+") as tmperr:
+        try:
+            shutil.copy("base_case.inp.yaml", tmpdir)
+            shutil.copy("with_overlapping_subnets.inp.yaml", tmpdir)
+            sys.stderr = tmperr
+            args = get_args(batch=tmpdir, batch_output=os.path.join(tmpdir, "out"), batch_workers=2,
+                            apicfile="-", apicfile_format="ndjson")
+            try:
+                acc_provision.main(args, no_random=True)
+                assert False, "overlapping subnets input must fail"
+            except SystemExit:
+                pass
+        finally:
+            sys.stderr = sys.__stderr__
+            out = sorted(os.listdir(os.path.join(tmpdir, "out")))
+            shutil.rmtree(tmpdir)
+        tmperr.seek(0)
+        stderr = tmperr.read()
+    assert out == ["base_case.inp.apic.ndjson", "base_case.inp.kube.yaml", "base_case.inp.operator_cr.yaml", "base_case.inp.tar.gz"]
+    assert "INFO: Batch done: 1 succeeded, 1 failed" in stderr
+    assert "ERR:  overlapping subnets found in configuration input file" in stderr
+
+
+@in_testdir
+def test_validate_only():
+    tmpdir = tempfile.mkdtemp()
+    shutil.copy("base_case.inp.yaml", tmpdir)
+    shutil.copy("with_overlapping_subnets.inp.yaml", tmpdir)
+    try:
+        sys.stdout = io.StringIO()
+        sys.stderr = io.StringIO()
+        args = get_args(batch=tmpdir, batch_output=os.path.join(tmpdir, "out"), validate_only=True)
+        try:
+            acc_provision.main(args, no_random=True)
+            assert False, "overlapping subnets input must fail"
+        except SystemExit:
+            pass
+        records = [json.loads(line) for line in sys.stdout.getvalue().splitlines()]
+        out = os.listdir(tmpdir)
+    finally:
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
+        shutil.rmtree(tmpdir)
+    assert sorted(out) == ["base_case.inp.yaml", "out", "with_overlapping_subnets.inp.yaml"]
+    records = dict((os.path.basename(r["config"]), r) for r in records)
+    assert records["base_case.inp.yaml"]["valid"] and records["base_case.inp.yaml"]["findings"] == []
+    findings = records["with_overlapping_subnets.inp.yaml"]["findings"]
+    assert not records["with_overlapping_subnets.inp.yaml"]["valid"]
+    assert [(f["check"], f["field"]) for f in findings] == [("overlap", "node_subnet"), ("overlap", "extern_dynamic")]
+
+
+@in_testdir
+def test_multi_document_input():
+    with open("base_case.inp.yaml", "r") as f:
+        data = f.read()
+    data = "---\n" + data + "---\n" + data.replace("system_id: kube", "system_id: kube2")
+    tmpdir = tempfile.mkdtemp()
+    try:
+        sys.stdin = io.StringIO(data)
+        sys.stderr = io.StringIO()
+        acc_provision.main(get_args(config="-", batch_output=tmpdir), no_random=True)
+        stderr = sys.stderr.getvalue()
+        out = sorted(os.listdir(tmpdir))
+        with open(os.path.join(tmpdir, "stdin-kube2.kube.yaml"), "r") as f:
+            kube2 = f.read()
+    finally:
+        sys.stdin = sys.__stdin__
+        sys.stderr = sys.__stderr__
+        shutil.rmtree(tmpdir)
+    assert out == ["stdin-kube.kube.yaml", "stdin-kube.operator_cr.yaml", "stdin-kube.tar.gz",
+                   "stdin-kube2.kube.yaml", "stdin-kube2.operator_cr.yaml", "stdin-kube2.tar.gz"]
+    assert "INFO: Batch done: 2 succeeded, 0 failed" in stderr
+    assert "\"aci-prefix\": \"kube2\"" in kube2
+
+    # Documents must not write the same outputs, a non-mapping document fails on its own
+    args = get_args(config="-", batch_output=tmpdir)
+    for text, error in ((data + "---\n" + data, "ERR:  Several clusters write"),
+                        (data + "---\n- a\n", "ERR:  Invalid configuration input"),
+                        (data + "---\n" + data.replace("system_id: kube", "system_id: kube3"),
+                         "ERR:  -o, -z, -r and --apicfile can't name files")):
+        if "kube3" in text:
+            args = get_args(config="-", batch_output=tmpdir, output="kube.yaml")
+        try:
+            sys.stdin = io.StringIO(text)
+            sys.stderr = io.StringIO()
+            acc_provision.main(args, no_random=True)
+        except SystemExit:
+            pass
+        finally:
+            stderr = sys.stderr.getvalue()
+            sys.stdin = sys.__stdin__
+            sys.stderr = sys.__stderr__
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        assert error in stderr
+
+
+@in_testdir
+def test_serve():
+    import requests
+    import threading
+
+    server = acc_provision.make_server(get_args(), ("127.0.0.1", 0), no_random=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = "http://127.0.0.1:%d" % server.server_address[1]
+    try:
+        flavors = requests.get(url + "/flavors").json()
+        assert flavors and all(not acc_provision.FLAVORS[f]["hidden"] for f in flavors)
+        with open("base_case.inp.yaml", "r") as f:
+            request = {"config": f.read(), "flavor": "kubernetes-1.15"}
+        for _ in range(2):
+            res = requests.post(url + "/provision", json=request)
+            assert res.status_code == 200
+            ret = res.json()
+            assert ret["ok"]
+            assert "kind: ConfigMap" in ret["kube"]
+            assert ret["apic"].startswith("/api/")
+            assert tarfile.open(fileobj=io.BytesIO(base64.b64decode(ret["tar"]))).getnames()
+
+        request["config"] = {"aci_config": {"system_id": "kube"}}
+        res = requests.post(url + "/provision", json=request)
+        assert res.status_code == 422
+        assert "Missing option" in res.json()["messages"]
+        assert not os.path.exists("kube.yaml")
+
+        # Malformed requests, server paths and server credentials are rejected
+        certfile = "aci_config:\n  sync_login:\n    certfile: /etc/passwd\n"
+        for body in ([], {"config": [1]}, {"config": "- a"}, {"config": {"versions_url": {"path": "/etc/passwd"}}},
+                     {"config": certfile}, {"config": {"aci_config": {"sync_login": {"keyfile": "/etc/shadow"}}}},
+                     dict(request, apply=True), dict(request, delete=True, username="admin")):
+            assert requests.post(url + "/provision", json=body).status_code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_layered_config():
+    flavor = {"net_config": {"infra_vlan": 4093, "kubeapi_vlan": 10}, "registry": "quay.io"}
+    defaults = {"net_config": {"infra_vlan": None, "service_vlan": 20}, "registry": {"image_prefix": "noiro"}}
+    layers = [{"net_config": {"kubeapi_vlan": 11}}, flavor, defaults]
+    expected = acc_provision.deep_merge(copy.deepcopy(layers[0]), copy.deepcopy(flavor))
+    expected = acc_provision.deep_merge(expected, copy.deepcopy(defaults))
+
+    config = acc_provision.LayeredConfig(layers)
+    net_config = config["net_config"]
+    config.push({"net_config": {"infra_vlan": 3456}}, top=True)
+    net_config["service_vlan"] = 30
+    assert net_config["infra_vlan"] == 3456
+    assert config["registry"] == "quay.io"
+    expected["net_config"].update({"infra_vlan": 3456, "service_vlan": 30})
+    assert config.materialize() == expected
+    assert flavor["net_config"] == {"infra_vlan": 4093, "kubeapi_vlan": 10}
+    assert defaults["net_config"]["service_vlan"] == 20
+
+
+@in_testdir
+def test_tenant_template_shared():
+    apic_provision.tenant_templates.clear()
+    run_provision("base_case.inp.yaml", None, None, None, "base_case.apic.txt")
+    assert len(apic_provision.tenant_templates) == 1
+    # Same tenant shape, only non-tenant settings differ
+    run_provision("with_interface_mtu.inp.yaml", None, None, None, "with_interface_mtu.apic.txt")
+    assert len(apic_provision.tenant_templates) == 1
+    run_provision("base_case_ipv6.inp.yaml", None, None, None, "base_case_ipv6.apic.txt")
+    assert len(apic_provision.tenant_templates) == 2
+
+
+def test_tenant_template_literals():
+    # A literal equal to a placeholder is not a slot
+    slots = [("@@slot-0@@", ("aci_config", "system_id")), ("192.0.2.1/24", ("net_config", "node_subnet"))]
+    tree = [{"a": "192.0.2.1/24", "b": "192.0.2.1/24", "c": "kube-@@slot-0@@"}]
+    alt_tree = [{"a": "192.0.2.1/24", "b": "203.0.113.1/24", "c": "kube-@@alt-0@@"}]
+    template = apic_provision.TenantTemplate(tree, alt_tree, slots)
+    config = {"aci_config": {"system_id": "k8s"}, "net_config": {"node_subnet": "10.1.0.1/16"}}
+    assert template.fill(config) == ({"a": "192.0.2.1/24", "b": "10.1.0.1/16", "c": "kube-k8s"},)
+
+
+@in_testdir
+def test_incremental_regeneration():
+    state_file = os.path.join(tempfile.mkdtemp(), "state.json")
+    get_jinja_template = acc_provision.get_jinja_template
+    rendered = []
+
+    def recording_get_jinja_template(file):
+        rendered.append(file)
+        return get_jinja_template(file)
+
+    try:
+        run_provision("base_case.inp.yaml", "base_case.kube.yaml", "base_case_tar",
+                      "base_case_operator_cr.kube.yaml", "base_case.apic.txt", overrides={"state_file": state_file})
+        # The state holds the sync password
+        assert os.stat(state_file).st_mode & 0o077 == 0
+        acc_provision.get_jinja_template = recording_get_jinja_template
+        run_provision("base_case.inp.yaml", "base_case.kube.yaml", "base_case_tar",
+                      "base_case_operator_cr.kube.yaml", "base_case.apic.txt", overrides={"state_file": state_file})
+        assert "aci-containers.yaml" not in rendered
+        # A changed input regenerates the outputs that read it
+        run_provision("with_interface_mtu.inp.yaml", "with_interface_mtu.kube.yaml", None,
+                      None, "with_interface_mtu.apic.txt", overrides={"state_file": state_file})
+        assert "aci-containers.yaml" in rendered
+
+        # The configuration version is only kept while no output changes
+        def configuration_version(inpfile):
+            run_provision(inpfile, overrides={"state_file": state_file, "version_token": None})
+            with open(state_file, "r") as f:
+                return json.load(f)["values"]["configuration_version"]
+        version = configuration_version("base_case.inp.yaml")
+        assert configuration_version("base_case.inp.yaml") == version
+        assert configuration_version("with_interface_mtu.inp.yaml") != version
+    finally:
+        acc_provision.get_jinja_template = get_jinja_template
+        shutil.rmtree(os.path.dirname(state_file))
+
+
+def test_tracked_config_truthiness():
+    from jinja2 import Template
+    template = Template("{% if config.a.b %}set{% endif %}")
+    state = apic_provision.RegenState()
+    render = lambda config: state.cached("t", config, lambda tracked: template.render(config=tracked))
+    assert render({"a": {"b": {}, "c": 1}}) == ""
+    state.entries = state.used
+    assert render({"a": {"b": {"x": 1}, "c": 1}}) == "set"
+
+
+@in_testdir
+def test_apicfile_ndjson():
+    with tempfile.NamedTemporaryFile("w+") as output, tempfile.NamedTemporaryFile("w+") as apicfile:
+        args = get_args(config="base_case.inp.yaml", output=output.name, output_tar="/dev/null",
+                        aci_operator_cr="/dev/null", apicfile_format="ndjson")
+        acc_provision.main(args, apicfile.name, no_random=True)
+        records = [json.loads(line) for line in apicfile]
+        assert records[0]["meta"]["system_id"] == "kube"
+        assert set(records[1].keys()) == set(["path", "payload", "deps"])
+        assert any("uni/infra/vlanns-[kube-pool]-static" in record["deps"] for record in records[1:])
+
+        apicfile.seek(0)
+        with tempfile.NamedTemporaryFile("w+") as plan:
+            apic_provision.ApicKubeConfig.save_config(apic_provision.ApicKubeConfig.load_config(apicfile), plan)
+            plan.seek(0)
+            with open("base_case.apic.txt", "r") as expected:
+                assert plan.read() == expected.read()
+
+
+@in_testdir
+def test_apply_plan():
+    class PlanApic(object):
+        errors = 0
+
+        def provision(self, data, sync_login):
+            self.posted = list(data)
+            self.sync_login = sync_login
+
+    get_apic = acc_provision.get_apic
+    apic = PlanApic()
+    acc_provision.get_apic = lambda config: apic
+    try:
+        with tempfile.NamedTemporaryFile("w+") as output, tempfile.NamedTemporaryFile("w+") as apicfile:
+            args = get_args(config="base_case.inp.yaml", output=output.name, output_tar="/dev/null",
+                            aci_operator_cr="/dev/null", apicfile_format="ndjson")
+            acc_provision.main(args, apicfile.name, no_random=True)
+            # No config or flavor needed to apply the plan
+            acc_provision.main(get_args(flavor=None, apply_plan=apicfile.name))
+    finally:
+        acc_provision.get_apic = get_apic
+
+    assert apic.sync_login == "kube"
+    with tempfile.NamedTemporaryFile("w+") as plan:
+        apic_provision.ApicKubeConfig.save_config(apic.posted, plan)
+        plan.seek(0)
+        with open("base_case.apic.txt", "r") as expected:
+            assert plan.read() == expected.read()
+
+
+def test_l3out_contracts_teardown():
+    config = {"aci_config": {"system_id": "kube", "vrf": {"tenant": "common"},
+                             "l3out": {"name": "l3out", "external_networks": ["default", "other"]}}}
+    path, data = apic_provision.ApicKubeConfig(config).l3out_contracts()
+    assert path == "/api/mo/uni/tn-common/out-l3out.json"
+    teardown = apic_provision.mo_teardown(json.dumps(data))
+    assert teardown["l3extOut"]["attributes"]["status"] == "modified"
+    for instp in teardown["l3extOut"]["children"]:
+        assert instp["l3extInstP"]["attributes"]["status"] == "modified"
+        rsprov = instp["l3extInstP"]["children"][0]["fvRsProv"]
+        assert rsprov["attributes"]["status"] == "deleted"
+    # Objects we own are deleted by path
+    assert apic_provision.mo_teardown(json.dumps(instp["l3extInstP"]["children"][0])) is None
+
+
+def test_capic_contracts_batched():
+    class PostApic(object):
+        def __init__(self):
+            self.posts = []
+
+        def post(self, path, data):
+            self.posts.append((path, data))
+            return collections.namedtuple("resp", ["content", "text"])('{"imdata": []}', "")
+
+    config = {"aci_config": {"cluster_tenant": "kube", "vmm_domain": {"domain": "kube"},
+                             "filters": [{"name": "f", "entries": [{"name": "e", "prot": "tcp"}]}] * 3,
+                             "contracts": [{"name": "c", "filter": "f"}]}}
+    cloud = cloud_provision.CloudProvision.__new__(cloud_provision.CloudProvision)
+    cloud.apic = PostApic()
+    cloud.config = config
+    cloud.args = get_args(debug=False)
+    cloud.configurator = apic_provision.ApicKubeConfig(config)
+    cloud.deleter = cloud_provision.MoCleaner(cloud.apic, config)
+
+    cloud.setupCapicContractsInline()
+    assert len(cloud.apic.posts) == 1
+    path, data = cloud.apic.posts[0]
+    assert path == "/api/mo/uni/tn-kube.json"
+    assert "annotation" not in data["fvTenant"]["attributes"]
+    assert [list(child.keys())[0] for child in data["fvTenant"]["children"]] == ["vzFilter", "vzBrCP"]
+
+    batch = cloud_provision.CAPIC_CONTRACT_BATCH
+    cloud_provision.CAPIC_CONTRACT_BATCH = 1
+    try:
+        cloud.apic.posts = []
+        cloud.setupCapicContractsInline()
+        assert len(cloud.apic.posts) == 2
+    finally:
+        cloud_provision.CAPIC_CONTRACT_BATCH = batch
+
+
+def test_mo_index():
+    def mo(klass, children=None, **attributes):
+        return {klass: {"attributes": attributes, "children": children or []}}
+
+    epg = mo("fvAEPg", [mo("fvRsBd", tnFvBDName="kube-node-bd")], name="kube-nodes")
+    bd = mo("fvBD", [mo("fvSubnet", ip="10.1.0.1/16")], name="kube-node-bd")
+    tenant = mo("fvTenant", [mo("fvAp", [epg], name="kube"), bd], name="kube", dn="uni/tn-kube")
+    index = apic_provision.MoIndex([("/api/mo/uni/tn-kube.json", json.dumps(tenant))])
+    assert index.find("fvAEPg", "kube-nodes") == ["uni/tn-kube/ap-kube/epg-kube-nodes"]
+    assert index.lookup("uni/tn-kube/BD-kube-node-bd/subnet-[10.1.0.1/16]")["attributes"]["ip"] == "10.1.0.1/16"
+    assert index.children("uni/tn-kube") == ["uni/tn-kube/ap-kube", "uni/tn-kube/BD-kube-node-bd"]
+
+    index.remove("uni/tn-kube/BD-kube-node-bd")
+    assert index.find("fvBD", "kube-node-bd") == []
+    assert index.lookup("uni/tn-kube")["children"][0]["fvAp"]["attributes"]["name"] == "kube"
+    assert len(index.lookup("uni/tn-kube")["children"]) == 1
+
+
+def test_mo_fingerprint():
+    def mo(klass, children=None, **attributes):
+        return {klass: {"attributes": attributes, "children": children or []}}
+
+    generated = mo("fvBD", [mo("fvSubnet", ip="10.1.0.1/16"), mo("fvRsCtx", tnFvCtxName="kube")],
+                   name="kube-pod-bd")
+    # APIC adds defaults and unrelated children, and may reorder children
+    current = mo("fvBD", [mo("fvRsCtx", tnFvCtxName="kube", rn="rsctx"), mo("fvRsBDToOut", tnL3extOutName="l3out"),
+                          mo("fvSubnet", ip="10.1.0.1/16", scope="private")],
+                 name="kube-pod-bd", arpFlood="no", dn="uni/tn-kube/BD-kube-pod-bd")
+    fp = apic_provision.mo_fingerprint(generated)
+    assert apic_provision.mo_fingerprint(current, fp).digest == fp.digest
+    assert apic_provision.mo_diff(fp, apic_provision.mo_fingerprint(current, fp), "uni/tn-kube/BD-kube-pod-bd") == []
+
+    current["fvBD"]["children"][0]["fvRsCtx"]["attributes"]["tnFvCtxName"] = "other"
+    diff = apic_provision.mo_diff(fp, apic_provision.mo_fingerprint(current, fp), "uni/tn-kube/BD-kube-pod-bd")
+    assert diff == ["uni/tn-kube/BD-kube-pod-bd/rsctx"]
+
+    # children without an RN format are keyed by content, not class
+    generated = mo("l3extOut", [mo("fooEntry", key="a", value="1"), mo("fooEntry", key="b", value="2")])
+    fp = apic_provision.mo_fingerprint(generated)
+    assert len(fp.children) == 2
+    current = mo("l3extOut", [mo("fooEntry", key="b", value="2", rn="e-1"), mo("fooEntry", key="a", value="9", rn="e-0")])
+    assert apic_provision.mo_fingerprint(current, fp).digest != fp.digest
+    current["l3extOut"]["children"][1]["fooEntry"]["attributes"]["value"] = "1"
+    assert apic_provision.mo_fingerprint(current, fp).digest == fp.digest
+
+
 '''@in_testdir
 def test_certificate_generation_cloud_foundry():
     create_certificate("flavor_cf_10.inp.yaml", "user.crt", output='temp.yaml', flavor="cloudfoundry-1.0")'''